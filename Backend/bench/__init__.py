@@ -0,0 +1 @@
+"""Нагрузочный бенчмарк бэкенда (см. bench/run.py)."""
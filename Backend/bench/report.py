@@ -0,0 +1,88 @@
+"""Сводка результатов бенчмарка и сравнение с сохранённым baseline."""
+import json
+
+
+class Stats:
+    """Замеры одного сценария: задержки (мс), ошибки, число SQL-запросов."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.latencies: list[float] = []
+        self.errors = 0
+        self.queries = 0
+        self.duration = 0.0
+
+    def add(self, latency_ms: float, queries: int = 0):
+        self.latencies.append(latency_ms)
+        self.queries += queries
+
+    def summary(self) -> dict:
+        count = len(self.latencies)
+        ordered = sorted(self.latencies)
+        return {
+            "count": count,
+            "errors": self.errors,
+            "p50_ms": round(percentile(ordered, 50), 2),
+            "p99_ms": round(percentile(ordered, 99), 2),
+            "throughput_rps": round(count / self.duration, 1) if self.duration else 0.0,
+            "queries_per_request": round(self.queries / count, 2) if count else 0.0,
+        }
+
+
+def percentile(ordered: list[float], p: float) -> float:
+    if not ordered:
+        return 0.0
+    # Ближайший ранг: без интерполяции, как в большинстве нагрузочных инструментов
+    rank = max(0, min(len(ordered) - 1, round(p / 100 * len(ordered) + 0.5) - 1))
+    return ordered[rank]
+
+
+def print_table(report: dict):
+    header = f"{'scenario':<22}{'count':>8}{'err':>6}{'p50 ms':>10}{'p99 ms':>10}{'rps':>10}{'q/req':>8}"
+    print(header)
+    print("-" * len(header))
+    for name, s in report["scenarios"].items():
+        print(
+            f"{name:<22}{s['count']:>8}{s['errors']:>6}{s['p50_ms']:>10}{s['p99_ms']:>10}"
+            f"{s['throughput_rps']:>10}{s['queries_per_request']:>8}"
+        )
+
+
+def compare(
+    report: dict, baseline: dict, latency_tolerance: float, query_tolerance: float
+) -> tuple[list[str], list[str]]:
+    """Отличия от baseline: (регрессии по ошибкам и числу запросов, ухудшения задержек).
+    Число запросов почти детерминировано и не зависит от машины — проверяется с абсолютным
+    допуском; задержки и пропускная способность зависят от машины и шумят, поэтому
+    возвращаются отдельно — вызывающий решает, считать ли их регрессией."""
+    problems, latency = [], []
+    for name, base in baseline["scenarios"].items():
+        current = report["scenarios"].get(name)
+        if current is None:
+            problems.append(f"{name}: сценарий отсутствует в текущем прогоне")
+            continue
+        if current["errors"] > base["errors"]:
+            problems.append(f"{name}: ошибок {current['errors']} (baseline {base['errors']})")
+        if current["queries_per_request"] > base["queries_per_request"] + query_tolerance:
+            problems.append(
+                f"{name}: запросов на операцию {current['queries_per_request']} (baseline {base['queries_per_request']})"
+            )
+        # p99 по паре сотен замеров слишком шумный для автоматической проверки — сравниваем p50
+        if base["p50_ms"] and current["p50_ms"] > base["p50_ms"] * (1 + latency_tolerance):
+            latency.append(f"{name}: p50 {current['p50_ms']} мс (baseline {base['p50_ms']} мс)")
+        if base["throughput_rps"] and current["throughput_rps"] < base["throughput_rps"] / (1 + latency_tolerance):
+            latency.append(
+                f"{name}: пропускная способность {current['throughput_rps']}/с (baseline {base['throughput_rps']}/с)"
+            )
+    return problems, latency
+
+
+def load(path: str) -> dict:
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save(report: dict, path: str):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+        f.write("\n")
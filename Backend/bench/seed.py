@@ -0,0 +1,70 @@
+"""Наполнение базы для бенчмарка: N пользователей и M сообщений.
+
+У каждого пользователя PARTNERS собеседников, сообщения распределены по этим парам
+случайно, но воспроизводимо (фиксированный seed), часть — ответы и непрочитанные.
+Пишется пачками через INSERT executemany, диалоги пересобираются одним
+conversations.rebuild — так же, как для существующей базы.
+"""
+import random
+
+from sqlalchemy import func, insert, select
+
+import conversations
+import hashing
+import models
+from database import SessionLocal
+
+PASSWORD = "bench-password"
+PARTNERS = 10
+CHUNK = 5000
+
+WORDS = (
+    "привет как дела встреча завтра проект отчёт сервер база данных сообщение "
+    "hello meeting tomorrow report deploy release search index latency cache "
+    "фото документ ссылка вечером утром спасибо отлично договорились"
+).split()
+
+
+def email(i: int) -> str:
+    return f"bench{i}@bench.example.com"
+
+
+def seed(users: int, messages: int, seed_value: int = 42) -> dict[int, list[int]]:
+    """Возвращает {id пользователя: id его собеседников} в порядке bench0, bench1, ..."""
+    rng = random.Random(seed_value)
+    # Хэш один на всех: argon2 на каждого пользователя занял бы минуты
+    hashed = hashing.pwd_context.hash(PASSWORD)
+
+    with SessionLocal() as db:
+        db.execute(insert(models.User), [
+            {"username": f"bench{i}", "email": email(i), "hashed_password": hashed}
+            for i in range(users)
+        ])
+        db.commit()
+        user_ids = list(db.scalars(
+            select(models.User.id).where(models.User.email.like("bench%@bench.example.com")).order_by(models.User.id)
+        ))
+
+        partners = {
+            uid: rng.sample([other for other in user_ids if other != uid], min(PARTNERS, len(user_ids) - 1))
+            for uid in user_ids
+        }
+        first_id = (db.scalar(select(func.max(models.Message.id))) or 0) + 1
+        for start in range(0, messages, CHUNK):
+            rows = []
+            for n in range(start, min(start + CHUNK, messages)):
+                sender = rng.choice(user_ids)
+                rows.append({
+                    "sender_id": sender,
+                    "recipient_id": rng.choice(partners[sender]),
+                    "content": " ".join(rng.choices(WORDS, k=rng.randint(3, 12))),
+                    "is_read": rng.random() < 0.8,
+                    "is_encrypted": False,
+                    # Ответы ссылаются только на уже вставленные сообщения
+                    "reply_to_id": rng.randint(first_id, first_id + n - 1) if n and rng.random() < 0.1 else None,
+                })
+            db.execute(insert(models.Message), rows)
+            db.commit()
+
+        conversations.rebuild(db)
+    return partners
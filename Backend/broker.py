@@ -0,0 +1,262 @@
+"""Брокер для доставки событий между процессами (воркерами uvicorn) и учёта присутствия.
+
+Каждый воркер держит только свои сокеты (ConnectionManager). Событие для пользователя
+публикуется в брокер, и все воркеры доставляют его своим локальным сокетам.
+
+Бэкенд выбирается переменной окружения BROKER_URL:
+  - не задана или memory://  — InMemoryBroker, один процесс (разработка, тесты);
+  - redis://host:6379/0       — RedisBroker.
+
+Присутствие в Redis учитывается по воркерам: у каждого воркера есть множество его
+пользователей и ключ-пульс с TTL (PRESENCE_TTL_SECONDS), который он продлевает.
+Воркер, упавший без stop(), перестаёт продлевать пульс; любой живой воркер при
+следующем пульсе снимает его пользователей со счётчиков, и они уходят в офлайн.
+При обрыве соединения с Redis подписка восстанавливается с экспоненциальной
+задержкой; события, опубликованные за время обрыва, теряются (клиенты добирают их через sync).
+"""
+import asyncio
+import json
+import logging
+import os
+import uuid
+from collections import Counter
+from typing import Awaitable, Callable
+
+logger = logging.getLogger(__name__)
+
+# handler(user_id, message): user_id=None означает "всем локальным сокетам"
+DeliveryHandler = Callable[[int | None, dict], Awaitable[None]]
+# handler(user_id): пользователь ушёл в офлайн, потому что пропал воркер, где он был подключен
+ExpiredHandler = Callable[[int], Awaitable[None]]
+
+PRESENCE_TTL_SECONDS = float(os.getenv("PRESENCE_TTL_SECONDS", "30"))
+RECONNECT_MIN_DELAY = 0.5
+RECONNECT_MAX_DELAY = 30.0
+
+
+class Broker:
+    """Интерфейс брокера. Присутствие считается по воркерам: пользователь онлайн,
+    пока хотя бы у одного воркера есть его сокет."""
+
+    on_presence_expired: ExpiredHandler | None = None
+
+    async def start(self, handler: DeliveryHandler):
+        raise NotImplementedError
+
+    async def stop(self):
+        pass
+
+    async def publish(self, user_id: int | None, message: dict):
+        raise NotImplementedError
+
+    async def presence_join(self, user_id: int) -> bool:
+        """Воркер получил первый сокет пользователя. True — пользователь стал онлайн глобально."""
+        raise NotImplementedError
+
+    async def presence_leave(self, user_id: int) -> bool:
+        """Воркер потерял последний сокет пользователя. True — пользователь ушёл в офлайн глобально."""
+        raise NotImplementedError
+
+    async def online_users(self, user_ids: list[int]) -> set[int]:
+        raise NotImplementedError
+
+
+class InMemoryBroker(Broker):
+    def __init__(self):
+        self._handler: DeliveryHandler | None = None
+        self._presence: Counter[int] = Counter()
+
+    async def start(self, handler: DeliveryHandler):
+        self._handler = handler
+
+    async def publish(self, user_id: int | None, message: dict):
+        if self._handler is not None:
+            await self._handler(user_id, message)
+
+    async def presence_join(self, user_id: int) -> bool:
+        self._presence[user_id] += 1
+        return self._presence[user_id] == 1
+
+    async def presence_leave(self, user_id: int) -> bool:
+        if self._presence[user_id] <= 1:
+            self._presence.pop(user_id, None)
+            return True
+        self._presence[user_id] -= 1
+        return False
+
+    async def online_users(self, user_ids: list[int]) -> set[int]:
+        return {uid for uid in user_ids if self._presence.get(uid)}
+
+
+class RedisBroker(Broker):
+    CHANNEL = "messenger:events"
+    # user_id -> число воркеров, где пользователь подключен
+    PRESENCE_KEY = "messenger:presence"
+    WORKERS_KEY = "messenger:presence:workers"
+    PREFIX = "messenger:presence:"
+
+    # Все скрипты атомарны: пульс, вход/выход и уборка за мёртвыми воркерами не перемежаются
+    _JOIN = """
+    if redis.call('SADD', KEYS[1], ARGV[1]) == 0 then return 0 end
+    return redis.call('HINCRBY', KEYS[2], ARGV[1], 1)
+    """
+    _LEAVE = """
+    if redis.call('SREM', KEYS[1], ARGV[1]) == 0 then return -1 end
+    local remaining = redis.call('HINCRBY', KEYS[2], ARGV[1], -1)
+    if remaining <= 0 then
+        redis.call('HDEL', KEYS[2], ARGV[1])
+        return 0
+    end
+    return remaining
+    """
+    # Возвращает пользователей, ушедших в офлайн вместе с мёртвыми воркерами
+    _REAP = """
+    local offline = {}
+    for _, worker in ipairs(redis.call('SMEMBERS', KEYS[1])) do
+        if redis.call('EXISTS', ARGV[1] .. 'alive:' .. worker) == 0 then
+            local users_key = ARGV[1] .. 'users:' .. worker
+            for _, uid in ipairs(redis.call('SMEMBERS', users_key)) do
+                if redis.call('HINCRBY', KEYS[2], uid, -1) <= 0 then
+                    redis.call('HDEL', KEYS[2], uid)
+                    table.insert(offline, uid)
+                end
+            end
+            redis.call('DEL', users_key)
+            redis.call('SREM', KEYS[1], worker)
+        end
+    end
+    return offline
+    """
+
+    def __init__(self, url: str, presence_ttl: float = PRESENCE_TTL_SECONDS):
+        try:
+            import redis.asyncio as redis
+        except ImportError as exc:
+            raise RuntimeError("BROKER_URL указывает на Redis, но пакет redis не установлен") from exc
+        self._redis = redis.from_url(url, decode_responses=True)
+        self._pubsub = None
+        self._listener: asyncio.Task | None = None
+        self._heartbeat: asyncio.Task | None = None
+        self._handler: DeliveryHandler | None = None
+        self.presence_ttl = presence_ttl
+        # Пользователи, которых этот воркер учёл в PRESENCE_KEY (снимаем при остановке)
+        self._local_presence: set[int] = set()
+        self.worker_id = uuid.uuid4().hex
+        self._alive_key = f"{self.PREFIX}alive:{self.worker_id}"
+        self._users_key = f"{self.PREFIX}users:{self.worker_id}"
+        self._join = self._redis.register_script(self._JOIN)
+        self._leave = self._redis.register_script(self._LEAVE)
+        self._reap = self._redis.register_script(self._REAP)
+
+    async def start(self, handler: DeliveryHandler):
+        self._handler = handler
+        await self._beat()
+        await self._subscribe()
+        self._listener = asyncio.create_task(self._listen())
+        self._heartbeat = asyncio.create_task(self._heartbeat_loop())
+
+    async def stop(self):
+        for task in (self._listener, self._heartbeat):
+            if task:
+                task.cancel()
+        await self._close_pubsub()
+        # Корректное завершение воркера не должно оставлять "вечно онлайн" пользователей
+        for user_id in list(self._local_presence):
+            await self.presence_leave(user_id)
+        await self._redis.delete(self._alive_key, self._users_key)
+        await self._redis.srem(self.WORKERS_KEY, self.worker_id)
+        await self._redis.aclose()
+
+    async def _subscribe(self):
+        self._pubsub = self._redis.pubsub()
+        await self._pubsub.subscribe(self.CHANNEL)
+
+    async def _close_pubsub(self):
+        pubsub, self._pubsub = self._pubsub, None
+        if pubsub is None:
+            return
+        try:
+            await pubsub.aclose()
+        except Exception:
+            pass
+
+    async def _listen(self):
+        delay = RECONNECT_MIN_DELAY
+        while True:
+            try:
+                if self._pubsub is None:
+                    await self._subscribe()
+                    logger.info("Подписка на %s восстановлена", self.CHANNEL)
+                    delay = RECONNECT_MIN_DELAY
+                async for item in self._pubsub.listen():
+                    if item.get("type") != "message":
+                        continue
+                    try:
+                        envelope = json.loads(item["data"])
+                        await self._handler(envelope.get("user_id"), envelope["message"])
+                    except Exception:
+                        logger.exception("Не удалось доставить событие из брокера")
+                # listen() завершается без ошибки, если соединение подписки сброшено
+                raise ConnectionError("подписка на канал закрыта")
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.warning("Потеряно соединение с Redis, переподключение через %.1f с", delay, exc_info=True)
+                await self._close_pubsub()
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, RECONNECT_MAX_DELAY)
+
+    async def _beat(self):
+        """Продлевает пульс воркера. Если воркер уже убрали как мёртвого (Redis был
+        недоступен дольше TTL), заново учитывает его пользователей."""
+        await self._redis.set(self._alive_key, 1, px=int(self.presence_ttl * 1000))
+        if await self._redis.sadd(self.WORKERS_KEY, self.worker_id) and self._local_presence:
+            logger.warning("Воркер %s считался мёртвым, присутствие восстановлено", self.worker_id)
+            for user_id in list(self._local_presence):
+                await self._join(keys=[self._users_key, self.PRESENCE_KEY], args=[user_id])
+
+    async def _heartbeat_loop(self):
+        while True:
+            await asyncio.sleep(self.presence_ttl / 3)
+            try:
+                await self._beat()
+                offline = await self._reap(keys=[self.WORKERS_KEY, self.PRESENCE_KEY], args=[self.PREFIX])
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.warning("Не удалось обновить присутствие в Redis", exc_info=True)
+                continue
+            for user_id in offline:
+                if self.on_presence_expired is not None:
+                    try:
+                        await self.on_presence_expired(int(user_id))
+                    except Exception:
+                        logger.exception("Не удалось разослать офлайн-статус user_id=%s", user_id)
+
+    async def publish(self, user_id: int | None, message: dict):
+        envelope = json.dumps({"user_id": user_id, "message": message}, default=str)
+        await self._redis.publish(self.CHANNEL, envelope)
+
+    async def presence_join(self, user_id: int) -> bool:
+        self._local_presence.add(user_id)
+        return await self._join(keys=[self._users_key, self.PRESENCE_KEY], args=[user_id]) == 1
+
+    async def presence_leave(self, user_id: int) -> bool:
+        self._local_presence.discard(user_id)
+        # -1 — пользователя у этого воркера уже нет (воркер убран как мёртвый, офлайн уже разослан)
+        return await self._leave(keys=[self._users_key, self.PRESENCE_KEY], args=[user_id]) == 0
+
+    async def online_users(self, user_ids: list[int]) -> set[int]:
+        if not user_ids:
+            return set()
+        counts = await self._redis.hmget(self.PRESENCE_KEY, user_ids)
+        return {uid for uid, count in zip(user_ids, counts) if count and int(count) > 0}
+
+
+def create_broker(url: str | None = None) -> Broker:
+    url = url if url is not None else os.getenv("BROKER_URL", "memory://")
+    if url.startswith("redis://") or url.startswith("rediss://"):
+        return RedisBroker(url)
+    if url in ("", "memory://"):
+        return InMemoryBroker()
+    raise ValueError(f"Неизвестный BROKER_URL: {url}")
@@ -0,0 +1,136 @@
+"""Склейка частых WebSocket-событий: индикатор набора и отметки о прочтении.
+
+typing: клиенты шлют событие на каждое нажатие клавиши; собеседнику пересылается
+не чаще одного события в TYPING_THROTTLE_SECONDS для пары (отправитель, получатель).
+
+read_messages: вместо UPDATE + commit на каждый кадр запоминается "прочитано до
+сообщения N" для пары (читатель, отправитель). Раз в READ_FLUSH_INTERVAL_SECONDS все
+накопленные отметки записываются одним UPDATE и одним commit, после чего отправители
+получают messages_read с up_to_id. Если запись не удалась, отметки возвращаются
+в накопитель и уходят со следующим сбросом.
+"""
+import asyncio
+import logging
+import os
+import time
+
+from sqlalchemy import and_, or_, update
+
+import conversations
+import events
+import instrumentation
+import models
+import response_cache
+
+logger = logging.getLogger(__name__)
+
+TYPING_THROTTLE_SECONDS = float(os.getenv("TYPING_THROTTLE_SECONDS", "2"))
+READ_FLUSH_INTERVAL_SECONDS = float(os.getenv("READ_FLUSH_INTERVAL_SECONDS", "0.25"))
+# Сколько пар (читатель, отправитель) обновляется одним UPDATE
+READ_FLUSH_BATCH = 200
+
+
+class Coalescer:
+    def __init__(self, manager, session_factory):
+        self.manager = manager
+        self.session_factory = session_factory
+        self._typing_sent: dict[tuple[int, int], float] = {}
+        # (reader_id, sender_id) -> максимальный прочитанный id;
+        # None — "прочитано всё" (старые клиенты не присылают up_to_id)
+        self._read_watermarks: dict[tuple[int, int], int | None] = {}
+        self._flusher: asyncio.Task | None = None
+
+    # --- typing ---
+
+    def should_forward_typing(self, sender_id: int, recipient_id: int) -> bool:
+        now = time.monotonic()
+        key = (sender_id, recipient_id)
+        last = self._typing_sent.get(key)
+        if last is not None and now - last < TYPING_THROTTLE_SECONDS:
+            return False
+        self._typing_sent[key] = now
+        if len(self._typing_sent) > 10000:
+            # Забываем пары, по которым давно не было событий
+            self._typing_sent = {k: t for k, t in self._typing_sent.items() if now - t < TYPING_THROTTLE_SECONDS}
+        return True
+
+    # --- read receipts ---
+
+    def mark_read(self, reader_id: int, sender_id: int, up_to_id: int | None):
+        key = (reader_id, sender_id)
+        if key not in self._read_watermarks:
+            self._read_watermarks[key] = up_to_id
+            return
+        current = self._read_watermarks[key]
+        if current is not None and (up_to_id is None or up_to_id > current):
+            self._read_watermarks[key] = up_to_id
+
+    async def start(self):
+        self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        if self._flusher:
+            self._flusher.cancel()
+        # Отметки, накопленные к остановке, не теряем
+        await self.flush()
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(READ_FLUSH_INTERVAL_SECONDS)
+            try:
+                if self._read_watermarks:
+                    with instrumentation.track("background", "read_receipts_flush"):
+                        await self.flush()
+            except Exception:
+                logger.exception("Не удалось записать отметки о прочтении")
+
+    async def flush(self):
+        if not self._read_watermarks:
+            return
+        pending, self._read_watermarks = self._read_watermarks, {}
+        try:
+            frames, seqs = await self._write(pending)
+        except BaseException:
+            # Отметки, пришедшие за время записи, объединяются с возвращёнными (по максимуму)
+            for (reader_id, sender_id), up_to_id in pending.items():
+                self.mark_read(reader_id, sender_id, up_to_id)
+            raise
+        await response_cache.invalidate_reads(pending)
+
+        await asyncio.gather(*(
+            self.manager.send_personal_message({**frame, "seq": seq}, sender_id)
+            for (sender_id, frame), seq in zip(frames, seqs)
+        ))
+
+    async def _write(self, pending: dict[tuple[int, int], int | None]):
+        items = list(pending.items())
+        async with self.session_factory() as db:
+            for start in range(0, len(items), READ_FLUSH_BATCH):
+                batch = items[start:start + READ_FLUSH_BATCH]
+                await db.execute(
+                    update(models.Message)
+                    .where(
+                        models.Message.is_read == False,
+                        or_(*(
+                            and_(
+                                models.Message.sender_id == sender_id,
+                                models.Message.recipient_id == reader_id,
+                                # Без up_to_id условия на id нет: прочитано всё
+                                *([models.Message.id <= up_to_id] if up_to_id is not None else []),
+                            )
+                            for (reader_id, sender_id), up_to_id in batch
+                        )),
+                    )
+                    .values(is_read=True)
+                    .execution_options(synchronize_session=False)
+                )
+                for (reader_id, sender_id), _ in batch:
+                    await db.run_sync(conversations.on_messages_read, reader_id, sender_id)
+
+            frames = [
+                (sender_id, {"type": "messages_read", "user_id": reader_id, "up_to_id": up_to_id})
+                for (reader_id, sender_id), up_to_id in items
+            ]
+            seqs = await db.run_sync(events.record, frames)
+            await db.commit()
+        return frames, seqs
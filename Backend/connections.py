@@ -0,0 +1,191 @@
+import asyncio
+import logging
+import os
+
+from fastapi import WebSocket, status
+
+import wire
+from broker import Broker
+
+logger = logging.getLogger(__name__)
+
+# Размер очереди исходящих кадров на один сокет
+SEND_QUEUE_SIZE = int(os.getenv("WS_SEND_QUEUE_SIZE", "256"))
+# Что делать с клиентом, который не успевает читать (очередь заполнена):
+#   disconnect  — закрыть сокет (клиент переподключится);
+#   drop_oldest — выбросить самый старый кадр из очереди;
+#   drop_new    — выбросить новый кадр.
+SLOW_CONSUMER_POLICY = os.getenv("WS_SLOW_CONSUMER_POLICY", "disconnect")
+
+
+class ClientConnection:
+    """Сокет + ограниченная очередь исходящих кадров + задача-писатель.
+
+    Отправка не ждёт сокет: кадр кладётся в очередь, а писатель отдаёт их по одному.
+    Медленный клиент задерживает только свою очередь, а не доставку остальным.
+    В очереди лежат уже закодированные кадры (str для JSON, bytes для MessagePack).
+    """
+
+    def __init__(self, websocket: WebSocket, user_id: int, protocol: str = wire.JSON, queue_size: int = SEND_QUEUE_SIZE):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.protocol = protocol
+        self.queue: asyncio.Queue[str | bytes] = asyncio.Queue(maxsize=queue_size)
+        self.writer: asyncio.Task | None = None
+        self.sent = 0
+        self.dropped = 0
+        self.closed = False
+        # Взводится писателем, когда в очереди освободилось место (и при закрытии)
+        self.space_available = asyncio.Event()
+
+    def start(self):
+        self.writer = asyncio.create_task(self._write_loop())
+
+    async def _write_loop(self):
+        while True:
+            frame = await self.queue.get()
+            self.space_available.set()
+            try:
+                await wire.send(self.websocket, frame)
+                self.sent += 1
+            except Exception:
+                # Сокет уже закрыт — цикл чтения в /ws сам выполнит disconnect
+                self.space_available.set()
+                return
+
+    def enqueue(self, frame: str | bytes) -> bool:
+        try:
+            self.queue.put_nowait(frame)
+            return True
+        except asyncio.QueueFull:
+            return False
+
+    async def close(self):
+        self.closed = True
+        if self.writer:
+            self.writer.cancel()
+        self.space_available.set()
+
+
+class ConnectionManager:
+    """Локальные сокеты этого процесса. Доставка и присутствие идут через брокер,
+    поэтому сообщение дойдёт до пользователя, подключенного к другому воркеру."""
+
+    def __init__(self, broker: Broker, slow_consumer_policy: str = SLOW_CONSUMER_POLICY):
+        if slow_consumer_policy not in ("disconnect", "drop_oldest", "drop_new"):
+            raise ValueError(f"Неизвестная политика для медленных клиентов: {slow_consumer_policy}")
+        self.active_connections: dict[int, list[ClientConnection]] = {}
+        self.broker = broker
+        self.slow_consumer_policy = slow_consumer_policy
+        # Счётчики за время жизни процесса (см. /metrics)
+        self.frames_dropped = 0
+        self.slow_consumers_disconnected = 0
+        self._sent_by_closed = 0
+
+    async def start(self):
+        await self.broker.start(self._deliver_local)
+
+    async def stop(self):
+        await self.broker.stop()
+
+    async def connect(self, websocket: WebSocket, user_id: int) -> tuple[ClientConnection, bool]:
+        """Возвращает соединение и True, если это первый сокет пользователя в этом процессе.
+        Учёт присутствия в брокере и рассылку статуса ведёт PresenceService."""
+        protocol, subprotocol = wire.negotiate(websocket)
+        await websocket.accept(subprotocol=subprotocol)
+        connection = ClientConnection(websocket, user_id, protocol)
+        connection.start()
+        first_local = user_id not in self.active_connections
+        if first_local:
+            self.active_connections[user_id] = []
+        self.active_connections[user_id].append(connection)
+        return connection, first_local
+
+    async def disconnect(self, websocket: WebSocket, user_id: int):
+        """Возвращает True, если у пользователя не осталось сокетов в этом процессе."""
+        if user_id in self.active_connections:
+            for connection in list(self.active_connections[user_id]):
+                if connection.websocket is websocket:
+                    self.active_connections[user_id].remove(connection)
+                    self._sent_by_closed += connection.sent
+                    await connection.close()
+            if not self.active_connections[user_id]:
+                del self.active_connections[user_id]
+                return True
+        return False
+
+    async def online_users(self, user_ids: list[int]) -> set[int]:
+        return await self.broker.online_users(user_ids)
+
+    async def send_personal_message(self, message: dict, user_id: int):
+        await self.broker.publish(user_id, message)
+
+    async def send_to_socket(self, websocket: WebSocket, user_id: int, message: dict):
+        """Кадр одному сокету (ответ на его же запрос, например пачки sync).
+        В отличие от рассылки, ждёт места в очереди, а не выбрасывает кадр."""
+        for connection in self.active_connections.get(user_id, []):
+            if connection.websocket is not websocket:
+                continue
+            frame = wire.encode(message, connection.protocol)
+            # Писатель завершается, если сокет закрыт, — тогда место в очереди уже не появится
+            while not connection.closed and not connection.writer.done():
+                if connection.enqueue(frame):
+                    return
+                connection.space_available.clear()
+                await connection.space_available.wait()
+            return
+
+    async def _deliver_local(self, user_id: int | None, message: dict):
+        # Вызывается брокером в каждом воркере; user_id=None — всем локальным сокетам
+        if user_id is None:
+            targets = [conn for conns in list(self.active_connections.values()) for conn in conns]
+        else:
+            targets = list(self.active_connections.get(user_id, []))
+
+        # Кадр кодируется один раз на формат, а не на каждый сокет
+        frames: dict[str, str | bytes] = {}
+        overflowed = []
+        for conn in targets:
+            if conn.closed:
+                continue
+            if conn.protocol not in frames:
+                frames[conn.protocol] = wire.encode(message, conn.protocol)
+            if not conn.enqueue(frames[conn.protocol]):
+                overflowed.append(conn)
+        if overflowed:
+            await asyncio.gather(*(self._handle_slow_consumer(conn, frames[conn.protocol]) for conn in overflowed))
+
+    async def _handle_slow_consumer(self, connection: ClientConnection, frame: str | bytes):
+        if self.slow_consumer_policy == "drop_oldest":
+            try:
+                connection.queue.get_nowait()
+            except asyncio.QueueEmpty:
+                pass
+            connection.enqueue(frame)
+            connection.dropped += 1
+            self.frames_dropped += 1
+        elif self.slow_consumer_policy == "drop_new":
+            connection.dropped += 1
+            self.frames_dropped += 1
+        else:
+            self.frames_dropped += connection.queue.qsize() + 1
+            self.slow_consumers_disconnected += 1
+            logger.warning("Медленный клиент user_id=%s отключён: очередь отправки переполнена", connection.user_id)
+            await connection.close()
+            try:
+                await connection.websocket.close(code=status.WS_1013_TRY_AGAIN_LATER)
+            except RuntimeError:
+                pass
+
+    def metrics(self) -> dict:
+        connections = [conn for conns in self.active_connections.values() for conn in conns]
+        depths = [conn.queue.qsize() for conn in connections]
+        return {
+            "connections": len(connections),
+            "users": len(self.active_connections),
+            "queue_depth_total": sum(depths),
+            "queue_depth_max": max(depths, default=0),
+            "frames_sent": self._sent_by_closed + sum(conn.sent for conn in connections),
+            "frames_dropped": self.frames_dropped,
+            "slow_consumers_disconnected": self.slow_consumers_disconnected,
+        }
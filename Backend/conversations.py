@@ -0,0 +1,131 @@
+"""Поддержка денормализованной таблицы conversations.
+
+Все функции работают в транзакции вызывающего кода и не делают commit сами:
+запись сообщения и обновление диалога фиксируются одним commit.
+"""
+from sqlalchemy import and_, case, func, insert, or_, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+
+import models
+
+
+def canonical_pair(a: int, b: int) -> tuple[int, int]:
+    return (a, b) if a <= b else (b, a)
+
+
+def _unread_column(conv: models.Conversation, user_id: int):
+    return models.Conversation.unread_low if user_id == conv.user_low_id else models.Conversation.unread_high
+
+
+def on_messages_created(db: Session, msgs):
+    """Новые сообщения пачки: один INSERT ... ON CONFLICT DO UPDATE на все её диалоги.
+    msgs — объекты с полями id, sender_id, recipient_id, is_read (модели или строки RETURNING)."""
+    by_pair: dict[tuple[int, int], dict] = {}
+    for msg in msgs:
+        low, high = canonical_pair(msg.sender_id, msg.recipient_id)
+        row = by_pair.setdefault((low, high), {
+            "user_low_id": low, "user_high_id": high, "last_message_id": msg.id, "unread_low": 0, "unread_high": 0,
+        })
+        row["last_message_id"] = max(row["last_message_id"], msg.id)
+        if msg.sender_id != msg.recipient_id and not msg.is_read:
+            row["unread_low" if msg.recipient_id == low else "unread_high"] += 1
+    if not by_pair:
+        return
+
+    upsert = pg_insert if db.get_bind().dialect.name == "postgresql" else sqlite_insert
+    # Пары по порядку: параллельные транзакции блокируют строки диалогов в одном порядке
+    stmt = upsert(models.Conversation).values([by_pair[pair] for pair in sorted(by_pair)])
+    conv = models.Conversation
+    db.execute(stmt.on_conflict_do_update(
+        index_elements=[conv.user_low_id, conv.user_high_id],
+        set_={
+            # Только вперёд: пачка, зафиксированная позже, может нести меньшие id
+            "last_message_id": case(
+                (conv.last_message_id > stmt.excluded.last_message_id, conv.last_message_id),
+                else_=stmt.excluded.last_message_id,
+            ),
+            "last_activity": func.now(),
+            # Атомарный инкремент на стороне БД, без гонок между сокетами
+            "unread_low": conv.unread_low + stmt.excluded.unread_low,
+            "unread_high": conv.unread_high + stmt.excluded.unread_high,
+        },
+    ))
+
+
+def on_message_deleted(db: Session, msg: models.Message):
+    """Вызывается ДО удаления сообщения: переносит last_message_id и поправляет счётчики."""
+    low, high = canonical_pair(msg.sender_id, msg.recipient_id)
+    conv = db.query(models.Conversation).filter(
+        models.Conversation.user_low_id == low,
+        models.Conversation.user_high_id == high,
+    ).first()
+    if not conv:
+        return None
+
+    if conv.last_message_id == msg.id:
+        previous = db.query(models.Message).filter(
+            or_(
+                and_(models.Message.sender_id == msg.sender_id, models.Message.recipient_id == msg.recipient_id),
+                and_(models.Message.sender_id == msg.recipient_id, models.Message.recipient_id == msg.sender_id),
+            ),
+            models.Message.id < msg.id,
+        ).order_by(models.Message.id.desc()).first()
+        conv.last_message_id = previous.id if previous else None
+        if previous:
+            conv.last_activity = previous.timestamp
+
+    if msg.sender_id != msg.recipient_id and not msg.is_read:
+        column = _unread_column(conv, msg.recipient_id)
+        setattr(conv, column.key, case((column > 0, column - 1), else_=0))
+    db.flush()
+    return conv
+
+
+def on_messages_read(db: Session, reader_id: int, sender_id: int):
+    """Сообщения sender -> reader отмечены прочитанными (все или до какого-то id):
+    счётчик стороны читателя пересчитывается по оставшимся непрочитанным."""
+    low, high = canonical_pair(reader_id, sender_id)
+    remaining = select(func.count(models.Message.id)).where(
+        models.Message.sender_id == sender_id,
+        models.Message.recipient_id == reader_id,
+        models.Message.is_read == False,
+    ).scalar_subquery()
+    values = {"unread_low": remaining} if reader_id == low else {"unread_high": remaining}
+    db.query(models.Conversation).filter(
+        models.Conversation.user_low_id == low,
+        models.Conversation.user_high_id == high,
+    ).update(values, synchronize_session=False)
+
+
+def rebuild(db: Session):
+    """Заполняет conversations из messages одним INSERT ... SELECT (для существующих баз)."""
+    m = models.Message
+    low = case((m.sender_id <= m.recipient_id, m.sender_id), else_=m.recipient_id)
+    high = case((m.sender_id <= m.recipient_id, m.recipient_id), else_=m.sender_id)
+    unread = and_(m.is_read == False, m.sender_id != m.recipient_id)
+    source = select(
+        low.label("user_low_id"),
+        high.label("user_high_id"),
+        func.max(m.id).label("last_message_id"),
+        func.max(m.timestamp).label("last_activity"),
+        func.sum(case((and_(unread, m.recipient_id == low), 1), else_=0)).label("unread_low"),
+        func.sum(case((and_(unread, m.recipient_id == high), 1), else_=0)).label("unread_high"),
+    ).group_by(low, high)
+
+    db.query(models.Conversation).delete(synchronize_session=False)
+    db.execute(
+        insert(models.Conversation).from_select(
+            ["user_low_id", "user_high_id", "last_message_id", "last_activity", "unread_low", "unread_high"],
+            source,
+        )
+    )
+    db.commit()
+
+
+def rebuild_if_empty(db: Session):
+    has_conversations = db.query(models.Conversation.id).first() is not None
+    has_messages = db.query(models.Message.id).first() is not None
+    if has_messages and not has_conversations:
+        rebuild(db)
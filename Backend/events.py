@@ -0,0 +1,180 @@
+"""Журнал событий пользователя и догоняющая синхронизация (кадр sync).
+
+Каждый кадр new_message / message_edited / message_deleted / messages_read,
+адресованный пользователю, пишется в user_events в той же транзакции, что и само
+изменение, с номером seq и уходит клиенту с полем "seq". Номера растут строго по
+пользователю: счётчик event_sequences обновляется UPDATE-ом, который держит
+блокировку строки до commit, поэтому транзакции одного пользователя фиксируются в
+порядке своих seq.
+
+Клиент запоминает последний увиденный seq и после переподключения шлёт
+{"type": "sync", "since": N}. В ответ идут пачки sync_batch с событиями seq > N.
+Если события после N уже удалены компактизацией (старше EVENT_RETENTION_DAYS) или
+клиент прислал since=null, приходит sync_reset: состояние нужно загрузить заново через REST.
+
+Текст сообщений в журнал не пишется: у new_message и message_edited (и у цитаты
+reply_to) поле content убирается, а при sync подставляется текущий текст из messages.
+Удалённое или отредактированное сообщение не остаётся в журнале в прежнем виде;
+new_message/message_edited уже удалённого сообщения при sync пропускаются.
+"""
+import asyncio
+import logging
+import os
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import delete, func, insert, select, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+
+import models
+
+logger = logging.getLogger(__name__)
+
+EVENT_RETENTION_DAYS = float(os.getenv("EVENT_RETENTION_DAYS", "30"))
+EVENT_COMPACT_INTERVAL_SECONDS = float(os.getenv("EVENT_COMPACT_INTERVAL_SECONDS", "3600"))
+SYNC_BATCH_SIZE = int(os.getenv("SYNC_BATCH_SIZE", "500"))
+
+
+def _allocate(db: Session, counts: dict[int, int]) -> dict[int, int]:
+    """Резервирует номера подряд сразу для всех пользователей ({user_id: сколько})
+    одним upsert; возвращает первый номер каждого."""
+    upsert = pg_insert if db.get_bind().dialect.name == "postgresql" else sqlite_insert
+    # Счётчики блокируются в порядке строк VALUES, то есть по user_id — параллельные
+    # транзакции не встанут в deadlock
+    stmt = upsert(models.EventSequence).values([
+        {"user_id": user_id, "last_seq": counts[user_id], "floor_seq": 0} for user_id in sorted(counts)
+    ])
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[models.EventSequence.user_id],
+        set_={"last_seq": models.EventSequence.last_seq + stmt.excluded.last_seq},
+    ).returning(models.EventSequence.user_id, models.EventSequence.last_seq)
+    return {user_id: last_seq - counts[user_id] + 1 for user_id, last_seq in db.execute(stmt)}
+
+
+def _redact(payload: dict) -> dict:
+    stored = {key: value for key, value in payload.items() if key != "content"}
+    if stored.get("reply_to"):
+        stored["reply_to"] = {key: value for key, value in stored["reply_to"].items() if key != "content"}
+    return stored
+
+
+def record(db: Session, events: list[tuple[int, dict]]) -> list[int]:
+    """Записывает события [(user_id, кадр), ...] в транзакции вызывающего кода.
+    Возвращает seq для каждого события в том же порядке."""
+    if not events:
+        return []
+    next_seq = _allocate(db, Counter(user_id for user_id, _ in events))
+
+    seqs = []
+    for user_id, _ in events:
+        seqs.append(next_seq[user_id])
+        next_seq[user_id] += 1
+    db.execute(
+        insert(models.UserEvent),
+        [
+            {"user_id": user_id, "seq": seq, "payload": _redact(payload)}
+            for (user_id, payload), seq in zip(events, seqs)
+        ],
+    )
+    return seqs
+
+
+def compact(db: Session, retention_days: float = EVENT_RETENTION_DAYS) -> int:
+    """Удаляет события старше срока хранения и поднимает floor_seq. Возвращает число удалённых."""
+    cutoff = datetime.now(timezone.utc) - timedelta(days=retention_days)
+    floors = db.execute(
+        select(models.UserEvent.user_id, func.max(models.UserEvent.seq))
+        .where(models.UserEvent.created_at < cutoff)
+        .group_by(models.UserEvent.user_id)
+    ).all()
+    for user_id, floor_seq in floors:
+        db.execute(
+            update(models.EventSequence)
+            .where(models.EventSequence.user_id == user_id, models.EventSequence.floor_seq < floor_seq)
+            .values(floor_seq=floor_seq)
+        )
+    result = db.execute(delete(models.UserEvent).where(models.UserEvent.created_at < cutoff))
+    return result.rowcount
+
+
+class EventLog:
+    def __init__(self, session_factory):
+        self.session_factory = session_factory
+        self._compactor: asyncio.Task | None = None
+
+    async def start(self):
+        self._compactor = asyncio.create_task(self._compact_loop())
+
+    async def stop(self):
+        if self._compactor:
+            self._compactor.cancel()
+
+    async def _compact_loop(self):
+        while True:
+            try:
+                async with self.session_factory() as db:
+                    removed = await db.run_sync(compact)
+                    await db.commit()
+                if removed:
+                    logger.info("Журнал событий: удалено %s событий старше %s дн.", removed, EVENT_RETENTION_DAYS)
+            except Exception:
+                logger.exception("Не удалось компактизировать журнал событий")
+            await asyncio.sleep(EVENT_COMPACT_INTERVAL_SECONDS)
+
+    async def sync(self, user_id: int, since: int | None, send):
+        """Отправляет через send(кадр) все события пользователя с seq > since пачками.
+        Сессия берётся на каждую пачку и возвращается в пул до отправки."""
+        async with self.session_factory() as db:
+            state = await db.get(models.EventSequence, user_id)
+            last_seq = state.last_seq if state else 0
+            floor_seq = state.floor_seq if state else 0
+        if since is None or since < floor_seq or since > last_seq:
+            await send({"type": "sync_reset", "last_seq": last_seq})
+            return
+
+        while True:
+            async with self.session_factory() as db:
+                rows = (await db.execute(
+                    select(models.UserEvent.seq, models.UserEvent.payload)
+                    .where(models.UserEvent.user_id == user_id, models.UserEvent.seq > since)
+                    .order_by(models.UserEvent.seq)
+                    .limit(SYNC_BATCH_SIZE)
+                )).all()
+                batch = await self._with_content(db, rows)
+            if rows:
+                since = rows[-1].seq
+            done = len(rows) < SYNC_BATCH_SIZE
+            await send({
+                "type": "sync_batch",
+                "events": batch,
+                "last_seq": since,
+                "done": done,
+            })
+            if done:
+                return
+
+    async def _with_content(self, db, rows) -> list[dict]:
+        """Подставляет текущий текст сообщений (и цитат) одним запросом на пачку."""
+        ids = set()
+        for _, payload in rows:
+            if payload.get("type") in ("new_message", "message_edited"):
+                ids.add(payload["id"])
+                if payload.get("reply_to"):
+                    ids.add(payload["reply_to"]["id"])
+        contents = dict((await db.execute(
+            select(models.Message.id, models.Message.content).where(models.Message.id.in_(ids))
+        )).all()) if ids else {}
+
+        batch = []
+        for seq, payload in rows:
+            if payload.get("type") in ("new_message", "message_edited"):
+                if payload["id"] not in contents:
+                    continue
+                payload = {**payload, "content": contents[payload["id"]]}
+                reply = payload.get("reply_to")
+                if reply:
+                    payload["reply_to"] = {**reply, "content": contents[reply["id"]]} if reply["id"] in contents else None
+            batch.append({**payload, "seq": seq})
+        return batch
@@ -0,0 +1,368 @@
+"""Экспорт и импорт переписки в формате NDJSON (по JSON-объекту на строку).
+
+Экспорт отдаётся потоком (по желанию через gzip), импорт проверяет файл целиком
+и пишет его пачками по IMPORT_BATCH_SIZE, каждая своим commit. Импортируются только
+сообщения автора экспорта; пропущенные строки считаются по причинам (SKIP_REASONS).
+Формат файла — в README.md, раздел «Экспорт и импорт».
+"""
+import gzip
+import io
+import json
+import os
+import zlib
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+from pydantic import ValidationError
+from sqlalchemy import and_, case, func, insert, or_, select, update
+from sqlalchemy.orm import Session
+
+import conversations
+import models
+import partitions
+import schemas
+
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "1000"))
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", "1000"))
+FORMAT_VERSION = 1
+# Причины пропуска строк при импорте (ImportJob.skipped_by_reason, ImportResult)
+SKIP_REASONS = {
+    "received": "сообщение написано не автором экспорта",
+    "unknown_recipient": "собеседника с таким username нет",
+    "out_of_range": "время в будущем или раньше самой ранней секции messages",
+    "not_newer": "не новее последнего сообщения диалога",
+}
+
+_MESSAGE_COLUMNS = (
+    models.Message.id,
+    models.Message.sender_id,
+    models.Message.recipient_id,
+    models.Message.content,
+    models.Message.is_encrypted,
+    models.Message.is_read,
+    models.Message.timestamp,
+    models.Message.reply_to_id,
+)
+# Допустимое расхождение часов: время сообщения позже now + _CLOCK_SKEW — строка пропускается
+_CLOCK_SKEW = timedelta(minutes=5)
+# Длина цитаты, которая подставляется в текст ответа вместо ссылки на неимпортированное сообщение
+QUOTE_LENGTH = 200
+
+
+def _line(record: dict) -> bytes:
+    return (json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n").encode()
+
+
+def _message_record(row) -> dict:
+    record = {"type": "message", **row._asdict()}
+    record["timestamp"] = row.timestamp.isoformat() if row.timestamp else None
+    return record
+
+
+# --- экспорт ---
+
+async def export_lines(session_factory, owner_id: int, contact_id: int | None = None):
+    """Асинхронный генератор кусков NDJSON: вся переписка пользователя или диалог с contact_id."""
+    async with session_factory() as db:
+        owner = await db.get(models.User, owner_id)
+        yield _line({
+            "type": "export",
+            "version": FORMAT_VERSION,
+            "exported_at": datetime.now(timezone.utc).isoformat(),
+            "user_id": owner.id,
+            "username": owner.username,
+            "email": owner.email,
+            "phone_number": owner.phone_number,
+            "birth_date": owner.birth_date.isoformat() if owner.birth_date else None,
+            "avatar_url": owner.avatar_url,
+        })
+
+        if contact_id is not None:
+            partner_ids = [contact_id]
+            scope = or_(
+                and_(models.Message.sender_id == owner_id, models.Message.recipient_id == contact_id),
+                and_(models.Message.sender_id == contact_id, models.Message.recipient_id == owner_id),
+            )
+        else:
+            conv = models.Conversation
+            partner_ids = (await db.scalars(
+                select(case((conv.user_low_id == owner_id, conv.user_high_id), else_=conv.user_low_id))
+                .where(or_(conv.user_low_id == owner_id, conv.user_high_id == owner_id))
+            )).all()
+            scope = or_(models.Message.sender_id == owner_id, models.Message.recipient_id == owner_id)
+
+        partners = await db.execute(
+            select(models.User.id, models.User.username).where(models.User.id.in_(partner_ids))
+        )
+        yield b"".join(_line({"type": "user", "id": row.id, "username": row.username}) for row in partners)
+
+        result = await db.stream(
+            select(*_MESSAGE_COLUMNS).where(scope).order_by(models.Message.id)
+            .execution_options(yield_per=EXPORT_BATCH_SIZE)
+        )
+        async for rows in result.partitions():
+            yield b"".join(_line(_message_record(row)) for row in rows)
+
+
+async def gzip_chunks(chunks):
+    # wbits=31 — заголовок и контрольная сумма gzip, а не "голый" deflate
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    async for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+# --- импорт ---
+
+def _records(stream):
+    """Строки файла как dict; gzip распознаётся по сигнатуре. Поток читается с начала."""
+    stream.seek(0)
+    head = stream.read(2)
+    stream.seek(0)
+    raw = gzip.GzipFile(fileobj=stream, mode="rb") if head == b"\x1f\x8b" else stream
+    lines = io.TextIOWrapper(raw, encoding="utf-8")
+    try:
+        for number, line in enumerate(lines, start=1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as exc:
+                raise ValueError(f"Строка {number}: некорректный JSON") from exc
+            if not isinstance(record, dict):
+                raise ValueError(f"Строка {number}: некорректная запись")
+            yield number, record
+    finally:
+        # Файл читается дважды: обёртка не должна закрыть его вместе с собой
+        if not lines.closed:
+            lines.detach()
+
+
+def _parse(stream):
+    """Заголовок, затем (номер строки, ExportedUser | ExportedMessage); прочие типы строк пропускаются."""
+    records = _records(stream)
+    first = next(records, None)
+    try:
+        header = schemas.ExportHeader.model_validate(first[1]) if first else None
+    except ValidationError:
+        header = None
+    if header is None:
+        raise ValueError("Файл не является экспортом переписки (версия 1)")
+    yield header
+    for number, record in records:
+        kind = {"user": schemas.ExportedUser, "message": schemas.ExportedMessage}.get(record.get("type"))
+        if kind is None:
+            continue
+        try:
+            yield number, kind.model_validate(record)
+        except ValidationError as exc:
+            raise ValueError(f"Строка {number}: некорректная запись") from exc
+
+
+def _validate(stream) -> tuple[schemas.ExportHeader, dict[int, str], set[int]]:
+    """Первый проход: весь файл корректен до записи первой пачки. Возвращает заголовок,
+    username участников (кроме автора) и id сообщений, на которые отвечает автор."""
+    lines = _parse(stream)
+    header = next(lines)
+    usernames: dict[int, str] = {}
+    reply_targets: set[int] = set()
+    last_id = None
+    for number, record in lines:
+        if isinstance(record, schemas.ExportedUser):
+            if record.id != header.user_id:
+                usernames[record.id] = record.username
+            continue
+        if last_id is not None and record.id <= last_id:
+            raise ValueError(f"Строка {number}: id сообщений должны возрастать")
+        last_id = record.id
+        if record.sender_id == header.user_id and record.reply_to_id is not None:
+            reply_targets.add(record.reply_to_id)
+    return header, usernames, reply_targets
+
+
+def _quote(author: str, content: str) -> str:
+    """Цитата текстом для ответа, чьё исходное сообщение не импортируется."""
+    text = " ".join(content.split())
+    if len(text) > QUOTE_LENGTH:
+        text = text[:QUOTE_LENGTH - 1] + "…"
+    return f"> {author}: {text}\n"
+
+
+def _utc(moment: datetime) -> datetime:
+    return moment.replace(tzinfo=timezone.utc) if moment.tzinfo is None else moment.astimezone(timezone.utc)
+
+
+def _resolve_users(db: Session, usernames: dict[int, str]) -> dict[int, int]:
+    if not usernames:
+        return {}
+    found = dict(db.execute(
+        select(models.User.username, models.User.id).where(models.User.username.in_(set(usernames.values())))
+    ).all())
+    return {old_id: found[name] for old_id, name in usernames.items() if name in found}
+
+
+def _floors(db: Session, pairs: set[tuple[int, int]]) -> dict[tuple[int, int], datetime]:
+    """Время последнего сообщения каждой пары. Строки диалогов блокируются до commit пачки:
+    запись в ту же пару из другой транзакции не вклинится между проверкой и вставкой."""
+    conv = models.Conversation
+    rows = db.execute(
+        select(conv.user_low_id, conv.user_high_id, models.Message.timestamp)
+        .join(models.Message, models.Message.id == conv.last_message_id)
+        .where(or_(*(and_(conv.user_low_id == low, conv.user_high_id == high) for low, high in pairs)))
+        .with_for_update(of=conv)
+    ).all()
+    return {(low, high): _utc(timestamp) for low, high, timestamp in rows}
+
+
+def _write_batch(
+    db: Session, job_id: int, owner_id: int, batch: list[tuple[schemas.ExportedMessage, int]], quotes: dict[int, str]
+) -> int:
+    """Пишет пачку в транзакции db. Возвращает число записанных строк.
+    quotes — цитаты текстом по старым id (см. _quote) для ответов на неимпортированное."""
+    floors = _floors(db, {conversations.canonical_pair(owner_id, recipient_id) for _, recipient_id in batch})
+    # Внутри пачки равное время допустимо, относительно уже записанного — только строго новее
+    latest: dict[tuple[int, int], datetime] = {}
+    accepted = []
+    for record, recipient_id in batch:
+        pair = conversations.canonical_pair(owner_id, recipient_id)
+        timestamp = _utc(record.timestamp)
+        if pair in latest:
+            if timestamp < latest[pair]:
+                continue
+        elif pair in floors and timestamp <= floors[pair]:
+            continue
+        latest[pair] = timestamp
+        accepted.append((record, recipient_id, timestamp))
+    if not accepted:
+        return 0
+
+    # Ответы — на новые id: цитируемое сообщение было в этой или одной из прошлых пачек
+    reply_to = {record.reply_to_id for record, _, _ in accepted if record.reply_to_id is not None}
+    new_ids = dict(db.execute(
+        select(models.ImportedMessage.old_id, models.ImportedMessage.new_id).where(
+            models.ImportedMessage.job_id == job_id, models.ImportedMessage.old_id.in_(reply_to),
+        )
+    ).all()) if reply_to else {}
+    linked = set(new_ids) | {record.id for record, _, _ in accepted}
+
+    def content(record: schemas.ExportedMessage) -> str:
+        # Исходное сообщение не импортируется (чужое или пропущенное) — цитата остаётся текстом
+        if record.reply_to_id is None or record.reply_to_id in linked or record.is_encrypted:
+            return record.content
+        return quotes.get(record.reply_to_id, "") + record.content
+
+    inserted = db.execute(
+        insert(models.Message).returning(
+            models.Message.id,
+            models.Message.sender_id,
+            models.Message.recipient_id,
+            models.Message.is_read,
+            sort_by_parameter_order=True,
+        ),
+        [
+            {
+                "sender_id": owner_id,
+                "recipient_id": recipient_id,
+                "content": content(record),
+                "is_encrypted": record.is_encrypted,
+                "is_read": record.is_read,
+                "timestamp": timestamp,
+                "reply_to_id": None,
+            }
+            for record, recipient_id, timestamp in accepted
+        ],
+    ).all()
+    db.execute(insert(models.ImportedMessage), [
+        {"job_id": job_id, "old_id": record.id, "new_id": new.id}
+        for (record, _, _), new in zip(accepted, inserted)
+    ])
+
+    new_ids.update((record.id, new.id) for (record, _, _), new in zip(accepted, inserted))
+    replies = [
+        {"id": new.id, "reply_to_id": new_ids[record.reply_to_id]}
+        for (record, _, _), new in zip(accepted, inserted) if record.reply_to_id in new_ids
+    ]
+    if replies:
+        db.execute(update(models.Message), replies)
+    conversations.on_messages_created(db, inserted)
+    return len(inserted)
+
+
+def import_file(session_factory, owner_id: int, stream, on_batch=None) -> tuple[int, int, dict[str, int]]:
+    """Импортирует файл экспорта. Возвращает (id задачи, импортировано, пропущено по причинам —
+    см. SKIP_REASONS). ValueError — файл не является экспортом или повреждён; тогда не записано
+    ничего. on_batch(пары (sender_id, recipient_id)) вызывается после commit каждой пачки."""
+    header, usernames, reply_targets = _validate(stream)
+
+    with session_factory() as db:
+        user_map = _resolve_users(db, usernames)
+        user_map[header.user_id] = owner_id
+        authors = {**usernames, header.user_id: db.get(models.User, owner_id).username}
+        lowest = partitions.lowest_bound(db.connection())
+        job = models.ImportJob(user_id=owner_id, status="running", imported=0, skipped=0, skipped_by_reason={})
+        db.add(job)
+        db.commit()
+        job_id = job.id
+
+    imported = 0
+    skipped: Counter[str] = Counter()
+    quotes: dict[int, str] = {}
+
+    def flush(batch, rejected):
+        nonlocal imported
+        with session_factory() as db:
+            written = _write_batch(db, job_id, owner_id, batch, quotes) if batch else 0
+            imported += written
+            skipped.update(rejected)
+            skipped["not_newer"] += len(batch) - written
+            db.execute(
+                update(models.ImportJob).where(models.ImportJob.id == job_id)
+                .values(imported=imported, skipped=sum(skipped.values()), skipped_by_reason=dict(+skipped))
+            )
+            db.commit()
+        if written and on_batch is not None:
+            on_batch({(owner_id, recipient_id) for _, recipient_id in batch})
+
+    try:
+        latest = datetime.now(timezone.utc) + _CLOCK_SKEW
+        batch: list[tuple[schemas.ExportedMessage, int]] = []
+        rejected: Counter[str] = Counter()
+        lines = _parse(stream)
+        next(lines)
+        for _, record in lines:
+            if isinstance(record, schemas.ExportedUser):
+                continue
+            if record.id in reply_targets and not record.is_encrypted:
+                quotes[record.id] = _quote(authors.get(record.sender_id, "Unknown"), record.content)
+            recipient_id = user_map.get(record.recipient_id)
+            timestamp = _utc(record.timestamp)
+            if record.sender_id != header.user_id:
+                rejected["received"] += 1
+            elif recipient_id is None:
+                rejected["unknown_recipient"] += 1
+            elif timestamp > latest or (lowest is not None and timestamp < lowest):
+                rejected["out_of_range"] += 1
+            else:
+                batch.append((record, recipient_id))
+            if len(batch) >= IMPORT_BATCH_SIZE:
+                flush(batch, rejected)
+                batch, rejected = [], Counter()
+        flush(batch, rejected)
+    except BaseException:
+        with session_factory() as db:
+            db.execute(
+                update(models.ImportJob).where(models.ImportJob.id == job_id)
+                .values(status="failed", finished_at=func.now())
+            )
+            db.commit()
+        raise
+
+    with session_factory() as db:
+        db.execute(
+            update(models.ImportJob).where(models.ImportJob.id == job_id)
+            .values(status="done", finished_at=func.now())
+        )
+        db.commit()
+    return job_id, imported, dict(+skipped)
@@ -0,0 +1,89 @@
+"""Хэширование паролей (argon2id) в отдельном ограниченном пуле процессов.
+
+argon2 специально дорогой по CPU и памяти. Выполняя его в пуле потоков FastAPI,
+всплеск логинов занимает все потоки и останавливает остальные sync-эндпоинты.
+Здесь хэширование идёт в HASH_WORKERS процессах; одновременно ждать может не
+больше HASH_QUEUE_SIZE задач сверх этого — дальше клиент получает 503 и Retry-After.
+
+Параметры argon2 задаются переменными окружения; если они изменились, хэш
+пользователя прозрачно пересчитывается при следующем успешном входе.
+"""
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from fastapi import HTTPException, status
+from passlib.context import CryptContext
+
+HASH_WORKERS = int(os.getenv("HASH_WORKERS", str(max(1, (os.cpu_count() or 2) // 2))))
+HASH_QUEUE_SIZE = int(os.getenv("HASH_QUEUE_SIZE", str(HASH_WORKERS * 4)))
+HASH_RETRY_AFTER_SECONDS = int(os.getenv("HASH_RETRY_AFTER_SECONDS", "2"))
+
+_argon2_settings = {"argon2__type": "id"}
+for _name in ("time_cost", "memory_cost", "parallelism"):
+    _value = os.getenv(f"ARGON2_{_name.upper()}")
+    if _value:
+        _argon2_settings[f"argon2__{_name}"] = int(_value)
+
+pwd_context = CryptContext(schemes=["argon2"], deprecated="auto", **_argon2_settings)
+
+# Пул создаётся лениво, когда в процессе уже есть потоки (anyio, aiosqlite): fork такого
+# процесса может унаследовать чужую захваченную блокировку и зависнуть — процессы пула
+# запускаются через forkserver (или spawn, где его нет)
+_MP_CONTEXT = multiprocessing.get_context(
+    "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+)
+_executor: ProcessPoolExecutor | None = None
+_in_flight = 0
+
+
+# --- Выполняются в процессах пула ---
+
+def _hash(password: str) -> str:
+    return pwd_context.hash(password)
+
+
+def _verify_and_update(password: str, hashed: str) -> tuple[bool, str | None]:
+    # Для верного пароля со старыми параметрами passlib вернёт новый хэш
+    return pwd_context.verify_and_update(password, hashed)
+
+
+# --- Вызовы из event loop ---
+
+def _pool() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=HASH_WORKERS, mp_context=_MP_CONTEXT)
+    return _executor
+
+
+def shutdown():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+async def _submit(func, *args):
+    global _in_flight
+    if _in_flight >= HASH_WORKERS + HASH_QUEUE_SIZE:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Сервер перегружен, повторите попытку позже",
+            headers={"Retry-After": str(HASH_RETRY_AFTER_SECONDS)},
+        )
+    _in_flight += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(_pool(), func, *args)
+    finally:
+        _in_flight -= 1
+
+
+async def hash_password(password: str) -> str:
+    return await _submit(_hash, password)
+
+
+async def verify_password(password: str, hashed: str) -> tuple[bool, str | None]:
+    """(пароль верен, новый хэш или None, если пересчёт не нужен)."""
+    return await _submit(_verify_and_update, password, hashed)
@@ -0,0 +1,81 @@
+"""Кэш аутентифицированных пользователей.
+
+get_current_user вызывается на каждом запросе; вместо SELECT по email он берёт
+снимок пользователя из TTL/LRU-кэша по id из токена (claim "uid"). Кэш живёт в
+процессе, поэтому изменения профиля на другом воркере видны не позже чем через
+AUTH_CACHE_TTL_SECONDS; на своём воркере update_user_me сбрасывает запись сразу.
+"""
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import date
+
+AUTH_CACHE_SIZE = int(os.getenv("AUTH_CACHE_SIZE", "10000"))
+AUTH_CACHE_TTL_SECONDS = float(os.getenv("AUTH_CACHE_TTL_SECONDS", "60"))
+
+
+@dataclass(frozen=True)
+class Identity:
+    """Снимок пользователя, не привязанный к сессии БД (поля как в schemas.UserOut)."""
+    id: int
+    username: str
+    email: str
+    avatar_url: str | None = None
+    phone_number: str | None = None
+    birth_date: date | None = None
+
+    @classmethod
+    def from_user(cls, user) -> "Identity":
+        return cls(
+            id=user.id,
+            username=user.username,
+            email=user.email,
+            avatar_url=user.avatar_url,
+            phone_number=user.phone_number,
+            birth_date=user.birth_date,
+        )
+
+
+class TTLCache:
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict = OrderedDict()
+
+    def get(self, key):
+        item = self._data.get(key)
+        if item is None:
+            return None
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+
+identity_cache = TTLCache(AUTH_CACHE_SIZE, AUTH_CACHE_TTL_SECONDS)
+
+
+def cache_key(payload: dict):
+    # Новые токены содержат uid; для старых (только sub=email) ключом служит email
+    uid = payload.get("uid")
+    return ("uid", uid) if uid is not None else ("sub", payload.get("sub"))
+
+
+def invalidate(user: Identity):
+    identity_cache.pop(("uid", user.id))
+    identity_cache.pop(("sub", user.email))
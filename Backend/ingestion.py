@@ -0,0 +1,233 @@
+"""Запись новых сообщений с группировкой коммитов (write-behind).
+
+Сокеты не пишут сообщения в БД сами: они кладут их в общую очередь. Одна фоновая
+задача забирает из очереди всё накопившееся (до INGEST_BATCH_SIZE сообщений) и пишет
+его постоянным числом запросов: цитаты, многострочный INSERT ... RETURNING, один upsert
+диалогов, один upsert счётчиков seq и журнал событий — и одним commit, то есть один
+fsync на пачку, а не на сообщение.
+
+Порядок сохраняется: пачки пишутся строго по очереди, insert_ordered возвращает id
+в порядке постановки, и рассылка new_message идёт в том же порядке. Отправитель получает свой new_message с настоящими id и
+timestamp (и client_id, если клиент его прислал) — это и есть подтверждение.
+"""
+import asyncio
+import logging
+import os
+from dataclasses import dataclass
+
+from sqlalchemy import insert, select
+from sqlalchemy.orm import Session, joinedload
+
+import conversations
+import events
+import instrumentation
+import models
+import response_cache
+
+logger = logging.getLogger(__name__)
+
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "500"))
+# Сколько подождать, пока в пачку наберутся ещё сообщения (0 — брать только уже накопившиеся)
+INGEST_MAX_DELAY_SECONDS = float(os.getenv("INGEST_MAX_DELAY_MS", "2")) / 1000
+# При переполнении очереди submit ждёт — сокеты притормаживают вместо роста памяти
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", "10000"))
+
+
+def insert_ordered(db: Session, model, rows: list[dict], *columns) -> list:
+    """Многострочный INSERT ... RETURNING columns (среди них — id); строки результата
+    идут в порядке rows. PostgreSQL пишет такую вставку пачками сам (sort_by_parameter_order),
+    а на SQLite SQLAlchemy для упорядоченного RETURNING делает по INSERT на строку. Поэтому
+    для SQLite — один INSERT со многими VALUES: rowid выдаются по порядку строк, и сортировка
+    по id восстанавливает порядок."""
+    dialect = db.get_bind().dialect
+    if dialect.name != "sqlite":
+        return db.execute(insert(model).returning(*columns, sort_by_parameter_order=True), rows).all()
+    per_statement = max(1, dialect.insertmanyvalues_max_parameters // len(rows[0]))
+    result = []
+    for start in range(0, len(rows), per_statement):
+        chunk = db.execute(insert(model).values(rows[start:start + per_statement]).returning(*columns)).all()
+        result.extend(sorted(chunk, key=lambda row: row.id))
+    return result
+
+
+@dataclass
+class PendingMessage:
+    sender_id: int
+    recipient_id: int
+    content: str
+    reply_to_id: int | None = None
+    client_id: str | None = None
+
+
+class MessageIngestor:
+    def __init__(self, manager, session_factory, batch_size: int = INGEST_BATCH_SIZE,
+                 max_delay: float = INGEST_MAX_DELAY_SECONDS, queue_size: int = INGEST_QUEUE_SIZE):
+        self.manager = manager
+        self.session_factory = session_factory
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.queue: asyncio.Queue[PendingMessage | None] = asyncio.Queue(maxsize=queue_size)
+        self._runner: asyncio.Task | None = None
+        # Счётчики для наблюдения за размером пачек
+        self.batches = 0
+        self.messages = 0
+
+    async def start(self):
+        self._runner = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Дописывает всё, что уже в очереди, и останавливает задачу."""
+        if self._runner is None:
+            return
+        await self.queue.put(None)
+        await self._runner
+        self._runner = None
+
+    async def submit(self, message: PendingMessage):
+        await self.queue.put(message)
+
+    async def _run(self):
+        while True:
+            first = await self.queue.get()
+            if first is None:
+                return
+            batch = [first]
+            stopping = self._drain(batch)
+            if not stopping and len(batch) < self.batch_size and self.max_delay > 0:
+                await asyncio.sleep(self.max_delay)
+                stopping = self._drain(batch)
+            try:
+                with instrumentation.track("background", "ingest_batch"):
+                    await self._process(batch)
+            except Exception:
+                logger.exception("Не удалось записать пачку из %s сообщений", len(batch))
+            if stopping:
+                return
+
+    def _drain(self, batch: list[PendingMessage]) -> bool:
+        """Добирает в пачку уже накопившиеся сообщения. True — встретился сигнал остановки."""
+        while len(batch) < self.batch_size:
+            try:
+                item = self.queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return False
+            if item is None:
+                return True
+            batch.append(item)
+        return False
+
+    async def _process(self, batch: list[PendingMessage]):
+        try:
+            rows = await self._write(batch)
+            failed = []
+        except Exception:
+            # Одно плохое сообщение (например, reply_to_id на удалённое) не должно
+            # валить всю пачку: пишем по одному, ошибки отдаём отправителям
+            logger.warning("Пачка из %s сообщений отклонена, записываем по одному", len(batch), exc_info=True)
+            rows, failed = [], []
+            for item in batch:
+                try:
+                    rows.extend(await self._write([item]))
+                except Exception:
+                    failed.append(item)
+
+        self.batches += 1
+        self.messages += len(rows)
+        # Кэш ответов — до рассылки: клиент, получивший кадр, перечитает уже свежие данные
+        await response_cache.invalidate_messages((item.sender_id, item.recipient_id) for item, *_ in rows)
+        await self._deliver(rows)
+        for item in failed:
+            await self.manager.send_personal_message(
+                {"type": "message_failed", "client_id": item.client_id, "recipient_id": item.recipient_id},
+                item.sender_id,
+            )
+
+    async def _write(self, batch: list[PendingMessage]) -> list[tuple[PendingMessage, dict, int, int]]:
+        async with self.session_factory() as db:
+            replies = await self._load_replies(db, batch)
+            inserted = await db.run_sync(
+                insert_ordered,
+                models.Message,
+                [
+                    {
+                        "sender_id": item.sender_id,
+                        "recipient_id": item.recipient_id,
+                        "content": item.content,
+                        "is_read": False,
+                        "is_encrypted": False,
+                        "reply_to_id": reply.id if reply else None,
+                    }
+                    for item, reply in zip(batch, replies)
+                ],
+                models.Message.id,
+                models.Message.sender_id,
+                models.Message.recipient_id,
+                models.Message.is_read,
+                models.Message.timestamp,
+            )
+            await db.run_sync(conversations.on_messages_created, inserted)
+
+            payloads = []
+            for item, row, reply in zip(batch, inserted, replies):
+                payloads.append({
+                    "type": "new_message",
+                    "id": row.id,
+                    "sender_id": row.sender_id,
+                    "recipient_id": row.recipient_id,
+                    "content": item.content,
+                    "timestamp": row.timestamp.isoformat(),
+                    "is_read": row.is_read,
+                    "is_encrypted": False,
+                    "reply_to": {
+                        "id": reply.id,
+                        "content": reply.content,
+                        "sender_username": reply.sender.username if reply.sender else "Unknown",
+                    } if reply else None,
+                })
+
+            # Журнал событий получателя и отправителя — в той же транзакции
+            seqs = await db.run_sync(events.record, [
+                event
+                for item, payload in zip(batch, payloads)
+                for event in ((item.recipient_id, payload), (item.sender_id, payload))
+            ])
+            await db.commit()
+
+        return [
+            (item, payload, seqs[2 * i], seqs[2 * i + 1])
+            for i, (item, payload) in enumerate(zip(batch, payloads))
+        ]
+
+    async def _load_replies(self, db, batch: list[PendingMessage]) -> list[models.Message | None]:
+        """Цитируемое сообщение для каждого сообщения пачки — одним запросом. Цитировать
+        можно только сообщение своего диалога: reply_to_id на чужую переписку (или на
+        несуществующее сообщение) отбрасывается — иначе в ответ ушли бы чужой текст и автор."""
+        reply_ids = {item.reply_to_id for item in batch if item.reply_to_id}
+        found = {}
+        if reply_ids:
+            found = {
+                msg.id: msg
+                for msg in await db.scalars(
+                    select(models.Message)
+                    .options(joinedload(models.Message.sender))
+                    .where(models.Message.id.in_(reply_ids))
+                )
+            }
+        replies = []
+        for item in batch:
+            reply = found.get(item.reply_to_id)
+            if reply and conversations.canonical_pair(reply.sender_id, reply.recipient_id) != conversations.canonical_pair(
+                item.sender_id, item.recipient_id
+            ):
+                reply = None
+            replies.append(reply)
+        return replies
+
+    async def _deliver(self, rows: list[tuple[PendingMessage, dict, int, int]]):
+        # Последовательно, а не gather: порядок кадров у получателя = порядок id
+        for item, payload, recipient_seq, sender_seq in rows:
+            await self.manager.send_personal_message({**payload, "seq": recipient_seq}, item.recipient_id)
+            sender_payload = {**payload, "seq": sender_seq}
+            if item.client_id is not None:
+                sender_payload["client_id"] = item.client_id
+            await self.manager.send_personal_message(sender_payload, item.sender_id)
@@ -0,0 +1,213 @@
+"""Счётчики SQL-запросов и времени по HTTP-маршрутам и типам кадров /ws.
+
+Хук SQLAlchemy (before/after_cursor_execute) добавляет каждый запрос к операции,
+которая сейчас выполняется в этом контексте (contextvar): HTTP-запросу (InstrumentationMiddleware),
+кадру WebSocket или фоновой пачке (track). По операции учитываются число запросов,
+время в БД и полное время обработки; агрегаты отдаются в формате Prometheus (/metrics).
+Операции дольше SLOW_REQUEST_MS пишутся в лог вместе со своими SQL.
+
+Для тестов: assert_max_queries(n) — упасть, если внутри блока выполнено больше n запросов.
+"""
+import contextvars
+import logging
+import os
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+SLOW_REQUEST_MS = float(os.getenv("SLOW_REQUEST_MS", "500"))
+# Сколько SQL одной операции хранить для лога медленных запросов
+SLOW_LOG_MAX_STATEMENTS = 50
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+@dataclass
+class OperationStats:
+    kind: str
+    name: str
+    queries: int = 0
+    db_seconds: float = 0.0
+    statements: list[tuple[str, float]] = field(default_factory=list)
+
+
+_current: contextvars.ContextVar[OperationStats | None] = contextvars.ContextVar("instrumentation_current", default=None)
+# Активные assert_max_queries: считают все запросы процесса, независимо от контекста
+_global_counters: set["QueryCounter"] = set()
+
+
+class _Aggregate:
+    def __init__(self):
+        self.count = 0
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.seconds = 0.0
+        self.buckets = [0] * len(DURATION_BUCKETS)
+
+
+class Registry:
+    def __init__(self):
+        self._data: dict[tuple[str, str], _Aggregate] = {}
+
+    def observe(self, stats: OperationStats, seconds: float):
+        agg = self._data.get((stats.kind, stats.name))
+        if agg is None:
+            agg = self._data[(stats.kind, stats.name)] = _Aggregate()
+        agg.count += 1
+        agg.queries += stats.queries
+        agg.db_seconds += stats.db_seconds
+        agg.seconds += seconds
+        for i, bound in enumerate(DURATION_BUCKETS):
+            if seconds <= bound:
+                agg.buckets[i] += 1
+
+    def render(self) -> list[str]:
+        lines = [
+            "# HELP messenger_operations_total Обработанные HTTP-запросы, кадры /ws и фоновые пачки",
+            "# TYPE messenger_operations_total counter",
+        ]
+        for (kind, name), agg in sorted(self._data.items()):
+            lines.append(f"messenger_operations_total{_labels(kind, name)} {agg.count}")
+        lines += [
+            "# HELP messenger_operation_queries_total SQL-запросы, выполненные операциями",
+            "# TYPE messenger_operation_queries_total counter",
+        ]
+        for (kind, name), agg in sorted(self._data.items()):
+            lines.append(f"messenger_operation_queries_total{_labels(kind, name)} {agg.queries}")
+        lines += [
+            "# HELP messenger_operation_db_seconds_total Время операций в БД",
+            "# TYPE messenger_operation_db_seconds_total counter",
+        ]
+        for (kind, name), agg in sorted(self._data.items()):
+            lines.append(f"messenger_operation_db_seconds_total{_labels(kind, name)} {agg.db_seconds:.6f}")
+        lines += [
+            "# HELP messenger_operation_duration_seconds Полное время обработки операции",
+            "# TYPE messenger_operation_duration_seconds histogram",
+        ]
+        for (kind, name), agg in sorted(self._data.items()):
+            for bound, bucket in zip(DURATION_BUCKETS, agg.buckets):
+                lines.append(f'messenger_operation_duration_seconds_bucket{_labels(kind, name, le=str(bound))} {bucket}')
+            lines.append(f'messenger_operation_duration_seconds_bucket{_labels(kind, name, le="+Inf")} {agg.count}')
+            lines.append(f"messenger_operation_duration_seconds_sum{_labels(kind, name)} {agg.seconds:.6f}")
+            lines.append(f"messenger_operation_duration_seconds_count{_labels(kind, name)} {agg.count}")
+        return lines
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"')
+
+
+def _labels(kind: str, name: str, **extra) -> str:
+    pairs = {"kind": kind, "name": name, **extra}
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in pairs.items()) + "}"
+
+
+registry = Registry()
+
+
+# --- хук SQLAlchemy ---
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context._instrumentation_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - context._instrumentation_started
+    stats = _current.get()
+    if stats is not None:
+        stats.queries += 1
+        stats.db_seconds += elapsed
+        if len(stats.statements) < SLOW_LOG_MAX_STATEMENTS:
+            stats.statements.append((statement, elapsed))
+    for counter in _global_counters:
+        counter.count += 1
+        counter.statements.append(statement)
+
+
+def install(*engines):
+    """Подключает счётчик к движкам (для AsyncEngine — к его sync_engine)."""
+    for engine in engines:
+        target = getattr(engine, "sync_engine", engine)
+        if not event.contains(target, "before_cursor_execute", _before_cursor_execute):
+            event.listen(target, "before_cursor_execute", _before_cursor_execute)
+            event.listen(target, "after_cursor_execute", _after_cursor_execute)
+
+
+# --- учёт операций ---
+
+@contextmanager
+def track(kind: str, name: str):
+    """Учитывает всё, что выполнено внутри блока, как одну операцию kind/name."""
+    stats = OperationStats(kind, name)
+    token = _current.set(stats)
+    started = time.perf_counter()
+    try:
+        yield stats
+    finally:
+        _current.reset(token)
+        _finish(stats, time.perf_counter() - started)
+
+
+def _finish(stats: OperationStats, seconds: float):
+    registry.observe(stats, seconds)
+    if seconds * 1000 >= SLOW_REQUEST_MS:
+        sql = "\n".join(f"  [{elapsed * 1000:.1f} ms] {' '.join(statement.split())[:500]}" for statement, elapsed in stats.statements)
+        logger.warning(
+            "Медленная операция %s %s: %.0f ms, SQL: %s запросов, %.0f ms\n%s",
+            stats.kind, stats.name, seconds * 1000, stats.queries, stats.db_seconds * 1000, sql,
+        )
+
+
+class InstrumentationMiddleware:
+    """ASGI-middleware для HTTP: операция называется шаблоном маршрута ("GET /messages/{user_id}"),
+    а не фактическим путём, чтобы число рядов в /metrics не росло с числом id."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        stats = OperationStats("http", "")
+        token = _current.set(stats)
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _current.reset(token)
+            route = scope.get("route")
+            stats.name = f"{scope['method']} {route.path if route is not None else 'unmatched'}"
+            _finish(stats, time.perf_counter() - started)
+
+
+def render_metrics(extra: dict[str, float] | None = None) -> str:
+    """Текст для /metrics; extra — дополнительные метрики {имя: значение} (например, из ConnectionManager)."""
+    lines = registry.render()
+    for metric, value in (extra or {}).items():
+        lines.append(f"{metric} {value}")
+    return "\n".join(lines) + "\n"
+
+
+# --- для тестов ---
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+        self.statements: list[str] = []
+
+
+@contextmanager
+def assert_max_queries(limit: int):
+    """with assert_max_queries(3): client.get("/users", ...) — AssertionError со списком SQL, если запросов больше."""
+    counter = QueryCounter()
+    _global_counters.add(counter)
+    try:
+        yield counter
+    finally:
+        _global_counters.discard(counter)
+    if counter.count > limit:
+        statements = "\n".join(f"  {' '.join(statement.split())}" for statement in counter.statements)
+        raise AssertionError(f"Ожидалось не больше {limit} SQL-запросов, выполнено {counter.count}:\n{statements}")
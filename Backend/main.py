@@ -1,33 +1,70 @@
+import json
 import os
 import secrets
-import shutil
-import uuid
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta
 
+import anyio
 from fastapi import (
     Depends,
     FastAPI,
     File,
+    Header,
     HTTPException,
     Query,
+    Request,
+    Response,
     UploadFile,
     WebSocket,
     WebSocketDisconnect,
     status,
 )
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import FileResponse, PlainTextResponse, StreamingResponse
 from fastapi.security import OAuth2PasswordBearer
 from fastapi.staticfiles import StaticFiles
 from jose import JWTError, jwt
-from passlib.context import CryptContext
-from pydantic import BaseModel
-from sqlalchemy import or_, and_
-from sqlalchemy.orm import Session
+from pydantic import BaseModel, TypeAdapter, ValidationError
+from sqlalchemy import and_, case, or_, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, joinedload
+from starlette.concurrency import run_in_threadpool
 
 # Локальные модули
+import conversations
+import events
+import exports
+import hashing
+import identity
+import instrumentation
 import models
+import partitions
+import response_cache
 import schemas
-from database import engine, get_db
+import search
+import thumbnails
+import uploads
+import wire
+from broker import create_broker
+from coalescer import Coalescer
+from connections import ConnectionManager
+from events import EventLog
+from identity import Identity
+from ingestion import MessageIngestor, PendingMessage
+from partitions import PartitionMaintenance
+from presence import PresenceService
+from database import (
+    AsyncReadSessionLocal,
+    AsyncSessionLocal,
+    READ_REPLICA_URL,
+    SessionLocal,
+    async_engine,
+    engine,
+    get_async_db,
+    get_async_read_db,
+    get_db,
+    read_async_engine,
+)
 
 # --- КОНФИГУРАЦИЯ ---
 SECRET_KEY = "super-secret-key-change-me"
@@ -35,9 +72,36 @@ ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30 * 24 * 7 
 
 os.makedirs("static/uploads", exist_ok=True)
+uploads.ensure_dirs()
+thumbnails.ensure_dirs()
 models.Base.metadata.create_all(bind=engine)
-
-app = FastAPI()
+partitions.setup(engine)
+search.setup(engine)
+# Для баз, созданных до появления таблицы conversations
+with SessionLocal() as _db:
+    conversations.rebuild_if_empty(_db)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Подписка на брокер событий (доставка между воркерами)
+    await manager.start()
+    await coalescer.start()
+    await ingestor.start()
+    await event_log.start()
+    await partition_maintenance.start()
+    await upload_sweeper.start()
+    yield
+    await upload_sweeper.stop()
+    await partition_maintenance.stop()
+    await event_log.stop()
+    await ingestor.stop()
+    await coalescer.stop()
+    await presence.stop()
+    await manager.stop()
+    thumbnails.shutdown()
+    hashing.shutdown()
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -45,16 +109,16 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "ETag"],
 )
+# Число SQL-запросов, время в БД и время обработки по маршрутам (см. /metrics)
+instrumentation.install(engine, async_engine, read_async_engine)
+app.add_middleware(instrumentation.InstrumentationMiddleware)
 
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
-pwd_context = CryptContext(schemes=["argon2"], deprecated="auto", argon2__type="id")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
 
-def get_password_hash(password):
-    return pwd_context.hash(password)
-
 def create_access_token(data: dict):
     to_encode = data.copy()
     expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
@@ -62,65 +126,51 @@ def create_access_token(data: dict):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
-    credentials_exception = HTTPException(
-        status_code=status.HTTP_401_UNAUTHORIZED,
-        detail="Could not validate credentials",
-        headers={"WWW-Authenticate": "Bearer"},
-    )
+credentials_exception = HTTPException(
+    status_code=status.HTTP_401_UNAUTHORIZED,
+    detail="Could not validate credentials",
+    headers={"WWW-Authenticate": "Bearer"},
+)
+
+def decode_token(token: str) -> dict:
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        email: str = payload.get("sub")
-        if email is None:
+        if payload.get("sub") is None:
             raise credentials_exception
     except JWTError:
         raise credentials_exception
-    
-    user = db.query(models.User).filter(models.User.email == email).first()
-    if user is None:
+    return payload
+
+async def authenticate_token(token: str) -> Identity:
+    """Проверка JWT + снимок пользователя. На горячем пути — только поиск в кэше;
+    в БД идём при промахе (сессия открывается только в этом случае)."""
+    payload = decode_token(token)
+    key = identity.cache_key(payload)
+    current = identity.identity_cache.get(key)
+    if current is not None:
+        return current
+
+    async with AsyncSessionLocal() as db:
+        if payload.get("uid") is not None:
+            user = await db.get(models.User, payload["uid"])
+        else:
+            user = (await db.execute(select(models.User).where(models.User.email == payload["sub"]))).scalar_one_or_none()
+    if user is None or user.email != payload["sub"]:
         raise credentials_exception
-    return user
+    current = Identity.from_user(user)
+    identity.identity_cache.set(key, current)
+    return current
 
-class ConnectionManager:
-    def __init__(self):
-        self.active_connections: dict[int, list[WebSocket]] = {}
-
-    async def connect(self, websocket: WebSocket, user_id: int):
-        await websocket.accept()
-        was_offline = user_id not in self.active_connections
-        if was_offline:
-            self.active_connections[user_id] = []
-        self.active_connections[user_id].append(websocket)
-        if was_offline:
-            await self.broadcast_status(user_id, "online")
-
-    def disconnect(self, websocket: WebSocket, user_id: int):
-        if user_id in self.active_connections:
-            if websocket in self.active_connections[user_id]:
-                self.active_connections[user_id].remove(websocket)
-            if not self.active_connections[user_id]:
-                del self.active_connections[user_id]
-                return True 
-        return False
-
-    async def send_personal_message(self, message: dict, user_id: int):
-        if user_id in self.active_connections:
-            for connection in self.active_connections[user_id]:
-                try:
-                    await connection.send_json(message)
-                except RuntimeError:
-                    pass
-    
-    async def broadcast_status(self, user_id: int, status: str):
-        message = {"type": "status_update", "user_id": user_id, "status": status}
-        for uid, sockets in list(self.active_connections.items()):
-            for ws in sockets:
-                try:
-                    await ws.send_json(message)
-                except RuntimeError:
-                    pass
+async def get_current_user(token: str = Depends(oauth2_scheme)) -> Identity:
+    return await authenticate_token(token)
 
-manager = ConnectionManager()
+manager = ConnectionManager(create_broker())
+presence = PresenceService(manager, AsyncSessionLocal)
+coalescer = Coalescer(manager, AsyncSessionLocal)
+ingestor = MessageIngestor(manager, AsyncSessionLocal)
+event_log = EventLog(AsyncSessionLocal)
+partition_maintenance = PartitionMaintenance(engine)
+upload_sweeper = uploads.UploadSweeper(AsyncSessionLocal)
 
 class Token(BaseModel):
     access_token: str
@@ -128,301 +178,557 @@ class Token(BaseModel):
 
 # --- ЭНДПОИНТЫ ---
 
-@app.post("/upload")
-async def upload_file(file: UploadFile = File(...)):
-    file_extension = file.filename.split(".")[-1]
-    unique_filename = f"{uuid.uuid4()}.{file_extension}"
-    file_path = f"static/uploads/{unique_filename}"
-    
-    with open(file_path, "wb+") as file_object:
-        shutil.copyfileobj(file.file, file_object)
-        
-    return {"url": f"http://localhost:8000/{file_path}"}
+# Тело multipart читается самим эндпоинтом (не UploadFile): иначе Starlette сначала
+# сохранит его целиком во временный файл и лимиты сработают только после этого
+@app.post("/upload", response_model=schemas.UploadResult, openapi_extra={"requestBody": {
+    "required": True,
+    "content": {"multipart/form-data": {"schema": {
+        "type": "object",
+        "properties": {"file": {"type": "string", "format": "binary"}},
+        "required": ["file"],
+    }}},
+}})
+async def upload_file(
+    request: Request,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: Identity = Depends(get_current_user)
+):
+    # Потоковая запись + sha256: одинаковые файлы хранятся один раз, действует квота пользователя
+    url = await uploads.save_upload(db, current_user.id, request)
+    # Превью/аватары 64/128/512 строятся в фоне, ответ их не ждёт
+    thumbnails.schedule_variants(url.rsplit("/", 1)[-1])
+    return {"url": url}
+
+# --- Докачиваемая загрузка больших вложений ---
+# POST /uploads -> upload_id; PUT /uploads/{id}?offset=N (тело — сырые байты части);
+# GET /uploads/{id} -> сколько уже принято; POST /uploads/{id}/complete -> url;
+# DELETE /uploads/{id} -> отмена (брошенные загрузки удаляются и сами, по TTL)
+
+@app.post("/uploads", response_model=schemas.UploadSessionOut)
+async def create_upload_session(
+    data: schemas.UploadSessionCreate,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: Identity = Depends(get_current_user)
+):
+    session = await uploads.create_session(db, current_user.id, data.filename, data.size)
+    return {"upload_id": session.id, "size": session.size, "offset": session.received, "chunk_size": uploads.CHUNK_SIZE}
+
+@app.get("/uploads/{upload_id}", response_model=schemas.UploadSessionOut)
+async def get_upload_session(
+    upload_id: str,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: Identity = Depends(get_current_user)
+):
+    session = await uploads.get_session(db, current_user.id, upload_id)
+    return {"upload_id": session.id, "size": session.size, "offset": session.received, "chunk_size": uploads.CHUNK_SIZE}
+
+@app.put("/uploads/{upload_id}", response_model=schemas.UploadSessionOut)
+async def upload_part(
+    upload_id: str,
+    request: Request,
+    offset: int = Query(..., ge=0),
+    db: AsyncSession = Depends(get_async_db),
+    current_user: Identity = Depends(get_current_user)
+):
+    session = await uploads.get_session(db, current_user.id, upload_id)
+    received = await uploads.append_part(db, session, offset, request.stream())
+    return {"upload_id": session.id, "size": session.size, "offset": received, "chunk_size": uploads.CHUNK_SIZE}
+
+@app.post("/uploads/{upload_id}/complete", response_model=schemas.UploadResult)
+async def complete_upload(
+    upload_id: str,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: Identity = Depends(get_current_user)
+):
+    session = await uploads.get_session(db, current_user.id, upload_id)
+    url = await uploads.complete_session(db, session)
+    thumbnails.schedule_variants(url.rsplit("/", 1)[-1])
+    return {"url": url}
+
+@app.delete("/uploads/{upload_id}", status_code=204)
+async def cancel_upload(
+    upload_id: str,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: Identity = Depends(get_current_user)
+):
+    session = await uploads.get_session(db, current_user.id, upload_id)
+    await uploads.cancel_session(db, session)
+    return Response(status_code=204)
+
+@app.get("/media/{stored_name}/{size}")
+async def get_media_variant(stored_name: str, size: int, request: Request):
+    # Уменьшенная WebP-копия загруженного изображения; если её ещё нет — строится сейчас
+    if size not in thumbnails.VARIANT_SIZES or not thumbnails.is_image(stored_name):
+        raise HTTPException(status_code=404, detail="Not found")
+    if not os.path.exists(os.path.join(uploads.UPLOAD_DIR, stored_name)):
+        raise HTTPException(status_code=404, detail="Not found")
+
+    # Имя содержит sha256 оригинала, поэтому вариант неизменяем и ETag строгий
+    headers = {"ETag": thumbnails.etag(stored_name, size), "Cache-Control": thumbnails.CACHE_CONTROL}
+    if request.headers.get("if-none-match") == headers["ETag"]:
+        return Response(status_code=304, headers=headers)
+    try:
+        path = await thumbnails.ensure_variant(stored_name, size)
+    except Exception:
+        raise HTTPException(status_code=415, detail="Не удалось обработать изображение")
+    return FileResponse(path, media_type="image/webp", headers=headers)
 
 @app.post("/register", response_model=schemas.UserOut)
-def register(user: schemas.UserCreate, db: Session = Depends(get_db)):
-    if db.query(models.User).filter(models.User.email == user.email).first():
+async def register(user: schemas.UserCreate, db: AsyncSession = Depends(get_async_db)):
+    if await db.scalar(select(models.User.id).where(models.User.email == user.email)):
         raise HTTPException(status_code=400, detail="Email already registered")
-    if db.query(models.User).filter(models.User.username == user.username).first():
+    if await db.scalar(select(models.User.id).where(models.User.username == user.username)):
         raise HTTPException(status_code=400, detail="Username already taken")
 
-    hashed_pw = get_password_hash(user.password)
+    # argon2 считается в пуле процессов hashing; при перегрузке — 503 + Retry-After
+    hashed_pw = await hashing.hash_password(user.password)
     new_user = models.User(email=user.email, username=user.username, hashed_password=hashed_pw)
     db.add(new_user)
-    db.commit()
-    db.refresh(new_user)
+    await db.commit()
+    await db.refresh(new_user)
     return new_user
 
 @app.post("/login", response_model=Token)
-def login(user_data: schemas.UserCreate, db: Session = Depends(get_db)):
-    user = db.query(models.User).filter(models.User.email == user_data.email).first()
-    if not user or not pwd_context.verify(user_data.password, user.hashed_password):
+async def login(user_data: schemas.UserCreate, db: AsyncSession = Depends(get_async_db)):
+    user = (await db.execute(select(models.User).where(models.User.email == user_data.email))).scalar_one_or_none()
+    if not user:
+        raise HTTPException(status_code=400, detail="Incorrect email or password")
+    is_valid, new_hash = await hashing.verify_password(user_data.password, user.hashed_password)
+    if not is_valid:
         raise HTTPException(status_code=400, detail="Incorrect email or password")
+
+    # Параметры argon2 изменились — сохраняем хэш с новыми параметрами
+    if new_hash:
+        user.hashed_password = new_hash
+        await db.commit()
     
-    access_token = create_access_token(data={"sub": user.email})
+    access_token = create_access_token(data={"sub": user.email, "uid": user.id})
     return {"access_token": access_token, "token_type": "bearer"}
 
 @app.get("/users/me", response_model=schemas.UserOut)
-def read_users_me(current_user: models.User = Depends(get_current_user)):
+def read_users_me(current_user: Identity = Depends(get_current_user)):
     return current_user
 
 @app.put("/users/me", response_model=schemas.UserOut)
 def update_user_me(
     user_update: schemas.UserUpdate,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(get_current_user)
+    current_user: Identity = Depends(get_current_user)
 ):
+    user = db.get(models.User, current_user.id)
+    if user is None:
+        raise credentials_exception
+
     if user_update.username is not None:
         new_username = user_update.username.strip()
-        if new_username != current_user.username:
+        if new_username != user.username:
             existing = db.query(models.User).filter(models.User.username == new_username).first()
             if existing:
                 raise HTTPException(status_code=400, detail="Имя пользователя уже занято")
-            current_user.username = new_username
+            user.username = new_username
 
     if user_update.phone_number is not None:
-        current_user.phone_number = user_update.phone_number
+        user.phone_number = user_update.phone_number
         
     if user_update.birth_date is not None:
-        current_user.birth_date = user_update.birth_date
+        user.birth_date = user_update.birth_date
     
     if user_update.avatar_url is not None:
-        current_user.avatar_url = user_update.avatar_url
+        user.avatar_url = user_update.avatar_url
         
     db.commit()
-    db.refresh(current_user)
-    return current_user
+    db.refresh(user)
+    # Профиль изменился — следующий запрос возьмёт свежий снимок из БД
+    identity.invalidate(current_user)
+    # Имя и аватар видны в списках чатов собеседников и в цитатах диалогов
+    conv = models.Conversation
+    partner_ids = db.scalars(
+        select(case((conv.user_low_id == user.id, conv.user_high_id), else_=conv.user_low_id))
+        .where(or_(conv.user_low_id == user.id, conv.user_high_id == user.id))
+    ).all()
+    anyio.from_thread.run(response_cache.invalidate_profile, user.id, partner_ids)
+    return user
+
+_chat_list_adapter = TypeAdapter(list[schemas.UserWithLastMessage])
+_messages_page_adapter = TypeAdapter(list[schemas.MessageOut])
+
+def dump_json(data) -> str:
+    # Так же, как JSONResponse FastAPI
+    return json.dumps(data, separators=(",", ":"), ensure_ascii=False)
+
+def cached_json_response(body: str, next_cursor: int | None, if_none_match: str | None) -> Response:
+    """Ответ из кэша ответов: ETag по телу, 304 при совпадении If-None-Match."""
+    data = body.encode()
+    etag = response_cache.etag_for(data)
+    # no-cache: браузер хранит ответ, но перед использованием сверяет ETag
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if next_cursor is not None:
+        headers["X-Next-Cursor"] = str(next_cursor)
+    if response_cache.etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+    return Response(data, media_type="application/json", headers=headers)
+
+async def load_cached(scopes: list[str], params: tuple, db: AsyncSession, loader) -> dict:
+    """Запись кэша ответов или loader(сессия). Сразу после инвалидации запись заполняется
+    с основной БД: реплика могла ещё не получить изменение."""
+    cache_key, recently_bumped = await response_cache.cache.lookup(scopes, *params)
+    entry = await response_cache.cache.get(cache_key)
+    if entry is None:
+        if recently_bumped and READ_REPLICA_URL:
+            async with AsyncSessionLocal() as primary:
+                entry = await loader(primary)
+        else:
+            entry = await loader(db)
+        await response_cache.cache.set(cache_key, entry)
+    return entry
 
 @app.get("/users", response_model=list[schemas.UserWithLastMessage])
-def get_users_with_last_message(db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)):
-    users = db.query(models.User).filter(models.User.id != current_user.id).all()
-    result = []
-    for user in users:
-        last_msg = db.query(models.Message).filter(
-            or_(
-                (models.Message.sender_id == current_user.id) & (models.Message.recipient_id == user.id),
-                (models.Message.sender_id == user.id) & (models.Message.recipient_id == current_user.id)
-            )
-        ).order_by(models.Message.timestamp.desc()).first()
+async def get_users_with_last_message(
+    cursor: int | None = Query(None, description="ID последнего сообщения из предыдущей страницы"),
+    limit: int = Query(50, ge=1, le=200),
+    with_unread: bool = Query(True),
+    if_none_match: str | None = Header(None),
+    db: AsyncSession = Depends(get_async_read_db),
+    current_user: Identity = Depends(get_current_user)
+):
+    me = current_user.id
+    entry = await load_cached(
+        [response_cache.chat_list_scope(me)], ("chats", cursor, limit, with_unread), db,
+        lambda session: load_chat_list(session, me, cursor, limit, with_unread),
+    )
 
+    # Онлайн-статус меняется без событий диалога, поэтому не кэшируется, а берётся из брокера
+    rows = json.loads(entry["body"])
+    online = await manager.online_users([row["id"] for row in rows])
+    for row in rows:
+        row["is_online"] = row["id"] in online
+    return cached_json_response(dump_json(rows), entry["next_cursor"], if_none_match)
+
+async def load_chat_list(db: AsyncSession, me: int, cursor: int | None, limit: int, with_unread: bool) -> dict:
+    # Список чатов читается из денормализованной таблицы conversations: по индексу
+    # (user_*_id, last_message_id) выбираются только мои диалоги. id последнего сообщения
+    # монотонен, поэтому он же задаёт порядок по активности и служит курсором.
+    conv = models.Conversation
+    partner_expr = case((conv.user_low_id == me, conv.user_high_id), else_=conv.user_low_id)
+    unread_expr = case((conv.user_low_id == me, conv.unread_low), else_=conv.unread_high)
+
+    stmt = (
+        select(models.User, models.Message, unread_expr.label("unread_count"))
+        .select_from(conv)
+        .join(models.User, models.User.id == partner_expr)
+        .join(models.Message, models.Message.id == conv.last_message_id)
+        .where(or_(conv.user_low_id == me, conv.user_high_id == me), models.User.id != me)
+    )
+    if cursor is not None:
+        stmt = stmt.where(conv.last_message_id < cursor)
+    rows = (await db.execute(stmt.order_by(conv.last_message_id.desc()).limit(limit + 1))).all()
+
+    # Берём на одну строку больше, чтобы понять, есть ли следующая страница
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = rows[-1].Message.id
+
+    result = []
+    for row in rows:
+        user, last_msg = row.User, row.Message
         result.append({
             "id": user.id,
             "username": user.username,
-            "last_message": last_msg.content if last_msg else "Начните общение",
-            "last_message_time": last_msg.timestamp.isoformat() if last_msg else None,
-            "is_online": user.id in manager.active_connections,
+            "last_message": last_msg.content,
+            "last_message_time": last_msg.timestamp.isoformat() if last_msg.timestamp else None,
+            "unread_count": row.unread_count if with_unread else None,
             "avatar_url": user.avatar_url,
+            "avatar_thumb_url": thumbnails.variant_url(user.avatar_url, 128),
             "phone_number": user.phone_number,
             "birth_date": user.birth_date
         })
-    return result
+    body = _chat_list_adapter.dump_python(_chat_list_adapter.validate_python(result), mode="json")
+    return {"body": dump_json(body), "next_cursor": next_cursor}
+
+def conversation_filter(a: int, b: int):
+    return or_(
+        and_(models.Message.sender_id == a, models.Message.recipient_id == b),
+        and_(models.Message.sender_id == b, models.Message.recipient_id == a)
+    )
+
+# Цитата и её автор подгружаются тем же запросом (JOIN), без отдельного SELECT на каждый ответ
+with_reply_preview = joinedload(models.Message.reply_to).joinedload(models.Message.sender)
+
+def message_to_dict(msg: models.Message) -> dict:
+    reply_data = None
+    if msg.reply_to:
+        reply_data = {
+            "id": msg.reply_to.id,
+            "content": msg.reply_to.content,
+            "sender_username": msg.reply_to.sender.username if msg.reply_to.sender else "Unknown"
+        }
+    return {
+        "id": msg.id,
+        "sender_id": msg.sender_id,
+        "recipient_id": msg.recipient_id,
+        "content": msg.content,
+        "timestamp": msg.timestamp,
+        "is_read": msg.is_read,
+        "is_encrypted": msg.is_encrypted,
+        "reply_to": reply_data
+    }
 
 @app.get("/messages/{user_id}", response_model=list[schemas.MessageOut])
-def get_messages(user_id: int, db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)):
-    messages = db.query(models.Message).filter(
-        or_(
-            and_(models.Message.sender_id == current_user.id, models.Message.recipient_id == user_id),
-            and_(models.Message.sender_id == user_id, models.Message.recipient_id == current_user.id)
-        )
-    ).order_by(models.Message.timestamp.asc()).all()
+async def get_messages(
+    user_id: int,
+    before: int | None = Query(None, description="Вернуть сообщения с id меньше указанного"),
+    limit: int = Query(50, ge=1, le=200),
+    if_none_match: str | None = Header(None),
+    db: AsyncSession = Depends(get_async_read_db),
+    current_user: Identity = Depends(get_current_user)
+):
+    # Страница одинакова для обоих собеседников, поэтому ключ — по паре, а не по пользователю
+    entry = await load_cached(
+        [response_cache.conversation_scope(current_user.id, user_id)], ("messages", before, limit), db,
+        lambda session: load_messages_page(session, current_user.id, user_id, before, limit),
+    )
+    return cached_json_response(entry["body"], entry["next_cursor"], if_none_match)
 
-    # Формируем ответ вручную, чтобы заполнить данные о цитате
-    result = []
-    for msg in messages:
-        reply_data = None
-        if msg.reply_to:
-            # Находим автора того сообщения, на которое ответили
-            sender = db.query(models.User).filter(models.User.id == msg.reply_to.sender_id).first()
-            reply_data = {
-                "id": msg.reply_to.id,
-                "content": msg.reply_to.content,
-                "sender_username": sender.username if sender else "Unknown"
-            }
-            
-        result.append({
-            "id": msg.id,
-            "sender_id": msg.sender_id,
-            "recipient_id": msg.recipient_id,
-            "content": msg.content,
-            "timestamp": msg.timestamp,
-            "is_read": msg.is_read,
-            "is_encrypted": msg.is_encrypted,
-            "reply_to": reply_data
-        })
-        
-    return result
+async def load_messages_page(db: AsyncSession, me: int, user_id: int, before: int | None, limit: int) -> dict:
+    # Последняя страница диалога (или страница перед ?before=), по индексу (sender, recipient, id)
+    stmt = select(models.Message).options(with_reply_preview).where(
+        conversation_filter(me, user_id)
+    )
+    if before is not None:
+        stmt = stmt.where(models.Message.id < before)
+    messages = (await db.scalars(stmt.order_by(models.Message.id.desc()).limit(limit + 1))).unique().all()
+
+    next_cursor = None
+    if len(messages) > limit:
+        messages = messages[:limit]
+        next_cursor = messages[-1].id
+
+    # Клиенту отдаём страницу в хронологическом порядке
+    page = _messages_page_adapter.validate_python([message_to_dict(msg) for msg in reversed(messages)])
+    return {"body": _messages_page_adapter.dump_json(page).decode(), "next_cursor": next_cursor}
 
 @app.get("/users/search", response_model=list[schemas.UserOut])
-def search_users(q: str = Query(..., min_length=1), db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)):
-    # Ищем пользователей по username или email (регистронезависимо через ilike)
-    # Используем current_user.id != models.User.id, чтобы не находить самого себя
-    users = db.query(models.User).filter(
-        and_(
-            models.User.id != current_user.id,
-            or_(
-                models.User.username.ilike(f"%{q}%"), # ilike - case insensitive search в Postgres
-                models.User.email.ilike(f"%{q}%")
-            )
-        )
-    ).all()
-    
-    return users
+async def search_users(
+    q: str = Query(..., min_length=1),
+    limit: int = Query(20, ge=1, le=100),
+    offset: int = Query(0, ge=0),
+    db: AsyncSession = Depends(get_async_read_db),
+    current_user: Identity = Depends(get_current_user)
+):
+    # Ищем пользователей по username или email (регистронезависимо, через trigram-индексы в Postgres)
+    # Самого себя не находим
+    return await db.run_sync(search.search_users, current_user.id, q, limit, offset)
 
-@app.get("/messages/{contact_id}/search", response_model=list[schemas.MessageOut])
-def search_messages(
+@app.get("/messages/{contact_id}/search", response_model=list[schemas.MessageSearchHit])
+async def search_messages(
     contact_id: int, 
     q: str = Query(..., min_length=1), 
-    db: Session = Depends(get_db), 
-    current_user: models.User = Depends(get_current_user)
+    limit: int = Query(50, ge=1, le=200),
+    offset: int = Query(0, ge=0),
+    db: AsyncSession = Depends(get_async_read_db), 
+    current_user: Identity = Depends(get_current_user)
 ):
-    # Ищем сообщения только между мной и контактом, содержащие текст запроса
-    messages = db.query(models.Message).filter(
-        and_(
-            models.Message.content.ilike(f"%{q}%"), # Поиск подстроки
-            or_(
-                and_(models.Message.sender_id == current_user.id, models.Message.recipient_id == contact_id),
-                and_(models.Message.sender_id == contact_id, models.Message.recipient_id == current_user.id)
-            )
-        )
-    ).order_by(models.Message.timestamp.desc()).all() # Сначала новые
+    # Ищем сообщения только между мной и контактом; сначала самые релевантные
+    # (модуль search синхронный — run_sync выполняет его поверх асинхронного драйвера)
+    hits = await db.run_sync(search.search_messages, current_user.id, contact_id, q, limit, offset)
 
-    # Формируем ответ вручную для цитат (та же логика, что в get_messages)
     result = []
-    for msg in messages:
-        reply_data = None
-        if msg.reply_to_id and msg.reply_to:
-             sender = db.query(models.User).filter(models.User.id == msg.reply_to.sender_id).first()
-             reply_data = {
-                 "id": msg.reply_to.id,
-                 "content": msg.reply_to.content,
-                 "sender_username": sender.username if sender else "Unknown"
-             }
-        
-        result.append({
-            "id": msg.id,
-            "sender_id": msg.sender_id,
-            "recipient_id": msg.recipient_id,
-            "content": msg.content,
-            "timestamp": msg.timestamp,
-            "is_read": msg.is_read,
-            "is_encrypted": msg.is_encrypted,
-            "reply_to": reply_data
-        })
-        
+    for msg, snippet, rank in hits:
+        item = message_to_dict(msg)
+        item["snippet"] = snippet
+        item["rank"] = rank or 0.0
+        result.append(item)
     return result
 
 
+def export_response(owner_id: int, contact_id: int | None, filename: str, compress: bool) -> StreamingResponse:
+    # Генератор открывает свою сессию: она живёт, пока идёт ответ, а не пока работает эндпоинт
+    chunks = exports.export_lines(AsyncReadSessionLocal, owner_id, contact_id)
+    if compress:
+        chunks, filename, media_type = exports.gzip_chunks(chunks), filename + ".gz", "application/gzip"
+    else:
+        media_type = "application/x-ndjson"
+    return StreamingResponse(
+        chunks, media_type=media_type, headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+@app.get("/users/me/export")
+async def export_account(
+    gzip: bool = Query(False),
+    current_user: Identity = Depends(get_current_user)
+):
+    # Вся переписка пользователя (GDPR-выгрузка, перенос на другой сервер)
+    return export_response(current_user.id, None, f"messages-{current_user.id}.ndjson", gzip)
+
+@app.get("/messages/{contact_id}/export")
+async def export_conversation(
+    contact_id: int,
+    gzip: bool = Query(False),
+    current_user: Identity = Depends(get_current_user)
+):
+    return export_response(current_user.id, contact_id, f"messages-{current_user.id}-{contact_id}.ndjson", gzip)
+
+@app.post("/users/me/import", response_model=schemas.ImportResult)
+async def import_messages(
+    file: UploadFile = File(...),
+    current_user: Identity = Depends(get_current_user)
+):
+    # Файл из /users/me/export или /messages/{id}/export (можно .gz); загрузка уже лежит
+    # во временном файле, читаем её построчно. Каждая пачка — свой commit, кэш
+    # сбрасывается по мере записи
+    def run_import():
+        return exports.import_file(
+            SessionLocal, current_user.id, file.file,
+            on_batch=lambda pairs: anyio.from_thread.run(response_cache.invalidate_messages, pairs),
+        )
+
+    try:
+        job_id, imported, skipped = await run_in_threadpool(run_import)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+    return {"job_id": job_id, "imported": imported, "skipped": sum(skipped.values()), "skipped_by_reason": skipped}
+
+@app.get("/presence", response_model=list[schemas.PresenceOut])
+async def get_presence(
+    ids: list[int] = Query(..., max_length=500),
+    current_user: Identity = Depends(get_current_user)
+):
+    # Пакетный запрос статусов (например, для видимой части списка чатов); только собеседники
+    statuses = await presence.batch_status(current_user.id, ids)
+    return [{"user_id": uid, "is_online": is_online} for uid, is_online in statuses.items()]
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def prometheus_metrics():
+    # Формат Prometheus: операции (HTTP, кадры /ws, фоновые пачки) + состояние сокетов и очереди записи
+    ws = manager.metrics()
+    return instrumentation.render_metrics({
+        "messenger_ws_connections": ws["connections"],
+        "messenger_ws_users": ws["users"],
+        "messenger_ws_queue_depth_total": ws["queue_depth_total"],
+        "messenger_ws_queue_depth_max": ws["queue_depth_max"],
+        "messenger_ws_frames_sent_total": ws["frames_sent"],
+        "messenger_ws_frames_dropped_total": ws["frames_dropped"],
+        "messenger_ws_slow_consumers_disconnected_total": ws["slow_consumers_disconnected"],
+        "messenger_ingest_queue_depth": ingestor.queue.qsize(),
+        "messenger_ingest_batches_total": ingestor.batches,
+        "messenger_ingest_messages_total": ingestor.messages,
+    })
+
+
 @app.websocket("/ws")
-async def websocket_endpoint(websocket: WebSocket, token: str = Query(...), db: Session = Depends(get_db)):
+async def websocket_endpoint(websocket: WebSocket, token: str = Query(...)):
+    # Сессия БД берётся на время обработки одного кадра, а не на всё время жизни сокета:
+    # иначе несколько сотен подключений исчерпали бы пул соединений
     # 1. Аутентификация
+    # Тот же путь, что и у HTTP: JWT + кэш пользователей
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        email: str = payload.get("sub")
-        user = db.query(models.User).filter(models.User.email == email).first()
-        if not user:
-            await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
-            return
+        user = await authenticate_token(token)
     except Exception:
         await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
         return
 
     # 2. Подключение
-    await manager.connect(websocket, user.id)
+    with instrumentation.track("ws", "connect"):
+        connection, first_local = await manager.connect(websocket, user.id)
+        await presence.user_connected(user.id, first_local)
     
     try:
         while True:
-            data = await websocket.receive_json()
-            msg_type = data.get("type")
-            
-            # --- ЛОГИКА: СТАТУС ПЕЧАТИ ---
-            if msg_type == "typing":
-                recipient_id = data.get("recipient_id")
-                await manager.send_personal_message(
-                    {"type": "user_typing", "sender_id": user.id}, 
-                    recipient_id
-                )
-                continue
-
-            # --- ЛОГИКА: ПРОЧИТАНО ---
-            elif msg_type == "read_messages":
-                sender_id = data.get("sender_id")
-                db.query(models.Message).filter(models.Message.sender_id == sender_id, models.Message.recipient_id == user.id, models.Message.is_read == False).update({"is_read": True})
-                db.commit()
-                await manager.send_personal_message({"type": "messages_read", "user_id": user.id}, sender_id)
-                continue
-
-            # --- ЛОГИКА: УДАЛЕНИЕ ---
-            elif msg_type == "delete_message":
-                msg_id = data.get("message_id")
-                msg_to_delete = db.query(models.Message).filter(models.Message.id == msg_id).first()
-                if msg_to_delete and msg_to_delete.sender_id == user.id:
-                    recipient_id = msg_to_delete.recipient_id
-                    db.delete(msg_to_delete)
-                    db.commit()
-                    update_payload = {"type": "message_deleted", "id": msg_id}
-                    await manager.send_personal_message(update_payload, user.id)
-                    await manager.send_personal_message(update_payload, recipient_id)
-                continue
-
-            # --- ЛОГИКА: РЕДАКТИРОВАНИЕ ---
-            elif msg_type == "edit_message":
-                msg_id = data.get("message_id")
-                new_content = data.get("new_content")
-                msg_to_edit = db.query(models.Message).filter(models.Message.id == msg_id).first()
-                if msg_to_edit and msg_to_edit.sender_id == user.id and new_content:
-                    msg_to_edit.content = new_content
-                    db.commit()
-                    update_payload = {"type": "message_edited", "id": msg_id, "content": new_content}
-                    await manager.send_personal_message(update_payload, user.id)
-                    await manager.send_personal_message(update_payload, msg_to_edit.recipient_id)
+            # Кадр в согласованном формате (JSON/MessagePack), не больше WS_MAX_FRAME_BYTES,
+            # проверенный по схемам schemas.*Frame
+            try:
+                frame = wire.parse_client_frame(await wire.receive(websocket, connection.protocol))
+            except wire.FrameTooLarge:
+                await websocket.close(code=status.WS_1009_MESSAGE_TOO_BIG)
+                break
+            except (ValueError, ValidationError) as exc:
+                detail = exc.errors(include_url=False, include_input=False) if isinstance(exc, ValidationError) else "Некорректный кадр"
+                await manager.send_to_socket(websocket, user.id, {"type": "error", "detail": detail})
                 continue
-
-            # --- ЛОГИКА: ОБЫЧНОЕ СООБЩЕНИЕ (С ОТВЕТОМ) ---
-            recipient_id = data.get("recipient_id")
-            content = data.get("content")
-            reply_to_id = data.get("reply_to_id") # <--- Получаем ID ответа
+            msg_type = frame.type
             
-            if recipient_id and content:
-                new_msg = models.Message(
-                    sender_id=user.id, 
-                    recipient_id=recipient_id, 
-                    content=content, 
-                    is_read=False, 
-                    is_encrypted=False,
-                    reply_to_id=reply_to_id # <--- Сохраняем связь в БД
-                )
-                db.add(new_msg)
-                db.commit()
-                db.refresh(new_msg)
-                
-                # Подготовка данных о цитате (чтобы фронтенд мог её сразу отрисовать)
-                reply_data = None
-                if reply_to_id:
-                     replied_msg = db.query(models.Message).filter(models.Message.id == reply_to_id).first()
-                     if replied_msg:
-                         reply_sender = db.query(models.User).filter(models.User.id == replied_msg.sender_id).first()
-                         reply_data = {
-                             "id": replied_msg.id,
-                             "content": replied_msg.content,
-                             "sender_username": reply_sender.username if reply_sender else "Unknown"
-                         }
-
-                msg_response = {
-                    "type": "new_message",
-                    "id": new_msg.id,
-                    "sender_id": user.id,
-                    "recipient_id": recipient_id,
-                    "content": content,
-                    "timestamp": new_msg.timestamp.isoformat(),
-                    "is_read": False,
-                    "is_encrypted": False,
-                    "reply_to": reply_data # <--- Отправляем объект цитаты клиенту
-                }
-                
-                await manager.send_personal_message(msg_response, recipient_id)
-                await manager.send_personal_message(msg_response, user.id)
+            # Запросы и время обработки учитываются по типу кадра (см. /metrics)
+            with instrumentation.track("ws", msg_type):
+                # --- ЛОГИКА: ДОГОНЯЮЩАЯ СИНХРОНИЗАЦИЯ ПОСЛЕ ПЕРЕПОДКЛЮЧЕНИЯ ---
+                if msg_type == "sync":
+                    await event_log.sync(
+                        user.id,
+                        frame.since,
+                        lambda frame: manager.send_to_socket(websocket, user.id, frame),
+                    )
+                    continue
+
+                # --- ЛОГИКА: СТАТУС ПЕЧАТИ ---
+                elif msg_type == "typing":
+                    recipient_id = frame.recipient_id
+                    # Не чаще раза в TYPING_THROTTLE_SECONDS для пары отправитель -> получатель
+                    if coalescer.should_forward_typing(user.id, recipient_id):
+                        await manager.send_personal_message(
+                            {"type": "user_typing", "sender_id": user.id}, 
+                            recipient_id
+                        )
+                    continue
+
+                # --- ЛОГИКА: ПРОЧИТАНО ---
+                elif msg_type == "read_messages":
+                    # Запись в БД и уведомление отправителя — пакетом, раз в READ_FLUSH_INTERVAL_SECONDS
+                    coalescer.mark_read(user.id, frame.sender_id, frame.up_to_id)
+                    continue
+
+                # --- ЛОГИКА: УДАЛЕНИЕ ---
+                elif msg_type == "delete_message":
+                    msg_id = frame.message_id
+                    update_payload = {"type": "message_deleted", "id": msg_id}
+                    seqs = None
+                    async with AsyncSessionLocal() as db:
+                        msg_to_delete = await db.get(models.Message, msg_id)
+                        if msg_to_delete and msg_to_delete.sender_id == user.id:
+                            recipient_id = msg_to_delete.recipient_id
+                            await db.run_sync(conversations.on_message_deleted, msg_to_delete)
+                            await db.delete(msg_to_delete)
+                            seqs = await db.run_sync(events.record, [(user.id, update_payload), (recipient_id, update_payload)])
+                            await db.commit()
+                    # Рассылка — уже после возврата соединения в пул
+                    if seqs:
+                        await response_cache.invalidate_messages([(user.id, recipient_id)])
+                        await manager.send_personal_message({**update_payload, "seq": seqs[0]}, user.id)
+                        await manager.send_personal_message({**update_payload, "seq": seqs[1]}, recipient_id)
+                    continue
+
+                # --- ЛОГИКА: РЕДАКТИРОВАНИЕ ---
+                elif msg_type == "edit_message":
+                    msg_id = frame.message_id
+                    update_payload = {"type": "message_edited", "id": msg_id, "content": frame.new_content}
+                    seqs = None
+                    async with AsyncSessionLocal() as db:
+                        msg_to_edit = await db.get(models.Message, msg_id)
+                        if msg_to_edit and msg_to_edit.sender_id == user.id:
+                            msg_to_edit.content = frame.new_content
+                            recipient_id = msg_to_edit.recipient_id
+                            seqs = await db.run_sync(events.record, [(user.id, update_payload), (recipient_id, update_payload)])
+                            await db.commit()
+                    if seqs:
+                        await response_cache.invalidate_messages([(user.id, recipient_id)])
+                        await manager.send_personal_message({**update_payload, "seq": seqs[0]}, user.id)
+                        await manager.send_personal_message({**update_payload, "seq": seqs[1]}, recipient_id)
+                    continue
+
+                # --- ЛОГИКА: ОБЫЧНОЕ СООБЩЕНИЕ (С ОТВЕТОМ) ---
+                # Запись пачкой с сообщениями других сокетов; new_message (с id и timestamp)
+                # придёт отправителю и получателю после commit пачки
+                await ingestor.submit(PendingMessage(
+                    sender_id=user.id,
+                    recipient_id=frame.recipient_id,
+                    content=frame.content,
+                    reply_to_id=frame.reply_to_id,
+                    client_id=frame.client_id,
+                ))
 
     except WebSocketDisconnect:
-        is_offline = manager.disconnect(websocket, user.id)
-        if is_offline:
-            await manager.broadcast_status(user.id, "offline")
+        pass
+    finally:
+        # Любой выход из цикла (в т.ч. закрытие медленного клиента сервером) освобождает сокет
+        last_local = await manager.disconnect(websocket, user.id)
+        await presence.user_disconnected(user.id, last_local)
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime, Date, ForeignKey, Text, Boolean 
+from sqlalchemy import BigInteger, Column, Integer, String, DateTime, Date, ForeignKey, Text, Boolean, Index, JSON, UniqueConstraint
 from sqlalchemy.sql import func
 from sqlalchemy.orm import relationship
 from database import Base
@@ -35,9 +35,11 @@ class Message(Base):
     content = Column(Text, nullable=False)
     is_encrypted = Column(Boolean, default=False)
     is_read = Column(Boolean, default=False)
-    timestamp = Column(DateTime(timezone=True), server_default=func.now(), index=True)
+    # Ключ секционирования в PostgreSQL (partitions.py), поэтому NOT NULL
+    timestamp = Column(DateTime(timezone=True), server_default=func.now(), nullable=False, index=True)
 
     # --- ОТВЕТЫ (REPLY) ---
+    # В секционированной messages FK существует только в метаданных ORM (см. partitions.py)
     reply_to_id = Column(Integer, ForeignKey("messages.id"), nullable=True)
 
     sender = relationship("User", foreign_keys=[sender_id], back_populates="sent_messages")
@@ -45,3 +47,121 @@ class Message(Base):
     
     # Связь с самим собой
     reply_to = relationship("Message", remote_side=[id], backref="replies")
+
+    __table_args__ = (
+        # История диалога: keyset-пагинация "сообщения пары до id X" без сортировки
+        Index("ix_messages_pair_id", "sender_id", "recipient_id", "id"),
+    )
+
+
+class Conversation(Base):
+    """Денормализованный диалог: одна строка на пару пользователей.
+
+    Пара хранится канонически (user_low_id < user_high_id), поэтому оба направления
+    переписки ссылаются на одну запись. Поддерживается в тех же транзакциях, что и
+    запись сообщений (см. conversations.py).
+    """
+    __tablename__ = "conversations"
+
+    id = Column(Integer, primary_key=True, index=True)
+
+    user_low_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    user_high_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+
+    last_message_id = Column(Integer, ForeignKey("messages.id", ondelete="SET NULL"), nullable=True)
+    last_activity = Column(DateTime(timezone=True), server_default=func.now())
+
+    # Непрочитанные сообщения, адресованные соответствующей стороне
+    unread_low = Column(Integer, nullable=False, default=0, server_default="0")
+    unread_high = Column(Integer, nullable=False, default=0, server_default="0")
+
+    __table_args__ = (
+        UniqueConstraint("user_low_id", "user_high_id", name="uq_conversations_pair"),
+        # Список чатов: "мои диалоги, отсортированные по последнему сообщению"
+        Index("ix_conversations_low_last", "user_low_id", "last_message_id"),
+        Index("ix_conversations_high_last", "user_high_id", "last_message_id"),
+    )
+
+
+class Upload(Base):
+    """Файл, загруженный пользователем. Сам файл хранится по sha256 содержимого
+    (static/uploads/<sha256>.<ext>), поэтому одинаковые файлы лежат на диске один раз;
+    строка на пользователя нужна для учёта квоты."""
+    __tablename__ = "uploads"
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
+    sha256 = Column(String(64), nullable=False, index=True)
+    stored_name = Column(String, nullable=False)
+    size = Column(BigInteger, nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+    __table_args__ = (
+        UniqueConstraint("user_id", "sha256", name="uq_uploads_user_sha"),
+    )
+
+
+class UploadSession(Base):
+    """Незавершённая докачиваемая загрузка (части пишутся в uploads.PARTIAL_DIR/<id>)."""
+    __tablename__ = "upload_sessions"
+
+    id = Column(String(32), primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
+    filename = Column(String, nullable=False)
+    size = Column(BigInteger, nullable=False)
+    received = Column(BigInteger, nullable=False, default=0)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+
+class EventSequence(Base):
+    """Счётчик событий пользователя. last_seq — номер последнего события,
+    floor_seq — последний номер, удалённый при компактизации журнала."""
+    __tablename__ = "event_sequences"
+
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    last_seq = Column(BigInteger, nullable=False, default=0, server_default="0")
+    floor_seq = Column(BigInteger, nullable=False, default=0, server_default="0")
+
+
+class UserEvent(Base):
+    """Журнал событий пользователя (new_message, message_edited, ...) для догоняющей
+    синхронизации после переподключения. payload — кадр, ушедший по /ws, без текста
+    сообщений (его подставляет sync, см. events.py)."""
+    __tablename__ = "user_events"
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    seq = Column(BigInteger, nullable=False)
+    payload = Column(JSON, nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), index=True)
+
+    __table_args__ = (
+        UniqueConstraint("user_id", "seq", name="uq_user_events_user_seq"),
+    )
+
+
+class ImportJob(Base):
+    """Импорт переписки из файла экспорта (exports.import_file). Каждая пачка фиксируется
+    своим commit, счётчики обновляются вместе с ней."""
+    __tablename__ = "import_jobs"
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
+    # running / done / failed
+    status = Column(String(16), nullable=False, default="running")
+    imported = Column(Integer, nullable=False, default=0)
+    skipped = Column(Integer, nullable=False, default=0)
+    # Пропущенные строки по причинам (exports.SKIP_REASONS): {"received": 12, ...}
+    skipped_by_reason = Column(JSON, nullable=False, default=dict)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    finished_at = Column(DateTime(timezone=True), nullable=True)
+
+
+class ImportedMessage(Base):
+    """Соответствие id сообщения в файле экспорта и id созданного сообщения: по нему
+    переставляются reply_to_id между пачками. Без FK на messages (см. partitions.py)."""
+    __tablename__ = "imported_messages"
+
+    job_id = Column(Integer, ForeignKey("import_jobs.id"), primary_key=True)
+    old_id = Column(BigInteger, primary_key=True)
+    new_id = Column(Integer, nullable=False)
@@ -0,0 +1,383 @@
+"""Помесячное секционирование messages (PostgreSQL) и архивирование старых секций.
+
+Включается MESSAGE_PARTITIONING=monthly; на SQLite все функции ничего не делают.
+Подробности и ограничения — в README.md, раздел «Секционирование messages».
+
+Запуск вручную: python partitions.py migrate | maintain
+"""
+import argparse
+import asyncio
+import logging
+import os
+import re
+from datetime import datetime, timezone
+
+from sqlalchemy import text
+from sqlalchemy.schema import CreateIndex
+
+import models
+import search
+
+logger = logging.getLogger(__name__)
+
+MESSAGE_PARTITIONING = os.getenv("MESSAGE_PARTITIONING", "none")
+PARTITION_PREMAKE_MONTHS = int(os.getenv("PARTITION_PREMAKE_MONTHS", "2"))
+ARCHIVE_AFTER_MONTHS = int(os.getenv("ARCHIVE_AFTER_MONTHS", "6"))
+ARCHIVE_TABLESPACE = os.getenv("ARCHIVE_TABLESPACE") or None
+PARTITION_MAINTENANCE_INTERVAL_SECONDS = float(os.getenv("PARTITION_MAINTENANCE_INTERVAL_SECONDS", "86400"))
+
+LEGACY_PARTITION = "messages_legacy"
+DEFAULT_PARTITION = "messages_default"
+ARCHIVED_COMMENT = "archived"
+# Один воркер мигрирует/обслуживает секции, остальные пропускают ход
+_ADVISORY_LOCK_ID = 7_302_114
+
+_BOUND_RE = re.compile(r"TO \('([^']+)'\)")
+_LOWER_RE = re.compile(r"FROM \('([^']+)'\)")
+_INDEX_DEF_RE = re.compile(r"^CREATE (UNIQUE )?INDEX \S+ ON (?:ONLY )?\S+ (.*)$")
+
+
+def enabled(engine) -> bool:
+    return engine.dialect.name == "postgresql" and MESSAGE_PARTITIONING == "monthly"
+
+
+def _month_start(moment: datetime, shift: int = 0) -> datetime:
+    index = moment.year * 12 + moment.month - 1 + shift
+    return datetime(index // 12, index % 12 + 1, 1, tzinfo=timezone.utc)
+
+
+def _partition_name(start: datetime) -> str:
+    return f"messages_p{start.year:04d}_{start.month:02d}"
+
+
+def _literal(moment: datetime) -> str:
+    return f"'{moment.isoformat()}'"
+
+
+def is_partitioned(conn) -> bool:
+    return conn.execute(text(
+        "SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass('messages')"
+    )).first() is not None
+
+
+def list_partitions(conn) -> list[dict]:
+    """Секции messages: имя, границы (None у default и у MINVALUE), архивная ли."""
+    conn.execute(text("SET LOCAL TimeZone = 'UTC'"))
+    rows = conn.execute(text("""
+        SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) AS bound, obj_description(c.oid, 'pg_class') AS note
+        FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'messages'::regclass
+    """)).all()
+    partitions = []
+    for name, bound, note in rows:
+        match = _BOUND_RE.search(bound)
+        upper = datetime.fromisoformat(match.group(1)) if match else None
+        match = _LOWER_RE.search(bound)
+        lower = datetime.fromisoformat(match.group(1)) if match else None
+        partitions.append({"name": name, "lower": lower, "upper": upper, "archived": note == ARCHIVED_COMMENT})
+    return sorted(partitions, key=lambda p: (p["upper"] is None, p["upper"]))
+
+
+def lowest_bound(conn) -> datetime | None:
+    """Начало самой ранней секции: более старые строки попали бы в messages_default.
+    None — ограничения нет (секционирование выключено или есть секция от MINVALUE,
+    например messages_legacy)."""
+    if not enabled(conn.engine) or not is_partitioned(conn):
+        return None
+    ranged = [p for p in list_partitions(conn) if p["upper"] is not None]
+    if not ranged or any(p["lower"] is None for p in ranged):
+        return None
+    return min(p["lower"] for p in ranged)
+
+
+def ensure_partitions(conn, now: datetime | None = None) -> list[str]:
+    """Создаёт секции от последней существующей до текущего месяца + PARTITION_PREMAKE_MONTHS.
+
+    Секции нужно создавать заранее: строки месяца без своей секции попадают в
+    messages_default, и создать секцию поверх них PostgreSQL уже не даст. Если такие
+    строки всё же есть (обслуживание долго не запускалось), они переносятся в новую
+    секцию до её подключения.
+    """
+    now = now or datetime.now(timezone.utc)
+    uppers = [p["upper"] for p in list_partitions(conn) if p["upper"] is not None]
+    start = max(uppers) if uppers else _month_start(now)
+    until = _month_start(now, PARTITION_PREMAKE_MONTHS + 1)
+    has_default = conn.execute(text(f"SELECT to_regclass('{DEFAULT_PARTITION}')")).scalar() is not None
+    created = []
+    while start < until:
+        end = _month_start(start, 1)
+        name = _partition_name(start)
+        if has_default and _default_has_rows(conn, start, end):
+            _move_from_default(conn, name, start, end)
+        else:
+            conn.execute(text(
+                f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF messages "
+                f"FOR VALUES FROM ({_literal(start)}) TO ({_literal(end)})"
+            ))
+        created.append(name)
+        start = end
+    conn.execute(text(f"CREATE TABLE IF NOT EXISTS {DEFAULT_PARTITION} PARTITION OF messages DEFAULT"))
+    return created
+
+
+def _default_has_rows(conn, start: datetime, end: datetime) -> bool:
+    return conn.execute(text(
+        f'SELECT 1 FROM {DEFAULT_PARTITION} WHERE "timestamp" >= {_literal(start)} '
+        f'AND "timestamp" < {_literal(end)} LIMIT 1'
+    )).first() is not None
+
+
+def _move_from_default(conn, name: str, start: datetime, end: datetime):
+    """Секция месяца из строк, уже попавших в messages_default: отдельная таблица,
+    перенос строк, затем ATTACH (default проверяется уже без них)."""
+    columns = ", ".join(f'"{column.name}"' for column in models.Message.__table__.columns)
+    in_range = f'"timestamp" >= {_literal(start)} AND "timestamp" < {_literal(end)}'
+    # Вставка в default ждёт переноса: иначе новая строка месяца помешала бы ATTACH
+    conn.execute(text(f"LOCK TABLE {DEFAULT_PARTITION} IN SHARE ROW EXCLUSIVE MODE"))
+    conn.execute(text(f"CREATE TABLE {name} (LIKE messages INCLUDING DEFAULTS INCLUDING GENERATED)"))
+    moved = conn.execute(text(
+        f"WITH moved AS (DELETE FROM {DEFAULT_PARTITION} WHERE {in_range} RETURNING {columns}) "
+        f"INSERT INTO {name} ({columns}) SELECT {columns} FROM moved"
+    )).rowcount
+    conn.execute(text(f"ALTER TABLE {name} ADD CONSTRAINT {name}_bounds CHECK ({in_range})"))
+    conn.execute(text(
+        f"ALTER TABLE messages ATTACH PARTITION {name} FOR VALUES FROM ({_literal(start)}) TO ({_literal(end)})"
+    ))
+    conn.execute(text(f"ALTER TABLE {name} DROP CONSTRAINT {name}_bounds"))
+    logger.warning("Секция %s создана из %s строк, попавших в %s", name, moved, DEFAULT_PARTITION)
+
+
+# --- переход с обычной таблицы ---
+
+def migrate(engine, now: datetime | None = None):
+    """Превращает обычную messages в секционированную. Идемпотентна."""
+    now = now or datetime.now(timezone.utc)
+    # Всё до начала месяца после следующего остаётся в старой таблице: CHECK начинает
+    # действовать для новых вставок сразу, и запас в месяц исключает отказ на смене месяца
+    cutoff = _month_start(now, 2)
+
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        if is_partitioned(conn):
+            return
+        conn.execute(text('UPDATE messages SET "timestamp" = now() WHERE "timestamp" IS NULL'))
+        has_check = conn.execute(text(
+            "SELECT 1 FROM pg_constraint WHERE conname = 'messages_legacy_bounds'"
+        )).first()
+        if not has_check:
+            conn.execute(text(
+                'ALTER TABLE messages ADD CONSTRAINT messages_legacy_bounds '
+                f'CHECK ("timestamp" IS NOT NULL AND "timestamp" < {_literal(cutoff)}) NOT VALID'
+            ))
+        # Проверка существующих строк под SHARE UPDATE EXCLUSIVE: чтение и запись не блокируются
+        conn.execute(text("ALTER TABLE messages VALIDATE CONSTRAINT messages_legacy_bounds"))
+        conn.execute(text(
+            'CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS messages_legacy_id_timestamp_key '
+            'ON messages (id, "timestamp")'
+        ))
+
+    with engine.begin() as conn:
+        conn.execute(text("SELECT pg_advisory_xact_lock(:id)"), {"id": _ADVISORY_LOCK_ID})
+        if is_partitioned(conn):
+            return
+        # Граница из CHECK, а не из cutoff: CHECK мог остаться от прерванного прошлого запуска
+        conn.execute(text("SET LOCAL TimeZone = 'UTC'"))
+        check = conn.execute(text(
+            "SELECT pg_get_constraintdef(oid) FROM pg_constraint WHERE conname = 'messages_legacy_bounds'"
+        )).scalar_one()
+        cutoff = datetime.fromisoformat(re.search(r"< '([^']+)'", check).group(1))
+        conn.execute(text("LOCK TABLE messages IN ACCESS EXCLUSIVE MODE"))
+        # Без сканирования: NOT NULL следует из проверенного CHECK
+        conn.execute(text('ALTER TABLE messages ALTER COLUMN "timestamp" SET NOT NULL'))
+
+        foreign_keys = conn.execute(text("""
+            SELECT conrelid::regclass::text, conname FROM pg_constraint
+            WHERE contype = 'f' AND confrelid = 'messages'::regclass
+        """)).all()
+        for table_name, constraint in foreign_keys:
+            conn.execute(text(f'ALTER TABLE {table_name} DROP CONSTRAINT "{constraint}"'))
+        primary_key = conn.execute(text(
+            "SELECT conname FROM pg_constraint WHERE contype = 'p' AND conrelid = 'messages'::regclass"
+        )).scalar()
+        if primary_key:
+            conn.execute(text(f'ALTER TABLE messages DROP CONSTRAINT "{primary_key}"'))
+        # Ключ секции — на готовом индексе (без сканирования): ATTACH подключит его к
+        # messages_pkey только как ограничение, обычный уникальный индекс он построил бы заново
+        conn.execute(text(
+            "ALTER TABLE messages ADD CONSTRAINT messages_legacy_pkey "
+            "PRIMARY KEY USING INDEX messages_legacy_id_timestamp_key"
+        ))
+
+        # Имена индексов освобождаются для родительской таблицы; одинаковые по определению
+        # индексы CREATE INDEX на родителе потом подключит, а не построит заново
+        indexes = conn.execute(text(
+            "SELECT indexname FROM pg_indexes WHERE tablename = 'messages' "
+            "AND indexname <> 'messages_legacy_pkey'"
+        )).scalars().all()
+        for index in indexes:
+            conn.execute(text(f'ALTER INDEX "{index}" RENAME TO "{index[:55]}_legacy"'))
+
+        sequence = conn.execute(text("SELECT pg_get_serial_sequence('messages', 'id')")).scalar()
+        conn.execute(text(f"ALTER TABLE messages RENAME TO {LEGACY_PARTITION}"))
+        conn.execute(text(
+            f"CREATE TABLE messages (LIKE {LEGACY_PARTITION} INCLUDING DEFAULTS INCLUDING GENERATED) "
+            'PARTITION BY RANGE ("timestamp")'
+        ))
+        if sequence:
+            conn.execute(text(f"ALTER SEQUENCE {sequence} OWNED BY messages.id"))
+        conn.execute(text('ALTER TABLE messages ADD CONSTRAINT messages_pkey PRIMARY KEY (id, "timestamp")'))
+        conn.execute(text(
+            f"ALTER TABLE messages ATTACH PARTITION {LEGACY_PARTITION} "
+            f"FOR VALUES FROM (MINVALUE) TO ({_literal(cutoff)})"
+        ))
+        conn.execute(text(f"ALTER TABLE {LEGACY_PARTITION} DROP CONSTRAINT messages_legacy_bounds"))
+        for index in models.Message.__table__.indexes:
+            conn.execute(CreateIndex(index, if_not_exists=True))
+        # Поисковый индекс — только если он уже был (search.migrate): тогда индекс секции
+        # подключается; иначе его построит search.migrate, не под этой блокировкой
+        for name, (table_name, definition) in search.POSTGRES_INDEXES.items():
+            if table_name == "messages" and name in indexes:
+                conn.execute(text(f"CREATE INDEX IF NOT EXISTS {name} ON messages {definition}"))
+        ensure_partitions(conn, now)
+    logger.info("messages секционирована по месяцам, старые данные — секция %s до %s", LEGACY_PARTITION, cutoff)
+
+
+def setup(engine):
+    """Вызывается при старте после create_all."""
+    if not enabled(engine):
+        return
+    migrate(engine)
+    with engine.begin() as conn:
+        ensure_partitions(conn)
+
+
+# --- архивирование ---
+
+def _archive_partition(engine, partition: dict):
+    name = partition["name"]
+    staging = f"{name}_archive"
+    tablespace = f" TABLESPACE {ARCHIVE_TABLESPACE}" if ARCHIVE_TABLESPACE else ""
+    columns = ", ".join(f'"{column.name}"' for column in models.Message.__table__.columns)
+    # content || '' — новое значение, а не готовый TOAST-указатель: иначе INSERT
+    # скопирует его со старым сжатием (или вовсе без него)
+    values = ", ".join(
+        "content || ''" if column.name == "content" else f'"{column.name}"'
+        for column in models.Message.__table__.columns
+    )
+
+    with engine.begin() as conn:
+        conn.execute(text("SET LOCAL TimeZone = 'UTC'"))
+        bound = conn.execute(text(
+            "SELECT pg_get_expr(relpartbound, oid) FROM pg_class WHERE relname = :name"
+        ), {"name": name}).scalar_one()
+        # Запись в холодную секцию ждёт окончания копирования, чтение — нет
+        conn.execute(text(f"LOCK TABLE {name} IN SHARE MODE"))
+        conn.execute(text(f"DROP TABLE IF EXISTS {staging}"))
+        conn.execute(text(
+            f"CREATE TABLE {staging} (LIKE messages INCLUDING DEFAULTS INCLUDING GENERATED) "
+            f"WITH (toast_tuple_target = 128, fillfactor = 100){tablespace}"
+        ))
+        if conn.dialect.server_version_info >= (14,):
+            conn.execute(text(f"ALTER TABLE {staging} ALTER COLUMN content SET COMPRESSION lz4"))
+        conn.execute(text(f"INSERT INTO {staging} ({columns}) SELECT {values} FROM {name}"))
+
+        # Те же индексы, что у родителя: ATTACH подключит их без перестроения.
+        # Индекс первичного ключа подключается только как ограничение — PRIMARY KEY USING INDEX
+        definitions = conn.execute(text(
+            "SELECT pg_get_indexdef(indexrelid), indisprimary FROM pg_index WHERE indrelid = 'messages'::regclass"
+        )).all()
+        for number, (definition, is_primary) in enumerate(definitions):
+            match = _INDEX_DEF_RE.match(definition)
+            conn.execute(text(
+                f"CREATE {match.group(1) or ''}INDEX {staging}_{number}_idx ON {staging} {match.group(2)}{tablespace}"
+            ))
+            if is_primary:
+                conn.execute(text(
+                    f"ALTER TABLE {staging} ADD CONSTRAINT {staging}_pkey PRIMARY KEY USING INDEX {staging}_{number}_idx"
+                ))
+        # Ограничение секции заранее как CHECK: ATTACH не будет сканировать таблицу
+        constraint = conn.execute(text(
+            "SELECT pg_get_partition_constraintdef(CAST(:name AS regclass))"
+        ), {"name": name}).scalar_one()
+        conn.execute(text(f"ALTER TABLE {staging} ADD CONSTRAINT {staging}_bounds CHECK ({constraint})"))
+
+        conn.execute(text(f"ALTER TABLE messages DETACH PARTITION {name}"))
+        conn.execute(text(f"ALTER TABLE messages ATTACH PARTITION {staging} {bound}"))
+        conn.execute(text(f"ALTER TABLE {staging} DROP CONSTRAINT {staging}_bounds"))
+        conn.execute(text(f"DROP TABLE {name}"))
+        conn.execute(text(f"ALTER TABLE {staging} RENAME TO {name}"))
+        conn.execute(text(f"COMMENT ON TABLE {name} IS '{ARCHIVED_COMMENT}'"))
+
+    # Данные больше почти не меняются: после заморозки автоочистка пропускает страницы секции
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.execute(text(f"VACUUM (FREEZE, ANALYZE) {name}"))
+
+
+def archive_cold(engine, now: datetime | None = None) -> list[str]:
+    """Архивирует секции, закончившиеся раньше ARCHIVE_AFTER_MONTHS месяцев назад."""
+    boundary = _month_start(now or datetime.now(timezone.utc), -ARCHIVE_AFTER_MONTHS)
+    with engine.begin() as conn:
+        cold = [
+            p for p in list_partitions(conn)
+            if p["upper"] is not None and p["upper"] <= boundary and not p["archived"]
+        ]
+    for partition in cold:
+        _archive_partition(engine, partition)
+        logger.info("Секция %s перенесена в архив", partition["name"])
+    return [p["name"] for p in cold]
+
+
+def maintain(engine) -> bool:
+    """Создаёт будущие секции и архивирует холодные. False — обслуживанием занят другой воркер."""
+    # Блокировка на уровне сессии, без открытой транзакции: та мешала бы VACUUM FREEZE
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as lock_conn:
+        if not lock_conn.execute(text("SELECT pg_try_advisory_lock(:id)"), {"id": _ADVISORY_LOCK_ID}).scalar():
+            return False
+        try:
+            with engine.begin() as conn:
+                ensure_partitions(conn)
+            archive_cold(engine)
+        finally:
+            lock_conn.execute(text("SELECT pg_advisory_unlock(:id)"), {"id": _ADVISORY_LOCK_ID})
+    return True
+
+
+class PartitionMaintenance:
+    """Фоновое обслуживание секций раз в PARTITION_MAINTENANCE_INTERVAL_SECONDS."""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self._task: asyncio.Task | None = None
+
+    async def start(self):
+        if enabled(self.engine):
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+
+    async def _loop(self):
+        while True:
+            try:
+                # DDL и перезапись секций — синхронные и долгие, не держим цикл событий
+                await asyncio.to_thread(maintain, self.engine)
+            except Exception:
+                logger.exception("Не удалось обслужить секции messages")
+            await asyncio.sleep(PARTITION_MAINTENANCE_INTERVAL_SECONDS)
+
+
+if __name__ == "__main__":
+    from database import engine
+
+    parser = argparse.ArgumentParser(description="Секционирование messages (PostgreSQL)")
+    parser.add_argument("command", choices=["migrate", "maintain"])
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if engine.dialect.name != "postgresql":
+        parser.exit(message="Секционирование поддерживается только для PostgreSQL\n")
+    if args.command == "migrate":
+        migrate(engine)
+        with engine.begin() as conn:
+            ensure_partitions(conn)
+    else:
+        maintain(engine)
@@ -0,0 +1,94 @@
+"""Присутствие (online/offline), видимое только собеседникам.
+
+Статус пользователя рассылается лишь тем, с кем у него есть диалог (таблица
+conversations), а не всем сокетам сервера. Уход в офлайн откладывается на
+PRESENCE_GRACE_SECONDS: если клиент переподключился за это время (обрыв сети,
+перезапуск сервера), собеседники не увидят ни "offline", ни повторного "online".
+Всё это время пользователь остаётся учтённым в брокере, поэтому и /users,
+и /presence показывают его онлайн.
+"""
+import asyncio
+import os
+
+from sqlalchemy import case, or_, select
+
+import models
+from connections import ConnectionManager
+
+PRESENCE_GRACE_SECONDS = float(os.getenv("PRESENCE_GRACE_SECONDS", "5"))
+
+
+class PresenceService:
+    def __init__(self, manager: ConnectionManager, session_factory, grace_seconds: float = PRESENCE_GRACE_SECONDS):
+        self.manager = manager
+        self.session_factory = session_factory
+        self.grace_seconds = grace_seconds
+        # user_id -> отложенная рассылка "offline"
+        self._pending_offline: dict[int, asyncio.Task] = {}
+        # Воркер с сокетами пользователя упал: брокер сам снял его со счётчиков
+        manager.broker.on_presence_expired = self._expired
+
+    async def user_connected(self, user_id: int, first_local: bool):
+        """first_local — у этого воркера появился первый сокет пользователя."""
+        pending = self._pending_offline.pop(user_id, None)
+        if pending is not None:
+            # Переподключение в пределах окна: пользователь всё ещё учтён в брокере,
+            # для собеседников он и не уходил
+            pending.cancel()
+            return
+        if first_local and await self.manager.broker.presence_join(user_id):
+            await self.notify_contacts(user_id, "online")
+
+    async def user_disconnected(self, user_id: int, last_local: bool):
+        """last_local — у этого воркера не осталось сокетов пользователя."""
+        if not last_local:
+            return
+        if self.grace_seconds <= 0:
+            await self._leave(user_id)
+            return
+        self._pending_offline[user_id] = asyncio.create_task(self._leave_after_grace(user_id))
+
+    async def _leave_after_grace(self, user_id: int):
+        await asyncio.sleep(self.grace_seconds)
+        self._pending_offline.pop(user_id, None)
+        await self._leave(user_id)
+
+    async def _leave(self, user_id: int):
+        # Брокер скажет "офлайн" только если пользователя нет ни на одном воркере
+        if await self.manager.broker.presence_leave(user_id):
+            await self.notify_contacts(user_id, "offline")
+
+    async def _expired(self, user_id: int):
+        await self.notify_contacts(user_id, "offline")
+
+    async def contact_ids(self, user_id: int, among: list[int] | None = None) -> list[int]:
+        """Собеседники пользователя; с among — только те из них, кто есть в among."""
+        conv = models.Conversation
+        partner = case((conv.user_low_id == user_id, conv.user_high_id), else_=conv.user_low_id)
+        query = select(partner).where(or_(conv.user_low_id == user_id, conv.user_high_id == user_id))
+        if among is not None:
+            query = query.where(partner.in_(among))
+        async with self.session_factory() as db:
+            rows = await db.scalars(query)
+            return [uid for uid in rows if uid != user_id]
+
+    async def notify_contacts(self, user_id: int, status: str):
+        contacts = await self.contact_ids(user_id)
+        # Кадр нужен только тем собеседникам, кто сейчас подключен
+        online_contacts = await self.manager.online_users(contacts)
+        if not online_contacts:
+            return
+        message = {"type": "status_update", "user_id": user_id, "status": status}
+        await asyncio.gather(*(self.manager.send_personal_message(message, uid) for uid in online_contacts))
+
+    async def batch_status(self, viewer_id: int, user_ids: list[int]) -> dict[int, bool]:
+        """Статусы тех из user_ids, кто собеседник viewer_id; остальные (в том числе
+        несуществующие id) в ответ не попадают — статус чужих пользователей не раскрывается."""
+        contacts = set(await self.contact_ids(viewer_id, among=user_ids))
+        online = await self.manager.online_users(list(contacts))
+        return {uid: uid in online for uid in user_ids if uid in contacts}
+
+    async def stop(self):
+        for task in self._pending_offline.values():
+            task.cancel()
+        self._pending_offline.clear()
@@ -0,0 +1,217 @@
+"""Кэш ответов GET /messages/{user_id} (страницы диалога) и GET /users (список чатов).
+
+Записи привязаны к версии области (conv:{low}:{high}, chats:{user_id}); инвалидация —
+подъём версии после commit. Ответы отдаются с ETag, при совпадении If-None-Match — 304.
+Бэкенд задаёт RESPONSE_CACHE_URL (memory://, redis://, none://) — см. README.md.
+"""
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+
+from identity import TTLCache
+
+logger = logging.getLogger(__name__)
+
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "10000"))
+RESPONSE_CACHE_TTL_SECONDS = int(os.getenv("RESPONSE_CACHE_TTL_SECONDS", "300"))
+# Сколько версий областей помнит кэш в памяти
+RESPONSE_CACHE_VERSIONS_SIZE = int(os.getenv("RESPONSE_CACHE_VERSIONS_SIZE", "100000"))
+REPLICA_LAG_SECONDS = float(os.getenv("REPLICA_LAG_SECONDS", "5"))
+
+
+def conversation_scope(a: int, b: int) -> str:
+    low, high = (a, b) if a < b else (b, a)
+    return f"conv:{low}:{high}"
+
+
+def chat_list_scope(user_id: int) -> str:
+    return f"chats:{user_id}"
+
+
+def etag_for(body: bytes) -> str:
+    return '"' + hashlib.sha1(body).hexdigest()[:20] + '"'
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    candidates = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates
+
+
+class ResponseCache:
+    """Интерфейс бэкенда. Значения — dict, сериализуемые в JSON."""
+
+    async def versions(self, scopes: list[str]) -> list[tuple[int, float | None]]:
+        """(версия, время последнего bump по time.time() или None, если неизвестно)."""
+        raise NotImplementedError
+
+    async def bump(self, *scopes: str):
+        raise NotImplementedError
+
+    async def get(self, key: str) -> dict | None:
+        raise NotImplementedError
+
+    async def set(self, key: str, value: dict):
+        raise NotImplementedError
+
+    async def lookup(self, scopes: list[str], *params) -> tuple[str, bool]:
+        """Ключ записи (текущие версии областей + параметры запроса) и True, если версию
+        какой-то области подняли меньше REPLICA_LAG_SECONDS назад: тогда заполнять
+        запись нужно с основной БД, а не с реплики."""
+        versions = await self.versions(scopes)
+        parts = [f"{scope}@{version}" for scope, (version, _) in zip(scopes, versions)]
+        now = time.time()
+        recent = any(bumped_at is not None and now - bumped_at < REPLICA_LAG_SECONDS for _, bumped_at in versions)
+        return "|".join(parts + [str(param) for param in params]), recent
+
+
+class MemoryResponseCache(ResponseCache):
+    def __init__(
+        self,
+        maxsize: int = RESPONSE_CACHE_SIZE,
+        ttl: float = RESPONSE_CACHE_TTL_SECONDS,
+        versions_size: int = RESPONSE_CACHE_VERSIONS_SIZE,
+    ):
+        self._entries = TTLCache(maxsize, ttl)
+        # scope -> (версия, время bump); LRU, хранится только поднятая хотя бы раз версия
+        self._versions: OrderedDict[str, tuple[int, float]] = OrderedDict()
+        self._versions_size = versions_size
+        self._clock = 0
+        # Наибольшая забытая версия — версия по умолчанию для всех неизвестных областей
+        self._floor = 0
+
+    async def versions(self, scopes: list[str]) -> list[tuple[int, float | None]]:
+        result = []
+        for scope in scopes:
+            item = self._versions.get(scope)
+            if item is None:
+                result.append((self._floor, None))
+            else:
+                self._versions.move_to_end(scope)
+                result.append(item)
+        return result
+
+    async def bump(self, *scopes: str):
+        now = time.time()
+        for scope in scopes:
+            self._clock += 1
+            self._versions[scope] = (self._clock, now)
+            self._versions.move_to_end(scope)
+        while len(self._versions) > self._versions_size:
+            _, (version, _) = self._versions.popitem(last=False)
+            self._floor = max(self._floor, version)
+
+    async def get(self, key: str) -> dict | None:
+        return self._entries.get(key)
+
+    async def set(self, key: str, value: dict):
+        self._entries.set(key, value)
+
+
+class RedisResponseCache(ResponseCache):
+    PREFIX = "messenger:cache:"
+
+    def __init__(self, url: str):
+        try:
+            import redis.asyncio as redis
+        except ImportError as exc:
+            raise RuntimeError("RESPONSE_CACHE_URL указывает на Redis, но пакет redis не установлен") from exc
+        self._redis = redis.from_url(url, decode_responses=True)
+
+    async def versions(self, scopes: list[str]) -> list[tuple[int, float | None]]:
+        async with self._redis.pipeline(transaction=False) as pipe:
+            for scope in scopes:
+                pipe.hmget(f"{self.PREFIX}v:{scope}", "n", "t")
+            values = await pipe.execute()
+        return [(int(n) if n else 0, float(t) if t else None) for n, t in values]
+
+    async def bump(self, *scopes: str):
+        # Номер из общего счётчика; версия живёт дольше любой записи, сохранённой под ней
+        first = await self._redis.incrby(f"{self.PREFIX}clock", len(scopes)) - len(scopes) + 1
+        now = time.time()
+        async with self._redis.pipeline(transaction=False) as pipe:
+            for number, scope in enumerate(scopes):
+                key = f"{self.PREFIX}v:{scope}"
+                pipe.hset(key, mapping={"n": first + number, "t": now})
+                pipe.expire(key, 2 * RESPONSE_CACHE_TTL_SECONDS)
+            await pipe.execute()
+
+    async def get(self, key: str) -> dict | None:
+        value = await self._redis.get(f"{self.PREFIX}e:{key}")
+        return json.loads(value) if value else None
+
+    async def set(self, key: str, value: dict):
+        await self._redis.set(f"{self.PREFIX}e:{key}", json.dumps(value), ex=RESPONSE_CACHE_TTL_SECONDS)
+
+
+class DisabledResponseCache(ResponseCache):
+    async def versions(self, scopes: list[str]) -> list[tuple[int, float | None]]:
+        return [(0, None)] * len(scopes)
+
+    async def bump(self, *scopes: str):
+        pass
+
+    async def get(self, key: str) -> dict | None:
+        return None
+
+    async def set(self, key: str, value: dict):
+        pass
+
+
+def _multiple_workers() -> bool:
+    # WEB_CONCURRENCY — число воркеров uvicorn/gunicorn; Redis-брокер нужен только нескольким воркерам
+    workers = os.getenv("WEB_CONCURRENCY", "1")
+    broker_url = os.getenv("BROKER_URL", "")
+    return (workers.isdigit() and int(workers) > 1) or broker_url.startswith(("redis://", "rediss://"))
+
+
+def create_cache(url: str | None = None) -> ResponseCache:
+    if url is None:
+        url = os.getenv("RESPONSE_CACHE_URL") or os.getenv("REDIS_URL") or "memory://"
+    if url.startswith("redis://") or url.startswith("rediss://"):
+        return RedisResponseCache(url)
+    if url in ("", "memory://"):
+        if _multiple_workers():
+            logger.warning(
+                "Кэш ответов в памяти при нескольких воркерах: инвалидация не доходит до других "
+                "воркеров, они могут отдавать устаревшие страницы. Задайте RESPONSE_CACHE_URL=redis://..."
+            )
+        return MemoryResponseCache()
+    if url == "none://":
+        return DisabledResponseCache()
+    raise ValueError(f"Неизвестный RESPONSE_CACHE_URL: {url}")
+
+
+cache = create_cache()
+
+
+async def invalidate_messages(pairs):
+    """Новые, изменённые или удалённые сообщения пар (sender_id, recipient_id):
+    диалог пары и списки чатов обоих."""
+    scopes = set()
+    for sender_id, recipient_id in pairs:
+        scopes.update((conversation_scope(sender_id, recipient_id), chat_list_scope(sender_id), chat_list_scope(recipient_id)))
+    if scopes:
+        await cache.bump(*scopes)
+
+
+async def invalidate_reads(pairs):
+    """Прочтения пар (reader_id, sender_id): флаги is_read в диалоге и счётчик непрочитанных у читателя."""
+    scopes = set()
+    for reader_id, sender_id in pairs:
+        scopes.update((conversation_scope(reader_id, sender_id), chat_list_scope(reader_id)))
+    if scopes:
+        await cache.bump(*scopes)
+
+
+async def invalidate_profile(user_id: int, partner_ids: list[int]):
+    """Смена имени/аватара: списки чатов собеседников и диалоги (имя автора в цитатах)."""
+    scopes = set()
+    for partner_id in partner_ids:
+        scopes.update((chat_list_scope(partner_id), conversation_scope(user_id, partner_id)))
+    if scopes:
+        await cache.bump(*scopes)
@@ -1,5 +1,6 @@
-from pydantic import BaseModel, EmailStr
+from pydantic import BaseModel, EmailStr, Field, StrictBool, StrictInt, StrictStr
 from datetime import datetime, date
+from typing import Annotated, Literal, Union
 
 # --- USERS ---
 
@@ -30,11 +31,17 @@ class UserWithLastMessage(BaseModel):
     username: str
     last_message: str | None = None
     last_message_time: str | None = None
+    unread_count: int | None = None
     is_online: bool = False
     avatar_url: str | None = None
+    avatar_thumb_url: str | None = None
     phone_number: str | None = None
     birth_date: date | None = None
 
+class PresenceOut(BaseModel):
+    user_id: int
+    is_online: bool
+
 # --- AUTH ---
 
 class PasswordResetRequest(BaseModel):
@@ -76,3 +83,88 @@ class MessageOut(BaseModel):
 
     class Config:
         from_attributes = True
+
+# 4. Результат полнотекстового поиска: сообщение + подсвеченный фрагмент
+class MessageSearchHit(MessageOut):
+    snippet: str | None = None
+    rank: float = 0.0
+
+# 5. Итог импорта переписки из NDJSON
+class ImportResult(BaseModel):
+    job_id: int
+    imported: int
+    skipped: int
+    # Причина -> число строк (см. exports.SKIP_REASONS)
+    skipped_by_reason: dict[str, int] = {}
+
+# 6. Строки файла экспорта: типы проверяются строго, до записи первой пачки
+class ExportHeader(BaseModel):
+    type: Literal["export"]
+    version: Literal[1]
+    user_id: StrictInt
+
+class ExportedUser(BaseModel):
+    id: StrictInt
+    username: StrictStr
+
+class ExportedMessage(BaseModel):
+    id: StrictInt
+    sender_id: StrictInt
+    recipient_id: StrictInt
+    content: StrictStr = Field(..., min_length=1, max_length=10000)
+    is_encrypted: StrictBool = False
+    is_read: StrictBool = False
+    timestamp: datetime
+    reply_to_id: StrictInt | None = None
+
+# --- UPLOADS ---
+
+class UploadResult(BaseModel):
+    url: str
+
+class UploadSessionCreate(BaseModel):
+    filename: str
+    size: int = Field(..., gt=0)
+
+class UploadSessionOut(BaseModel):
+    upload_id: str
+    size: int
+    offset: int
+    chunk_size: int
+
+# --- WEBSOCKET: ВХОДЯЩИЕ КАДРЫ ---
+# Каждый кадр клиента проверяется по этим схемам до обработки (см. wire.parse_client_frame)
+
+class SyncFrame(BaseModel):
+    type: Literal["sync"]
+    since: int | None = None
+
+class TypingFrame(BaseModel):
+    type: Literal["typing"]
+    recipient_id: int
+
+class ReadMessagesFrame(BaseModel):
+    type: Literal["read_messages"]
+    sender_id: int
+    up_to_id: int | None = None
+
+class DeleteMessageFrame(BaseModel):
+    type: Literal["delete_message"]
+    message_id: int
+
+class EditMessageFrame(BaseModel):
+    type: Literal["edit_message"]
+    message_id: int
+    new_content: str = Field(..., min_length=1, max_length=10000)
+
+class NewMessageFrame(BaseModel):
+    type: Literal["message"] = "message"
+    recipient_id: int
+    content: str = Field(..., min_length=1, max_length=10000)
+    reply_to_id: int | None = None
+    client_id: str | None = Field(None, max_length=64)
+
+ClientFrame = Annotated[
+    Union[SyncFrame, TypingFrame, ReadMessagesFrame, DeleteMessageFrame, EditMessageFrame, NewMessageFrame],
+    Field(discriminator="type"),
+]
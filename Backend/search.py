@@ -0,0 +1,254 @@
+"""Полнотекстовый поиск по сообщениям и поиск пользователей.
+
+PostgreSQL — GIN-индексы (tsvector, pg_trgm), SQLite — FTS5-таблица messages_fts.
+Зашифрованные сообщения в индекс не попадают.
+
+Индексы PostgreSQL создаются вручную: python search.py migrate
+"""
+import html
+import logging
+import re
+
+from sqlalchemy import and_, column, func, literal_column, or_, table, text
+from sqlalchemy.orm import Session, joinedload
+
+import models
+
+logger = logging.getLogger(__name__)
+
+# Словарь без стемминга: в переписке смешаны русский, английский и сленг
+TS_CONFIG = "simple"
+# БД выделяет совпадения символами из области частного использования Unicode, а не тегами:
+# текст сообщения экранируется целиком, и только потом они заменяются на <mark>
+SNIPPET_START = "\ue000"
+SNIPPET_STOP = "\ue001"
+
+# Легковесное описание FTS5-таблицы для JOIN (в метаданных моделей её нет)
+_messages_fts = table("messages_fts", column("rowid"))
+
+# Выражение индекса и запросов должно совпадать дословно, иначе планировщик индекс не возьмёт
+SEARCH_VECTOR_SQL = (
+    "(CASE WHEN coalesce(messages.is_encrypted, false) THEN NULL "
+    f"ELSE to_tsvector('{TS_CONFIG}'::regconfig, messages.content) END)"
+)
+
+# имя индекса -> (таблица, определение после ON <таблица>)
+POSTGRES_INDEXES = {
+    "ix_messages_search_tsv": ("messages", f"USING gin ({SEARCH_VECTOR_SQL.replace('messages.', '')})"),
+    "ix_users_username_trgm": ("users", "USING gin (username gin_trgm_ops)"),
+    "ix_users_email_trgm": ("users", "USING gin (email gin_trgm_ops)"),
+}
+
+_SQLITE_DDL = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts
+    USING fts5(content, content='messages', content_rowid='id', tokenize='unicode61')
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS messages_fts_ai AFTER INSERT ON messages
+    WHEN NOT coalesce(new.is_encrypted, 0) BEGIN
+        INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS messages_fts_ad AFTER DELETE ON messages
+    WHEN NOT coalesce(old.is_encrypted, 0) BEGIN
+        INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+    END
+    """,
+    # Один триггер на UPDATE: порядок срабатывания нескольких триггеров в SQLite не гарантирован,
+    # а 'delete' старой версии обязан выполниться до вставки новой
+    """
+    CREATE TRIGGER IF NOT EXISTS messages_fts_au AFTER UPDATE OF content, is_encrypted ON messages BEGIN
+        INSERT INTO messages_fts(messages_fts, rowid, content)
+            SELECT 'delete', old.id, old.content WHERE NOT coalesce(old.is_encrypted, 0);
+        INSERT INTO messages_fts(rowid, content)
+            SELECT new.id, new.content WHERE NOT coalesce(new.is_encrypted, 0);
+    END
+    """,
+]
+
+
+def setup(engine):
+    """Вызывается при старте после create_all. SQLite: создаёт FTS5-таблицу и триггеры.
+    PostgreSQL: ничего не меняет в схеме, только предупреждает, если миграция не выполнена."""
+    dialect = engine.dialect.name
+    with engine.begin() as conn:
+        if dialect == "postgresql":
+            missing = _missing_indexes(conn)
+            if missing:
+                logger.warning(
+                    "Нет поисковых индексов %s: поиск работает последовательным сканированием. "
+                    "Выполните: python search.py migrate", ", ".join(missing)
+                )
+        elif dialect == "sqlite":
+            is_new = conn.execute(
+                text("SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'")
+            ).first() is None
+            for ddl in _SQLITE_DDL:
+                conn.execute(text(ddl))
+            # Сообщения, записанные до появления индекса
+            if is_new:
+                conn.execute(text(
+                    "INSERT INTO messages_fts(rowid, content) "
+                    "SELECT id, content FROM messages WHERE NOT coalesce(is_encrypted, 0)"
+                ))
+
+
+def _missing_indexes(conn) -> list[str]:
+    valid = set(conn.execute(text(
+        "SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+        "WHERE c.relname = ANY(:names) AND i.indisvalid"
+    ), {"names": list(POSTGRES_INDEXES)}).scalars())
+    return [name for name in POSTGRES_INDEXES if name not in valid]
+
+
+def migrate(engine):
+    """Разовая миграция PostgreSQL: расширение pg_trgm и поисковые индексы.
+
+    Индексы строятся CONCURRENTLY — чтение и запись таблиц во время построения не
+    блокируются; на секционированной messages (partitions.py) — по секциям с
+    последующим ATTACH. Недостроенный (INVALID) индекс прошлой попытки пересоздаётся.
+    Колонка search_vector прежней версии удаляется: это только изменение каталога.
+    """
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+        for name, (table_name, definition) in POSTGRES_INDEXES.items():
+            partitions = conn.execute(text(
+                "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+                "WHERE i.inhparent = to_regclass(:table)"
+            ), {"table": table_name}).scalars().all()
+            if not partitions:
+                _create_index_concurrently(conn, name, table_name, definition)
+                continue
+            # CONCURRENTLY на секционированной таблице не поддерживается: пустой индекс
+            # на родителе, индексы секций конкурентно и подключение их к родителю
+            conn.execute(text(f"CREATE INDEX IF NOT EXISTS {name} ON ONLY {table_name} {definition}"))
+            for partition in partitions:
+                child = f"{partition[:40]}_{name[3:]}"[:63]
+                _create_index_concurrently(conn, child, partition, definition)
+                attached = conn.execute(text(
+                    "SELECT 1 FROM pg_inherits WHERE inhrelid = to_regclass(:child) AND inhparent = to_regclass(:name)"
+                ), {"child": child, "name": name}).first()
+                if not attached:
+                    conn.execute(text(f"ALTER INDEX {name} ATTACH PARTITION {child}"))
+        conn.execute(text("DROP INDEX IF EXISTS ix_messages_search_vector"))
+        conn.execute(text("ALTER TABLE messages DROP COLUMN IF EXISTS search_vector"))
+
+
+def _create_index_concurrently(conn, name: str, table_name: str, definition: str):
+    invalid = conn.execute(text(
+        "SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid WHERE c.relname = :name AND NOT i.indisvalid"
+    ), {"name": name}).first()
+    if invalid:
+        conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+    conn.execute(text(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table_name} {definition}"))
+
+
+def _terms(q: str) -> list[str]:
+    # Только "словесные" токены: пользовательский ввод не должен ломать синтаксис tsquery/MATCH
+    return re.findall(r"\w+", q.lower())
+
+
+def _escape_like(q: str) -> str:
+    return q.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def highlight(snippet: str | None) -> str | None:
+    """Фрагмент из БД -> безопасный HTML: текст экранирован, совпадения в <mark>."""
+    if snippet is None:
+        return None
+    escaped = html.escape(snippet, quote=False)
+    return escaped.replace(SNIPPET_START, "<mark>").replace(SNIPPET_STOP, "</mark>")
+
+
+def search_messages(db: Session, user_id: int, contact_id: int, q: str, limit: int, offset: int):
+    """Сообщения диалога, подходящие под запрос: список (Message, snippet, rank) по убыванию релевантности.
+    snippet — экранированный HTML с совпадениями в <mark>.
+
+    Каждое слово запроса ищется как префикс, поэтому поиск работает "по мере ввода".
+    """
+    terms = _terms(q)
+    if not terms:
+        return []
+
+    conversation = or_(
+        and_(models.Message.sender_id == user_id, models.Message.recipient_id == contact_id),
+        and_(models.Message.sender_id == contact_id, models.Message.recipient_id == user_id),
+    )
+    dialect = db.get_bind().dialect.name
+
+    if dialect == "postgresql":
+        ts_query = func.to_tsquery(TS_CONFIG, " & ".join(f"{t}:*" for t in terms))
+        vector = literal_column(SEARCH_VECTOR_SQL)
+        rank = func.ts_rank(vector, ts_query)
+        snippet = func.ts_headline(
+            TS_CONFIG, models.Message.content, ts_query,
+            f'StartSel="{SNIPPET_START}", StopSel="{SNIPPET_STOP}", MaxFragments=1, MaxWords=20, MinWords=5',
+        )
+        query = db.query(models.Message, snippet.label("snippet"), rank.label("rank")).filter(
+            vector.op("@@")(ts_query), conversation
+        )
+        order = (rank.desc(), models.Message.id.desc())
+
+    elif dialect == "sqlite":
+        match = " ".join(f'"{t}"*' for t in terms)
+        fts = literal_column("messages_fts")
+        bm25 = func.bm25(fts)
+        snippet = func.snippet(fts, 0, SNIPPET_START, SNIPPET_STOP, "…", 12)
+        query = (
+            db.query(models.Message, snippet.label("snippet"), (-bm25).label("rank"))
+            .join(_messages_fts, _messages_fts.c.rowid == models.Message.id)
+            .filter(fts.op("MATCH")(match), conversation)
+        )
+        # bm25 в FTS5: чем меньше, тем релевантнее
+        order = (bm25.asc(), models.Message.id.desc())
+
+    else:
+        query = db.query(
+            models.Message, models.Message.content.label("snippet"), literal_column("0.0").label("rank")
+        ).filter(
+            models.Message.content.ilike(f"%{_escape_like(q)}%", escape="\\"),
+            or_(models.Message.is_encrypted == False, models.Message.is_encrypted.is_(None)),
+            conversation,
+        )
+        order = (models.Message.id.desc(),)
+
+    # Цитаты подгружаются тем же запросом, как и в истории сообщений
+    query = query.options(joinedload(models.Message.reply_to).joinedload(models.Message.sender))
+    hits = query.order_by(*order).offset(offset).limit(limit).all()
+    return [(msg, highlight(snippet), rank) for msg, snippet, rank in hits]
+
+
+def search_users(db: Session, exclude_user_id: int, q: str, limit: int, offset: int):
+    """Пользователи, у которых username или email содержат q; на Postgres — по сходству (pg_trgm)."""
+    pattern = f"%{_escape_like(q)}%"
+    query = db.query(models.User).filter(
+        models.User.id != exclude_user_id,
+        or_(
+            models.User.username.ilike(pattern, escape="\\"),
+            models.User.email.ilike(pattern, escape="\\"),
+        ),
+    )
+    if db.get_bind().dialect.name == "postgresql":
+        similarity = func.greatest(
+            func.similarity(models.User.username, q), func.similarity(models.User.email, q)
+        )
+        query = query.order_by(similarity.desc(), models.User.id)
+    else:
+        query = query.order_by(models.User.username)
+    return query.offset(offset).limit(limit).all()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from database import engine
+
+    parser = argparse.ArgumentParser(description="Поисковые индексы (PostgreSQL)")
+    parser.add_argument("command", choices=["migrate"])
+    parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if engine.dialect.name != "postgresql":
+        parser.exit(message="Миграция нужна только для PostgreSQL: в SQLite индекс создаётся при старте\n")
+    migrate(engine)
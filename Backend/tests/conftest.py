@@ -0,0 +1,98 @@
+"""Общие фикстуры: приложение на временной SQLite-базе и создание пользователей.
+
+DATABASE_URL задаётся до импорта main — движки создаются при импорте database.
+Рабочий каталог — временный: static/ и uploads_partial/ тестов не попадают в дерево.
+"""
+import os
+import sys
+import tempfile
+import time
+import uuid
+from contextlib import contextmanager
+
+import pytest
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_tmp = tempfile.mkdtemp(prefix="messenger-tests-")
+os.environ["DATABASE_URL"] = f"sqlite:///{_tmp}/test.db"
+os.environ.setdefault("PRESENCE_GRACE_SECONDS", "0")
+os.environ.setdefault("RESPONSE_CACHE_URL", "memory://")
+sys.path.insert(0, BACKEND_DIR)
+os.chdir(_tmp)
+
+import main  # noqa: E402
+import models  # noqa: E402
+from database import SessionLocal  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def client():
+    with TestClient(main.app) as test_client:
+        yield test_client
+
+
+class TestUser:
+    def __init__(self, user: models.User):
+        self.id = user.id
+        self.username = user.username
+        self.email = user.email
+        self.token = main.create_access_token({"sub": user.email, "uid": user.id})
+        self.headers = {"Authorization": f"Bearer {self.token}"}
+
+
+@pytest.fixture
+def make_user():
+    """make_user() -> TestUser с токеном; пароль не нужен — токен выписывается напрямую,
+    без argon2 в пуле процессов."""
+    def create(name: str | None = None) -> TestUser:
+        name = name or f"user_{uuid.uuid4().hex[:10]}"
+        with SessionLocal() as db:
+            user = models.User(username=name, email=f"{name}@example.com", hashed_password="-")
+            db.add(user)
+            db.commit()
+            return TestUser(user)
+    return create
+
+
+class FakeManager:
+    """ConnectionManager для фоновых задач в тестах: запоминает отправленные кадры."""
+
+    def __init__(self):
+        self.sent = []
+
+    async def send_personal_message(self, message, user_id):
+        self.sent.append((user_id, message))
+
+
+@contextmanager
+def open_ws(client, user: TestUser, **kwargs):
+    """/ws пользователя. При выходе сокет закрывается и обработчику даётся время завершиться:
+    иначе TestClient отменит его посреди рассылки офлайн-статуса, и соединение aiosqlite
+    останется с открытой транзакцией (database is locked в следующих тестах)."""
+    with client.websocket_connect(f"/ws?token={user.token}", **kwargs) as ws:
+        yield ws
+        ws.close()
+        time.sleep(0.2)
+
+
+def add_messages(sender_id: int, recipient_id: int, contents: list[str], **fields) -> list[int]:
+    """Сообщения напрямую в БД (как пишет ingestion): с обновлением conversations
+    и сбросом кэша ответов пары."""
+    import asyncio
+
+    import conversations
+    import response_cache
+
+    with SessionLocal() as db:
+        messages = [
+            models.Message(sender_id=sender_id, recipient_id=recipient_id, content=content, **fields)
+            for content in contents
+        ]
+        db.add_all(messages)
+        db.flush()
+        conversations.on_messages_created(db, messages)
+        db.commit()
+        ids = [message.id for message in messages]
+    asyncio.run(response_cache.invalidate_messages([(sender_id, recipient_id)]))
+    return ids
@@ -0,0 +1,132 @@
+"""RedisBroker поверх fakeredis: доставка между воркерами, присутствие и переподключение."""
+import asyncio
+
+import fakeredis
+import pytest
+import redis.asyncio
+
+import broker as broker_module
+from broker import RedisBroker
+
+
+@pytest.fixture
+def redis_server(monkeypatch):
+    """Общий сервер fakeredis: каждый RedisBroker — отдельный воркер со своим клиентом."""
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(
+        redis.asyncio, "from_url",
+        lambda url, **kwargs: fakeredis.FakeAsyncRedis(server=server, **kwargs),
+    )
+    monkeypatch.setattr(broker_module, "RECONNECT_MIN_DELAY", 0.01)
+    return server
+
+
+class Inbox:
+    def __init__(self):
+        self.items = []
+        self.event = asyncio.Event()
+
+    async def __call__(self, user_id, message):
+        self.items.append((user_id, message))
+        self.event.set()
+
+    async def wait(self, count: int):
+        while len(self.items) < count:
+            self.event.clear()
+            await asyncio.wait_for(self.event.wait(), timeout=2)
+
+
+async def start_worker(**kwargs) -> tuple[RedisBroker, Inbox]:
+    worker = RedisBroker("redis://test", **kwargs)
+    inbox = Inbox()
+    await worker.start(inbox)
+    return worker, inbox
+
+
+def test_publish_reaches_other_workers(redis_server):
+    async def scenario():
+        first, _ = await start_worker()
+        second, inbox = await start_worker()
+        await first.publish(7, {"type": "new_message", "id": 1})
+        await inbox.wait(1)
+        await first.stop()
+        await second.stop()
+        return inbox.items
+
+    assert asyncio.run(scenario()) == [(7, {"type": "new_message", "id": 1})]
+
+
+def test_presence_counts_workers(redis_server):
+    async def scenario():
+        first, _ = await start_worker()
+        second, _ = await start_worker()
+        steps = [
+            await first.presence_join(7),
+            await second.presence_join(7),
+            await first.presence_leave(7),
+            await second.online_users([7, 8]),
+            await second.presence_leave(7),
+            await first.online_users([7]),
+        ]
+        await first.stop()
+        await second.stop()
+        return steps
+
+    # Онлайн — с первого сокета на любом воркере, офлайн — после последнего
+    assert asyncio.run(scenario()) == [True, False, False, {7}, True, set()]
+
+
+def test_stop_releases_presence(redis_server):
+    async def scenario():
+        first, _ = await start_worker()
+        second, _ = await start_worker()
+        await first.presence_join(7)
+        await first.stop()
+        online = await second.online_users([7])
+        await second.stop()
+        return online
+
+    assert asyncio.run(scenario()) == set()
+
+
+def test_dead_worker_users_expire(redis_server):
+    async def scenario():
+        dead, _ = await start_worker(presence_ttl=0.3)
+        alive, _ = await start_worker(presence_ttl=0.3)
+        expired = []
+
+        async def on_expired(user_id):
+            expired.append(user_id)
+        alive.on_presence_expired = on_expired
+
+        await dead.presence_join(7)
+        # Воркер упал без stop(): пульс больше не продлевается
+        dead._listener.cancel()
+        dead._heartbeat.cancel()
+        await asyncio.sleep(0.7)
+        online = await alive.online_users([7])
+        await alive.stop()
+        return expired, online
+
+    assert asyncio.run(scenario()) == ([7], set())
+
+
+def test_subscription_restored_after_disconnect(redis_server):
+    async def scenario():
+        publisher, _ = await start_worker()
+        subscriber, inbox = await start_worker()
+        # Соединение подписки сброшено: listen() завершится, слушатель переподключится
+        dropped = subscriber._pubsub
+        await dropped.aclose()
+        for _ in range(100):
+            await asyncio.sleep(0.02)
+            if subscriber._pubsub not in (None, dropped) and subscriber._pubsub.subscribed:
+                break
+        assert subscriber._pubsub is not dropped
+        await publisher.publish(None, {"type": "ping"})
+        await inbox.wait(1)
+        await publisher.stop()
+        await subscriber.stop()
+        return inbox.items
+
+    assert asyncio.run(scenario()) == [(None, {"type": "ping"})]
@@ -0,0 +1,72 @@
+"""Отметки о прочтении: пачечная запись и повтор после неудачного сброса."""
+import pytest
+from sqlalchemy import select
+
+import models
+from coalescer import Coalescer
+from conftest import FakeManager, add_messages
+from database import AsyncSessionLocal, SessionLocal
+
+
+class FlakySessions:
+    """Фабрика сессий, первые failures вызовов которой падают, как при обрыве БД."""
+
+    def __init__(self, failures: int):
+        self.failures = failures
+
+    def __call__(self):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError("БД недоступна")
+        return AsyncSessionLocal()
+
+
+def read_flags(sender_id: int, recipient_id: int) -> list[bool]:
+    with SessionLocal() as db:
+        return db.scalars(
+            select(models.Message.is_read)
+            .where(models.Message.sender_id == sender_id, models.Message.recipient_id == recipient_id)
+            .order_by(models.Message.id)
+        ).all()
+
+
+def test_failed_flush_keeps_receipts(client, make_user):
+    reader, sender, other = make_user(), make_user(), make_user()
+    first, second, third = add_messages(sender.id, reader.id, ["a", "b", "c"])
+    add_messages(other.id, reader.id, ["d"])
+    manager = FakeManager()
+    coalescer = Coalescer(manager, FlakySessions(failures=1))
+
+    coalescer.mark_read(reader.id, sender.id, first)
+    with pytest.raises(ConnectionError):
+        client.portal.call(coalescer.flush)
+    assert read_flags(sender.id, reader.id) == [False, False, False]
+
+    # Отметки, пришедшие после сбоя, объединяются с возвращёнными: берётся максимум
+    coalescer.mark_read(reader.id, sender.id, second)
+    coalescer.mark_read(reader.id, other.id, None)
+    client.portal.call(coalescer.flush)
+
+    assert read_flags(sender.id, reader.id) == [True, True, False]
+    assert read_flags(other.id, reader.id) == [True]
+    frames = {user_id: (message["type"], message["up_to_id"]) for user_id, message in manager.sent}
+    assert frames == {sender.id: ("messages_read", second), other.id: ("messages_read", None)}
+
+
+def test_read_everything_has_no_id_bound(client, make_user):
+    reader, sender = make_user(), make_user()
+    add_messages(sender.id, reader.id, ["a", "b"])
+    coalescer = Coalescer(FakeManager(), AsyncSessionLocal)
+
+    coalescer.mark_read(reader.id, sender.id, None)
+    # Поздний up_to_id не сужает "прочитано всё"
+    coalescer.mark_read(reader.id, sender.id, 1)
+    client.portal.call(coalescer.flush)
+
+    assert read_flags(sender.id, reader.id) == [True, True]
+    with SessionLocal() as db:
+        conv = db.scalar(select(models.Conversation).where(
+            models.Conversation.user_low_id == min(reader.id, sender.id),
+            models.Conversation.user_high_id == max(reader.id, sender.id),
+        ))
+        assert (conv.unread_low, conv.unread_high) == (0, 0)
@@ -0,0 +1,73 @@
+"""Очереди отправки /ws: политики для медленных клиентов и метрики."""
+import asyncio
+
+import pytest
+
+from broker import InMemoryBroker
+from connections import ClientConnection, ConnectionManager
+
+
+class StuckSocket:
+    """Сокет, который не отдаёт кадры, пока не отпустят release."""
+
+    def __init__(self):
+        self.release = asyncio.Event()
+        self.sent = []
+        self.close_code = None
+
+    async def send_text(self, data):
+        await self.release.wait()
+        self.sent.append(data)
+
+    async def close(self, code=1000):
+        self.close_code = code
+
+
+async def flood(policy: str, frames: int):
+    manager = ConnectionManager(InMemoryBroker(), slow_consumer_policy=policy)
+    socket = StuckSocket()
+    connection = ClientConnection(socket, user_id=1, queue_size=2)
+    connection.start()
+    manager.active_connections[1] = [connection]
+    await asyncio.sleep(0)
+    for n in range(frames):
+        await manager._deliver_local(1, {"n": n})
+        await asyncio.sleep(0)
+    socket.release.set()
+    await asyncio.sleep(0.01)
+    await connection.close()
+    return manager, socket
+
+
+@pytest.mark.parametrize("policy, delivered", [
+    # Первый кадр уже у писателя, в очереди помещаются ещё два
+    ("drop_new", [0, 1, 2]),
+    ("drop_oldest", [0, 3, 4]),
+])
+def test_drop_policies(policy, delivered):
+    manager, socket = asyncio.run(flood(policy, 5))
+
+    assert socket.sent == [f'{{"n":{n}}}' for n in delivered]
+    assert socket.close_code is None
+    assert manager.metrics()["frames_dropped"] == 2
+
+
+def test_disconnect_policy():
+    manager, socket = asyncio.run(flood("disconnect", 4))
+
+    assert socket.close_code == 1013
+    assert manager.slow_consumers_disconnected == 1
+    # Очередь (2 кадра) и не поместившийся кадр
+    assert manager.frames_dropped == 3
+
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        ConnectionManager(InMemoryBroker(), slow_consumer_policy="ignore")
+
+
+def test_counters_only_on_metrics(client):
+    body = client.get("/metrics").text
+    assert "messenger_ws_frames_dropped_total" in body
+    assert "messenger_ws_slow_consumers_disconnected_total" in body
+    assert client.get("/metrics/websocket").status_code == 404
@@ -0,0 +1,23 @@
+"""Настройки движков: асинхронные драйверы и параметры пула."""
+import database
+
+
+def test_async_driver_for_each_dialect():
+    assert database.to_async_url("postgresql://u:p@db/messenger") == "postgresql+asyncpg://u:p@db/messenger"
+    assert database.to_async_url("postgresql+psycopg2://u:p@db/messenger") == "postgresql+asyncpg://u:p@db/messenger"
+    assert database.to_async_url("sqlite:///./messenger.db") == "sqlite+aiosqlite:///./messenger.db"
+
+
+def test_pool_options_skip_sqlite(monkeypatch):
+    monkeypatch.setattr(database, "DB_POOL_SIZE", 20)
+    monkeypatch.setattr(database, "DB_MAX_OVERFLOW", 0)
+
+    assert database.pool_options("sqlite:///./messenger.db") == {}
+    options = database.pool_options("postgresql://u:p@db/messenger")
+    assert (options["pool_size"], options["max_overflow"]) == (20, 0)
+    assert options["pool_pre_ping"] is database.DB_POOL_PRE_PING
+
+
+def test_without_replica_reads_use_primary():
+    # В тестах READ_REPLICA_URL не задана
+    assert database.read_async_engine is database.async_engine
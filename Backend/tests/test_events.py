@@ -0,0 +1,91 @@
+"""Журнал событий: номера seq, догоняющая синхронизация и компактизация."""
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import select, update
+
+import events
+import models
+from conftest import add_messages
+from database import AsyncSessionLocal, SessionLocal
+
+
+def record(frames: list[tuple[int, dict]]) -> list[int]:
+    with SessionLocal() as db:
+        seqs = events.record(db, frames)
+        db.commit()
+    return seqs
+
+
+def sync(client, user_id: int, since) -> list[dict]:
+    sent = []
+
+    async def send(frame):
+        sent.append(frame)
+    client.portal.call(events.EventLog(AsyncSessionLocal).sync, user_id, since, send)
+    return sent
+
+
+def test_seq_per_user(make_user):
+    first, second = make_user(), make_user()
+    ping = {"type": "messages_read"}
+
+    assert record([(first.id, ping), (second.id, ping), (first.id, ping)]) == [1, 1, 2]
+    assert record([(second.id, ping)]) == [2]
+
+
+def test_sync_sends_current_content(client, make_user, monkeypatch):
+    monkeypatch.setattr(events, "SYNC_BATCH_SIZE", 2)
+    me, partner = make_user(), make_user()
+    kept, edited, deleted = add_messages(partner.id, me.id, ["раз", "два", "три"])
+    record([
+        (me.id, {"type": "new_message", "id": kept, "content": "раз"}),
+        (me.id, {"type": "new_message", "id": edited, "content": "два"}),
+        (me.id, {"type": "new_message", "id": deleted, "content": "три"}),
+        (me.id, {"type": "message_deleted", "id": deleted}),
+    ])
+    with SessionLocal() as db:
+        # Текст в журнал не пишется
+        assert all("content" not in e.payload for e in db.scalars(select(models.UserEvent).where(models.UserEvent.user_id == me.id)))
+        db.execute(update(models.Message).where(models.Message.id == edited).values(content="два (правка)"))
+        db.execute(models.Message.__table__.delete().where(models.Message.id == deleted))
+        db.commit()
+
+    frames = sync(client, me.id, 0)
+
+    assert [(f["type"], f["done"]) for f in frames] == [("sync_batch", False), ("sync_batch", False), ("sync_batch", True)]
+    replayed = [event for frame in frames for event in frame["events"]]
+    # new_message удалённого сообщения пропускается
+    assert [(e["seq"], e["type"], e.get("content")) for e in replayed] == [
+        (1, "new_message", "раз"),
+        (2, "new_message", "два (правка)"),
+        (4, "message_deleted", None),
+    ]
+    assert frames[-1]["last_seq"] == 4
+    assert sync(client, me.id, 4) == [{"type": "sync_batch", "events": [], "last_seq": 4, "done": True}]
+
+
+def test_sync_reset(client, make_user):
+    me = make_user()
+    record([(me.id, {"type": "messages_read"})] * 3)
+
+    assert sync(client, me.id, None) == [{"type": "sync_reset", "last_seq": 3}]
+    assert sync(client, me.id, 7) == [{"type": "sync_reset", "last_seq": 3}]
+
+
+def test_compaction_raises_floor(client, make_user):
+    me = make_user()
+    record([(me.id, {"type": "messages_read"})] * 3)
+    with SessionLocal() as db:
+        old = datetime.now(timezone.utc) - timedelta(days=events.EVENT_RETENTION_DAYS + 1)
+        db.execute(
+            update(models.UserEvent)
+            .where(models.UserEvent.user_id == me.id, models.UserEvent.seq <= 2)
+            .values(created_at=old)
+        )
+        db.commit()
+        assert events.compact(db) >= 2
+        db.commit()
+
+    # События после since=1 уже удалены — клиент перезагружает состояние
+    assert sync(client, me.id, 1)[0]["type"] == "sync_reset"
+    assert [e["seq"] for e in sync(client, me.id, 2)[0]["events"]] == [3]
@@ -0,0 +1,63 @@
+"""Экспорт переписки: состав файла, gzip и повторный импорт выгрузки."""
+import gzip
+import json
+
+import exports
+from conftest import add_messages
+from test_import import run_import, stored
+
+
+def lines(body: bytes) -> list[dict]:
+    return [json.loads(line) for line in body.decode().splitlines()]
+
+
+def test_conversation_export(client, make_user, monkeypatch):
+    # Несколько кусков по yield_per
+    monkeypatch.setattr(exports, "EXPORT_BATCH_SIZE", 2)
+    me, partner, other = make_user(), make_user(), make_user()
+    add_messages(me.id, partner.id, ["раз", "два"])
+    add_messages(partner.id, me.id, ["три"])
+    add_messages(me.id, other.id, ["не в этом диалоге"])
+
+    response = client.get(f"/messages/{partner.id}/export", headers=me.headers)
+
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    assert f'filename="messages-{me.id}-{partner.id}.ndjson"' in response.headers["content-disposition"]
+    header, user, *messages = lines(response.content)
+    assert (header["type"], header["version"], header["user_id"]) == ("export", 1, me.id)
+    assert user == {"type": "user", "id": partner.id, "username": partner.username}
+    assert [m["content"] for m in messages] == ["раз", "два", "три"]
+    assert [m["id"] for m in messages] == sorted(m["id"] for m in messages)
+
+
+def test_account_export_gzip(client, make_user):
+    me, first, second, stranger = make_user(), make_user(), make_user(), make_user()
+    add_messages(me.id, first.id, ["первому"])
+    add_messages(second.id, me.id, ["от второго"])
+    add_messages(first.id, stranger.id, ["чужое"])
+
+    response = client.get("/users/me/export", params={"gzip": True}, headers=me.headers)
+
+    assert response.headers["content-type"] == "application/gzip"
+    assert f'filename="messages-{me.id}.ndjson.gz"' in response.headers["content-disposition"]
+    records = lines(gzip.decompress(response.content))
+    assert {r["id"] for r in records if r["type"] == "user"} == {first.id, second.id}
+    assert [r["content"] for r in records if r["type"] == "message"] == ["первому", "от второго"]
+
+
+def test_export_requires_auth(client):
+    assert client.get("/users/me/export").status_code == 401
+
+
+def test_export_imports_into_new_account(client, make_user):
+    old, partner, new = make_user(), make_user(), make_user()
+    add_messages(old.id, partner.id, ["перенесётся"])
+    add_messages(partner.id, old.id, ["останется у собеседника"])
+    body = client.get(f"/messages/{partner.id}/export", params={"gzip": True}, headers=old.headers).content
+
+    result = run_import(client, new, body).json()
+
+    assert result["imported"] == 1
+    assert result["skipped_by_reason"] == {"received": 1}
+    assert [(m.sender_id, m.content) for m in stored(new.id, partner.id)] == [(new.id, "перенесётся")]
@@ -0,0 +1,23 @@
+"""Хэширование паролей в пуле процессов: регистрация/вход и 503 при перегрузке."""
+import hashing
+
+
+def test_register_and_login_hash_in_pool(client):
+    credentials = {"email": "hash_user@example.com", "username": "hash_user", "password": "correct horse"}
+
+    assert client.post("/register", json=credentials).status_code == 200
+    assert client.post("/login", json=credentials).json()["token_type"] == "bearer"
+    assert client.post("/login", json={**credentials, "password": "wrong"}).status_code == 400
+    # Процессы пула не форкаются от многопоточного сервера
+    assert hashing._pool()._mp_context.get_start_method() != "fork"
+
+
+def test_overload_returns_503(client, monkeypatch):
+    monkeypatch.setattr(hashing, "_in_flight", hashing.HASH_WORKERS + hashing.HASH_QUEUE_SIZE)
+
+    response = client.post(
+        "/register", json={"email": "busy@example.com", "username": "busy_user", "password": "secret"}
+    )
+
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == str(hashing.HASH_RETRY_AFTER_SECONDS)
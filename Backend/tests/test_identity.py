@@ -0,0 +1,55 @@
+"""Кэш аутентифицированных пользователей: попадания без БД и сброс после смены профиля."""
+import time
+
+import identity
+import main
+from instrumentation import assert_max_queries
+
+
+def test_repeated_requests_skip_db(client, make_user):
+    me = make_user()
+    assert client.get("/users/me", headers=me.headers).status_code == 200
+
+    with assert_max_queries(0):
+        assert client.get("/users/me", headers=me.headers).json()["id"] == me.id
+
+
+def test_profile_update_invalidates(client, make_user):
+    me = make_user()
+    client.get("/users/me", headers=me.headers)
+
+    new_name = f"{me.username}_renamed"
+    assert client.put("/users/me", json={"username": new_name}, headers=me.headers).status_code == 200
+
+    assert client.get("/users/me", headers=me.headers).json()["username"] == new_name
+
+
+def test_legacy_token_cached_by_email(client, make_user):
+    me = make_user()
+    # Старые токены — только sub=email, без uid
+    headers = {"Authorization": f"Bearer {main.create_access_token({'sub': me.email})}"}
+    assert client.get("/users/me", headers=headers).json()["id"] == me.id
+    assert identity.identity_cache.get(("sub", me.email)).id == me.id
+
+    client.put("/users/me", json={"phone_number": "+70000000000"}, headers=me.headers)
+    assert identity.identity_cache.get(("sub", me.email)) is None
+
+
+def test_unknown_user_rejected(client):
+    token = main.create_access_token({"sub": "ghost@example.com", "uid": 999999})
+    response = client.get("/users/me", headers={"Authorization": f"Bearer {token}"})
+    assert response.status_code == 401
+
+
+def test_ttl_and_lru():
+    cache = identity.TTLCache(maxsize=2, ttl=0.05)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    # Вытесняется давно не использованный ключ
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+
+    time.sleep(0.06)
+    assert cache.get("a") is None
@@ -0,0 +1,152 @@
+"""Импорт переписки: авторство, проверка файла, пачки и порядок сообщений."""
+import json
+
+import pytest
+from sqlalchemy import select
+
+import exports
+import models
+from conftest import add_messages
+from database import SessionLocal
+
+EXPORTER, PARTNER = 900, 901
+
+
+def export_file(partner_username: str, messages: list[dict]) -> bytes:
+    lines = [
+        {"type": "export", "version": 1, "user_id": EXPORTER, "username": "old_me"},
+        {"type": "user", "id": PARTNER, "username": partner_username},
+        *({"type": "message", "is_encrypted": False, "is_read": False, "reply_to_id": None, **message} for message in messages),
+    ]
+    return "".join(json.dumps(line) + "\n" for line in lines).encode()
+
+
+def message(old_id: int, content: str, timestamp: str, sender=EXPORTER, recipient=PARTNER, **fields) -> dict:
+    return {"id": old_id, "sender_id": sender, "recipient_id": recipient, "content": content, "timestamp": timestamp, **fields}
+
+
+def run_import(client, user, body: bytes):
+    return client.post("/users/me/import", headers=user.headers, files={"file": ("export.ndjson", body)})
+
+
+def stored(sender_id: int, recipient_id: int) -> list[models.Message]:
+    with SessionLocal() as db:
+        return db.scalars(
+            select(models.Message)
+            .where(models.Message.sender_id.in_([sender_id, recipient_id]), models.Message.recipient_id.in_([sender_id, recipient_id]))
+            .order_by(models.Message.id)
+        ).all()
+
+
+def test_only_exporter_messages_are_imported_as_owner(client, make_user):
+    me, partner = make_user(), make_user()
+    body = export_file(partner.username, [
+        message(1, "моё", "2024-01-01T10:00:00+00:00"),
+        message(2, "якобы от собеседника", "2024-01-01T10:01:00+00:00", sender=PARTNER, recipient=EXPORTER),
+        message(3, "неизвестному", "2024-01-01T10:02:00+00:00", recipient=777),
+    ])
+
+    response = run_import(client, me, body)
+
+    assert response.status_code == 200
+    assert response.json()["imported"] == 1
+    assert response.json()["skipped"] == 2
+    assert response.json()["skipped_by_reason"] == {"received": 1, "unknown_recipient": 1}
+    assert [(m.sender_id, m.content) for m in stored(me.id, partner.id)] == [(me.id, "моё")]
+
+
+def test_timestamps_are_normalized_and_bounded(client, make_user):
+    me, partner = make_user(), make_user()
+    body = export_file(partner.username, [
+        message(1, "без пояса", "2024-01-01T10:00:00"),
+        message(2, "со сдвигом", "2024-01-01T12:30:00+02:00"),
+        message(3, "из будущего", "2999-01-01T00:00:00+00:00"),
+    ])
+
+    assert run_import(client, me, body).json()["skipped_by_reason"] == {"out_of_range": 1}
+    messages = stored(me.id, partner.id)
+    assert [m.content for m in messages] == ["без пояса", "со сдвигом"]
+    assert [m.timestamp.replace(tzinfo=None).isoformat() for m in messages] == ["2024-01-01T10:00:00", "2024-01-01T10:30:00"]
+
+
+@pytest.mark.parametrize("bad", [
+    {"content": 42},
+    {"content": ""},
+    {"sender_id": "900"},
+    {"timestamp": None},
+    {"id": 1},
+])
+def test_invalid_file_writes_nothing(client, make_user, bad):
+    me, partner = make_user(), make_user()
+    body = export_file(partner.username, [
+        message(1, "первое", "2024-01-01T10:00:00+00:00"),
+        {**message(2, "второе", "2024-01-01T10:01:00+00:00"), **bad},
+    ])
+
+    response = run_import(client, me, body)
+
+    assert response.status_code == 400
+    assert stored(me.id, partner.id) == []
+
+
+def test_batches_keep_replies_and_order(client, make_user, monkeypatch):
+    monkeypatch.setattr(exports, "IMPORT_BATCH_SIZE", 2)
+    me, partner = make_user(), make_user()
+    body = export_file(partner.username, [
+        message(10, "вопрос", "2024-01-01T10:00:00+00:00"),
+        message(11, "уточнение", "2024-01-01T10:01:00+00:00"),
+        message(12, "ответ на вопрос", "2024-01-01T10:02:00+00:00", reply_to_id=10),
+        message(13, "раньше предыдущего", "2024-01-01T09:00:00+00:00"),
+        message(14, "ответ на пропущенное", "2024-01-01T10:03:00+00:00", reply_to_id=13),
+    ])
+
+    result = run_import(client, me, body).json()
+
+    assert (result["imported"], result["skipped"]) == (4, 1)
+    messages = stored(me.id, partner.id)
+    by_content = {m.content: m for m in messages}
+    assert by_content["ответ на вопрос"].reply_to_id == by_content["вопрос"].id
+    # Исходное сообщение пропущено — цитата сохраняется текстом
+    fallback = by_content[f"> {me.username}: раньше предыдущего\nответ на пропущенное"]
+    assert fallback.reply_to_id is None
+    # Порядок id совпадает с порядком времени
+    assert [m.timestamp for m in messages] == sorted(m.timestamp for m in messages)
+    with SessionLocal() as db:
+        job = db.get(models.ImportJob, result["job_id"])
+        assert (job.status, job.imported, job.skipped) == ("done", 4, 1)
+        assert job.skipped_by_reason == {"not_newer": 1}
+
+
+def test_history_older_than_conversation_is_skipped(client, make_user):
+    me, partner = make_user(), make_user()
+    [live_id] = add_messages(partner.id, me.id, ["живое сообщение"])
+    body = export_file(partner.username, [message(1, "старое", "2020-01-01T00:00:00+00:00")])
+
+    assert run_import(client, me, body).json()["imported"] == 0
+    # Список чатов по-прежнему показывает последнее живое сообщение
+    chats = client.get("/users", headers=me.headers).json()
+    assert [chat["last_message"] for chat in chats] == ["живое сообщение"]
+    with SessionLocal() as db:
+        assert db.scalar(select(models.Conversation.last_message_id).where(
+            models.Conversation.user_low_id == min(me.id, partner.id),
+            models.Conversation.user_high_id == max(me.id, partner.id),
+        )) == live_id
+
+
+def test_reply_to_received_message_keeps_quote(client, make_user):
+    me, partner = make_user(), make_user()
+    body = export_file(partner.username, [
+        message(1, "как   дела?\nрасскажи", "2024-01-01T10:00:00+00:00", sender=PARTNER, recipient=EXPORTER),
+        message(2, "отлично", "2024-01-01T10:01:00+00:00", reply_to_id=1),
+        message(3, "секрет", "2024-01-01T10:02:00+00:00", sender=PARTNER, recipient=EXPORTER, is_encrypted=True),
+        message(4, "ответ на шифр", "2024-01-01T10:03:00+00:00", reply_to_id=3),
+    ])
+
+    result = run_import(client, me, body).json()
+
+    assert (result["imported"], result["skipped_by_reason"]) == (2, {"received": 2})
+    # Текст зашифрованного сообщения в цитату не попадает
+    assert [(m.content, m.reply_to_id) for m in stored(me.id, partner.id)] == [
+        (f"> {partner.username}: как дела? расскажи\nотлично", None),
+        ("ответ на шифр", None),
+    ]
@@ -0,0 +1,69 @@
+"""Запись пачек сообщений: постоянное число запросов на пачку и цитаты только своего диалога."""
+import pytest
+from sqlalchemy import select
+
+import models
+from conftest import FakeManager, add_messages
+from database import AsyncSessionLocal, SessionLocal
+from ingestion import MessageIngestor, PendingMessage
+from instrumentation import assert_max_queries
+
+
+def frames_to(manager: FakeManager, user_id: int) -> list[dict]:
+    return [message for recipient, message in manager.sent if recipient == user_id]
+
+
+@pytest.mark.parametrize("per_pair", [2, 40])
+def test_batch_statement_count(client, make_user, per_pair):
+    me = make_user()
+    partners = [make_user() for _ in range(3)]
+    quoted, = add_messages(partners[0].id, me.id, ["вопрос"])
+    batch = [
+        PendingMessage(sender_id=me.id, recipient_id=partner.id, content=f"сообщение {i}", client_id=f"{partner.id}-{i}")
+        for i in range(per_pair) for partner in partners
+    ]
+    batch[0].reply_to_id = quoted
+    manager = FakeManager()
+    ingestor = MessageIngestor(manager, AsyncSessionLocal)
+
+    # Цитаты, INSERT сообщений, upsert диалогов, upsert счётчиков seq, журнал событий —
+    # сколько бы сообщений и диалогов ни было в пачке
+    with assert_max_queries(5):
+        client.portal.call(ingestor._process, batch)
+
+    acks = frames_to(manager, me.id)
+    assert [frame["client_id"] for frame in acks] == [item.client_id for item in batch]
+    ids = [frame["id"] for frame in acks]
+    assert ids == sorted(ids)
+    seqs = [frame["seq"] for frame in acks]
+    assert seqs == list(range(seqs[0], seqs[0] + len(batch)))
+    assert acks[0]["reply_to"]["id"] == quoted
+
+    with SessionLocal() as db:
+        conv = db.scalar(select(models.Conversation).where(
+            models.Conversation.user_low_id == min(me.id, partners[0].id),
+            models.Conversation.user_high_id == max(me.id, partners[0].id),
+        ))
+        unread = conv.unread_high if partners[0].id > me.id else conv.unread_low
+        assert conv.last_message_id == max(frame["id"] for frame in acks if frame["recipient_id"] == partners[0].id)
+        assert unread == per_pair
+
+
+def test_reply_to_other_conversation_is_dropped(client, make_user):
+    alice, bob, mallory = make_user(), make_user(), make_user()
+    secret, = add_messages(alice.id, bob.id, ["секрет"])
+    manager = FakeManager()
+    ingestor = MessageIngestor(manager, AsyncSessionLocal)
+
+    client.portal.call(ingestor._process, [
+        PendingMessage(sender_id=mallory.id, recipient_id=alice.id, content="?", reply_to_id=secret, client_id="m"),
+        PendingMessage(sender_id=bob.id, recipient_id=alice.id, content="ответ", reply_to_id=secret, client_id="b"),
+    ])
+
+    leaked, = frames_to(manager, mallory.id)
+    assert leaked["reply_to"] is None
+    answer, = frames_to(manager, bob.id)
+    assert answer["reply_to"]["content"] == "секрет"
+    with SessionLocal() as db:
+        assert db.get(models.Message, leaked["id"]).reply_to_id is None
+        assert db.get(models.Message, answer["id"]).reply_to_id == secret
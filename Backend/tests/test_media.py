@@ -0,0 +1,52 @@
+"""Уменьшенные WebP-варианты загруженных изображений (/media)."""
+import io
+
+from PIL import Image
+
+import thumbnails
+
+
+def png(width: int, height: int) -> bytes:
+    buffer = io.BytesIO()
+    Image.new("RGB", (width, height), (200, 30, 30)).save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def upload(client, user, body: bytes, name: str) -> str:
+    return client.post("/upload", headers=user.headers, files={"file": (name, body)}).json()["url"].rsplit("/", 1)[-1]
+
+
+def test_variant_is_webp_and_cached(client, make_user):
+    user = make_user()
+    stored_name = upload(client, user, png(300, 200), "photo.png")
+
+    response = client.get(f"/media/{stored_name}/128")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "image/webp"
+    assert response.headers["cache-control"] == thumbnails.CACHE_CONTROL
+    with Image.open(io.BytesIO(response.content)) as variant:
+        assert variant.size == (128, 85)
+
+    etag = response.headers["etag"]
+    assert client.get(f"/media/{stored_name}/128", headers={"If-None-Match": etag}).status_code == 304
+    # Пул процессов не форкает многопоточный сервер
+    assert thumbnails._pool()._mp_context.get_start_method() != "fork"
+
+
+def test_unknown_sizes_and_files(client, make_user):
+    user = make_user()
+    stored_name = upload(client, user, png(10, 10), "small.png")
+    document = upload(client, user, b"%PDF-1.4 not an image", "doc.pdf")
+    broken = upload(client, user, b"definitely not a png", "broken.png")
+
+    assert client.get(f"/media/{stored_name}/100").status_code == 404
+    assert client.get(f"/media/{document}/64").status_code == 404
+    assert client.get(f"/media/{'0' * 64}.png/64").status_code == 404
+    assert client.get(f"/media/{broken}/64").status_code == 415
+
+
+def test_variant_url_only_for_own_images():
+    local = "http://localhost:8000/static/uploads/" + "a" * 64 + ".jpg"
+    assert thumbnails.variant_url(local, 64) == f"http://localhost:8000/media/{'a' * 64}.jpg/64"
+    assert thumbnails.variant_url("https://example.com/avatar.jpg", 64) == "https://example.com/avatar.jpg"
+    assert thumbnails.variant_url(None, 64) is None
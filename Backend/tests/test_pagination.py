@@ -0,0 +1,53 @@
+"""Курсорная пагинация списка чатов (X-Next-Cursor) и истории диалога (?before=)."""
+from conftest import add_messages
+
+
+def test_chat_list_pages_by_cursor(client, make_user):
+    me = make_user()
+    partners = [make_user() for _ in range(5)]
+    for partner in partners:
+        add_messages(partner.id, me.id, [f"от {partner.username}"])
+
+    pages, cursor = [], None
+    while True:
+        params = {"limit": 2, **({"cursor": cursor} if cursor is not None else {})}
+        response = client.get("/users", params=params, headers=me.headers)
+        pages.append([chat["id"] for chat in response.json()])
+        cursor = response.headers.get("X-Next-Cursor")
+        if cursor is None:
+            break
+
+    assert [len(page) for page in pages] == [2, 2, 1]
+    # Сначала диалоги с самым свежим сообщением, без повторов и пропусков
+    assert [chat_id for page in pages for chat_id in page] == [partner.id for partner in reversed(partners)]
+
+
+def test_new_message_moves_chat_to_first_page(client, make_user):
+    me = make_user()
+    old, recent = make_user(), make_user()
+    add_messages(old.id, me.id, ["давно"])
+    add_messages(recent.id, me.id, ["недавно"])
+    assert [chat["id"] for chat in client.get("/users", params={"limit": 1}, headers=me.headers).json()] == [recent.id]
+
+    add_messages(old.id, me.id, ["снова"])
+
+    response = client.get("/users", params={"limit": 1}, headers=me.headers)
+    assert [chat["id"] for chat in response.json()] == [old.id]
+    assert response.json()[0]["last_message"] == "снова"
+
+
+def test_history_pages_with_before(client, make_user):
+    me, partner = make_user(), make_user()
+    ids = add_messages(me.id, partner.id, [f"m{i}" for i in range(7)])
+
+    pages, before = [], None
+    while True:
+        params = {"limit": 3, **({"before": before} if before is not None else {})}
+        response = client.get(f"/messages/{partner.id}", params=params, headers=me.headers)
+        pages.append([message["id"] for message in response.json()])
+        before = response.headers.get("X-Next-Cursor")
+        if before is None:
+            break
+
+    # Каждая страница — по возрастанию id, страницы идут от новых к старым
+    assert pages == [ids[4:], ids[1:4], ids[:1]]
@@ -0,0 +1,23 @@
+"""Секционирование messages: границы месяцев и поведение на SQLite."""
+from datetime import datetime, timezone
+
+import partitions
+from database import engine
+
+
+def test_month_start_wraps_years():
+    moment = datetime(2024, 12, 31, 23, 59, tzinfo=timezone.utc)
+
+    assert partitions._month_start(moment) == datetime(2024, 12, 1, tzinfo=timezone.utc)
+    assert partitions._month_start(moment, 1) == datetime(2025, 1, 1, tzinfo=timezone.utc)
+    assert partitions._month_start(moment, -12) == datetime(2023, 12, 1, tzinfo=timezone.utc)
+    assert partitions._partition_name(partitions._month_start(moment, 1)) == "messages_p2025_01"
+
+
+def test_sqlite_is_noop(monkeypatch):
+    monkeypatch.setattr(partitions, "MESSAGE_PARTITIONING", "monthly")
+
+    assert not partitions.enabled(engine)
+    partitions.setup(engine)
+    with engine.connect() as conn:
+        assert partitions.lowest_bound(conn) is None
@@ -0,0 +1,60 @@
+"""Присутствие: статусы только собеседников и отложенный уход в офлайн."""
+import asyncio
+
+from broker import InMemoryBroker
+from conftest import FakeManager, add_messages, open_ws
+from database import AsyncSessionLocal
+from presence import PresenceService
+
+
+class PresenceManager(FakeManager):
+    def __init__(self):
+        super().__init__()
+        self.broker = InMemoryBroker()
+
+    async def online_users(self, user_ids):
+        return await self.broker.online_users(user_ids)
+
+
+def test_presence_only_for_contacts(client, make_user):
+    me, partner, quiet_partner, stranger = make_user(), make_user(), make_user(), make_user()
+    add_messages(partner.id, me.id, ["привет"])
+    add_messages(me.id, quiet_partner.id, ["привет"])
+
+    with open_ws(client, partner), open_ws(client, stranger):
+        response = client.get(
+            "/presence", params={"ids": [partner.id, quiet_partner.id, stranger.id, 99999]}, headers=me.headers
+        )
+    # Чужие и несуществующие id в ответ не попадают
+    assert response.json() == [
+        {"user_id": partner.id, "is_online": True},
+        {"user_id": quiet_partner.id, "is_online": False},
+    ]
+
+
+def test_offline_waits_for_grace(client, make_user):
+    me, partner = make_user(), make_user()
+    add_messages(partner.id, me.id, ["привет"])
+    manager = PresenceManager()
+    service = PresenceService(manager, AsyncSessionLocal, grace_seconds=0.2)
+
+    async def scenario():
+        await manager.broker.presence_join(partner.id)
+        await service.user_connected(me.id, True)
+        # Обрыв и переподключение в пределах окна: собеседник не видит ни offline, ни online
+        await service.user_disconnected(me.id, True)
+        await asyncio.sleep(0.05)
+        await service.user_connected(me.id, True)
+        await asyncio.sleep(0.3)
+        reconnect = list(manager.sent)
+        # Ушёл насовсем: offline после окна
+        await service.user_disconnected(me.id, True)
+        assert await manager.online_users([me.id]) == {me.id}
+        await asyncio.sleep(0.3)
+        return reconnect
+
+    reconnect = client.portal.call(scenario)
+    online = {"type": "status_update", "user_id": me.id, "status": "online"}
+    offline = {"type": "status_update", "user_id": me.id, "status": "offline"}
+    assert reconnect == [(partner.id, online)]
+    assert manager.sent == [(partner.id, online), (partner.id, offline)]
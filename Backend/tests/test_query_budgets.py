@@ -0,0 +1,97 @@
+"""Бюджеты SQL-запросов горячих маршрутов и кадров /ws (SQLite).
+
+Бюджет — не больше запросов, чем сейчас: рост числа запросов на маршрут
+(N+1, лишняя загрузка) должен заметно ронять тест, а не проходить незамеченным.
+"""
+import time
+
+from conftest import add_messages, open_ws
+from instrumentation import assert_max_queries
+
+
+def receive(ws, kind):
+    while True:
+        frame = ws.receive_json()
+        if frame.get("type") == kind:
+            return frame
+
+
+def test_chat_list(client, make_user):
+    me = make_user()
+    partners = [make_user() for _ in range(5)]
+    for partner in partners:
+        add_messages(partner.id, me.id, ["привет", "как дела?"])
+    client.get("/users/me", headers=me.headers)  # пользователь токена уже в identity_cache
+
+    # Один запрос на страницу, сколько бы ни было диалогов
+    with assert_max_queries(1):
+        response = client.get("/users", headers=me.headers)
+    assert len(response.json()) == 5
+    # Повтор — из кэша ответов, без БД
+    with assert_max_queries(0):
+        assert client.get("/users", headers=me.headers).status_code == 200
+
+
+def test_messages_page(client, make_user):
+    me, partner = make_user(), make_user()
+    first, *_ = add_messages(me.id, partner.id, [f"сообщение {i}" for i in range(40)])
+    add_messages(partner.id, me.id, ["ответ"], reply_to_id=first)
+    client.get("/users/me", headers=me.headers)
+
+    # Цитаты подгружаются тем же запросом, а не по одному на сообщение
+    with assert_max_queries(1):
+        response = client.get(f"/messages/{partner.id}", params={"limit": 50}, headers=me.headers)
+    assert len(response.json()) == 41
+    with assert_max_queries(0):
+        etag = client.get(f"/messages/{partner.id}", params={"limit": 50}, headers=me.headers).headers["ETag"]
+    with assert_max_queries(0):
+        response = client.get(
+            f"/messages/{partner.id}", params={"limit": 50}, headers={**me.headers, "If-None-Match": etag}
+        )
+    assert response.status_code == 304
+
+
+def test_search(client, make_user):
+    me, partner = make_user(), make_user()
+    add_messages(me.id, partner.id, [f"отчёт номер {i}" for i in range(20)])
+    client.get("/users/me", headers=me.headers)
+
+    with assert_max_queries(1):
+        response = client.get(f"/messages/{partner.id}/search", params={"q": "отчёт"}, headers=me.headers)
+    assert len(response.json()) == 20
+
+
+def test_ws_frames(client, make_user):
+    me, partner = make_user(), make_user()
+    add_messages(partner.id, me.id, ["непрочитанное"] * 3)
+
+    with open_ws(client, me) as ws:
+        time.sleep(0.1)  # подключение и рассылка статуса — вне бюджетов кадров
+
+        # INSERT пачки + upsert диалога + upsert счётчиков seq + журнал событий
+        with assert_max_queries(4):
+            ws.send_json({"recipient_id": partner.id, "content": "привет"})
+            message = receive(ws, "new_message")
+
+        with assert_max_queries(0):
+            ws.send_json({"type": "typing", "recipient_id": partner.id})
+            time.sleep(0.05)
+
+        with assert_max_queries(5):
+            ws.send_json({"type": "edit_message", "message_id": message["id"], "new_content": "исправлено"})
+            receive(ws, "message_edited")
+
+        with assert_max_queries(9):
+            ws.send_json({"type": "delete_message", "message_id": message["id"]})
+            receive(ws, "message_deleted")
+
+        # Отметки о прочтении пишутся пачкой при сбросе коалесцера
+        with assert_max_queries(4):
+            ws.send_json({"type": "read_messages", "sender_id": partner.id})
+            time.sleep(0.6)
+
+        with assert_max_queries(3):
+            ws.send_json({"type": "sync", "since": 0})
+            batch = receive(ws, "sync_batch")
+        # new_message и message_edited удалённого сообщения sync уже не отдаёт
+        assert [event["type"] for event in batch["events"]] == ["message_deleted"]
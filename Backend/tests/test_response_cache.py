@@ -0,0 +1,106 @@
+"""Кэш ответов: ETag/304, инвалидация по версиям областей и бэкенды."""
+import asyncio
+import time
+
+import fakeredis
+import pytest
+import redis.asyncio
+
+import response_cache
+from conftest import add_messages
+from instrumentation import assert_max_queries
+from response_cache import MemoryResponseCache, RedisResponseCache, chat_list_scope, conversation_scope
+
+
+def test_etag_and_not_modified(client, make_user):
+    me, partner = make_user(), make_user()
+    add_messages(partner.id, me.id, ["привет"])
+
+    first = client.get(f"/messages/{partner.id}", headers=me.headers)
+    etag = first.headers["etag"]
+    with assert_max_queries(0):
+        again = client.get(f"/messages/{partner.id}", headers={**me.headers, "If-None-Match": etag})
+
+    assert again.status_code == 304
+    assert again.content == b""
+
+
+def test_new_message_invalidates_both_sides(client, make_user):
+    me, partner = make_user(), make_user()
+    add_messages(partner.id, me.id, ["привет"])
+    etag = client.get(f"/messages/{partner.id}", headers=me.headers).headers["etag"]
+    client.get("/users", headers=partner.headers)
+
+    add_messages(me.id, partner.id, ["ответ"])
+
+    page = client.get(f"/messages/{partner.id}", headers={**me.headers, "If-None-Match": etag})
+    assert page.status_code == 200
+    assert [m["content"] for m in page.json()][-1] == "ответ"
+    chats = client.get("/users", headers=partner.headers).json()
+    assert chats[0]["last_message"] == "ответ"
+
+
+def test_conversation_scope_is_symmetric():
+    assert conversation_scope(3, 9) == conversation_scope(9, 3)
+
+
+def test_forgotten_version_does_not_reuse_entries():
+    async def scenario():
+        cache = MemoryResponseCache(versions_size=1)
+        key, _ = await cache.lookup(["conv:1:2"], "page")
+        await cache.set(key, {"body": "[]"})
+        await cache.bump("conv:1:2")
+        # Версия области вытеснена из LRU: версия по умолчанию не меньше прежней,
+        # запись до инвалидации не находится
+        await cache.bump("chats:5")
+        fresh_key, _ = await cache.lookup(["conv:1:2"], "page")
+        return key, fresh_key, await cache.get(fresh_key)
+
+    key, fresh_key, entry = asyncio.run(scenario())
+    assert fresh_key != key
+    assert entry is None
+
+
+def test_recent_bump_reads_primary(monkeypatch):
+    monkeypatch.setattr(response_cache, "REPLICA_LAG_SECONDS", 0.05)
+
+    async def scenario():
+        cache = MemoryResponseCache()
+        _, before = await cache.lookup([chat_list_scope(1)])
+        await cache.bump(chat_list_scope(1))
+        _, just_bumped = await cache.lookup([chat_list_scope(1)])
+        await asyncio.sleep(0.06)
+        _, later = await cache.lookup([chat_list_scope(1)])
+        return before, just_bumped, later
+
+    assert asyncio.run(scenario()) == (False, True, False)
+
+
+@pytest.fixture
+def redis_cache(monkeypatch):
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(
+        redis.asyncio, "from_url",
+        lambda url, **kwargs: fakeredis.FakeAsyncRedis(server=server, **kwargs),
+    )
+    return lambda: RedisResponseCache("redis://test")
+
+
+def test_redis_versions_shared_between_workers(redis_cache):
+    async def scenario():
+        first, second = redis_cache(), redis_cache()
+        key, _ = await first.lookup([conversation_scope(1, 2)], "page")
+        await first.set(key, {"body": "[]"})
+        shared = await second.get(key)
+        await second.bump(conversation_scope(1, 2))
+        stale_key, _ = await first.lookup([conversation_scope(1, 2)], "page")
+        return shared, stale_key != key
+
+    assert asyncio.run(scenario()) == ({"body": "[]"}, True)
+
+
+def test_create_cache_backends():
+    assert isinstance(response_cache.create_cache("memory://"), MemoryResponseCache)
+    assert isinstance(response_cache.create_cache("none://"), response_cache.DisabledResponseCache)
+    with pytest.raises(ValueError):
+        response_cache.create_cache("memcached://localhost")
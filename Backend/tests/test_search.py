@@ -0,0 +1,87 @@
+"""Поиск по сообщениям на SQLite (FTS5 + триггеры) и поиск пользователей."""
+from sqlalchemy import update
+
+import models
+from conftest import add_messages
+from database import SessionLocal
+
+
+def search(client, user, contact, q):
+    response = client.get(f"/messages/{contact.id}/search", params={"q": q}, headers=user.headers)
+    assert response.status_code == 200
+    return response.json()
+
+
+def test_finds_words_by_prefix_with_snippet(client, make_user):
+    alice, bob = make_user(), make_user()
+    add_messages(alice.id, bob.id, ["встреча завтра в офисе", "отчёт готов"])
+    add_messages(bob.id, alice.id, ["перенесём встречу?"])
+
+    hits = search(client, alice, bob, "встре")
+
+    assert {hit["content"] for hit in hits} == {"встреча завтра в офисе", "перенесём встречу?"}
+    assert all("<mark>" in hit["snippet"] for hit in hits)
+
+
+def test_all_terms_must_match(client, make_user):
+    alice, bob = make_user(), make_user()
+    add_messages(alice.id, bob.id, ["deploy release today", "deploy tomorrow"])
+
+    hits = search(client, alice, bob, "deploy release")
+
+    assert [hit["content"] for hit in hits] == ["deploy release today"]
+
+
+def test_only_own_conversation_and_not_encrypted(client, make_user):
+    alice, bob, carol = make_user(), make_user(), make_user()
+    add_messages(alice.id, bob.id, ["секретный план"], is_encrypted=True)
+    add_messages(alice.id, carol.id, ["план на вечер"])
+    add_messages(alice.id, bob.id, ["план на завтра"])
+
+    hits = search(client, alice, bob, "план")
+
+    assert [hit["content"] for hit in hits] == ["план на завтра"]
+
+
+def test_index_follows_edit_and_delete(client, make_user):
+    alice, bob = make_user(), make_user()
+    edited_id, deleted_id = add_messages(alice.id, bob.id, ["старый текст", "удалить это"])
+
+    with SessionLocal() as db:
+        db.execute(update(models.Message).where(models.Message.id == edited_id).values(content="новый текст"))
+        db.delete(db.get(models.Message, deleted_id))
+        db.commit()
+
+    assert search(client, alice, bob, "старый") == []
+    assert [hit["id"] for hit in search(client, alice, bob, "новый")] == [edited_id]
+    assert search(client, alice, bob, "удалить") == []
+
+
+def test_query_syntax_is_not_interpreted(client, make_user):
+    alice, bob = make_user(), make_user()
+    add_messages(alice.id, bob.id, ['цитата "с кавычками" AND NOT'])
+
+    # Операторы FTS5 — обычные слова запроса, спецсимволы отбрасываются
+    assert len(search(client, alice, bob, '"кавычками" (*')) == 1
+    assert len(search(client, alice, bob, 'AND NOT')) == 1
+    assert search(client, alice, bob, '"*()') == []
+
+
+def test_user_search_excludes_self(client, make_user):
+    me = make_user("searcher_me")
+    make_user("searcher_other")
+
+    response = client.get("/users/search", params={"q": "searcher_"}, headers=me.headers)
+
+    assert [user["username"] for user in response.json()] == ["searcher_other"]
+
+
+def test_snippet_escapes_message_html(client, make_user):
+    alice, bob = make_user(), make_user()
+    add_messages(bob.id, alice.id, ['<img src=x onerror="alert(1)"> ловушка & <b>'])
+
+    hit, = search(client, alice, bob, "ловушка")
+
+    # Разметка собеседника приходит текстом; теги — только выделение совпадения
+    assert hit["snippet"] == '&lt;img src=x onerror="alert(1)"&gt; <mark>ловушка</mark> &amp; &lt;b&gt;'
+    assert hit["content"] == '<img src=x onerror="alert(1)"> ловушка & <b>'
@@ -0,0 +1,124 @@
+"""Загрузки: потоковый multipart, дедупликация, лимиты и квота, докачка частями."""
+import hashlib
+import os
+
+import pytest
+from sqlalchemy import func, select
+
+import models
+import uploads
+from database import SessionLocal
+
+
+def upload(client, user, body: bytes, name: str = "photo.png"):
+    return client.post("/upload", headers=user.headers, files={"file": (name, body)})
+
+
+def partial_files() -> set[str]:
+    return set(os.listdir(uploads.PARTIAL_DIR))
+
+
+def test_upload_is_content_addressed(client, make_user):
+    first, second = make_user(), make_user()
+    body = os.urandom(3 * uploads.CHUNK_SIZE // 2)
+    before = partial_files()
+
+    url = upload(client, first, body).json()["url"]
+    assert upload(client, first, body, name="copy.png").json()["url"] == url
+    assert upload(client, second, body).json()["url"] == url
+
+    stored_name = url.rsplit("/", 1)[-1]
+    assert stored_name == f"{hashlib.sha256(body).hexdigest()}.png"
+    with open(os.path.join(uploads.UPLOAD_DIR, stored_name), "rb") as f:
+        assert f.read() == body
+    # Файл на диске один, строки — по одной на пользователя; временных файлов не осталось
+    with SessionLocal() as db:
+        owners = db.scalars(select(models.Upload.user_id).where(models.Upload.stored_name == stored_name)).all()
+    assert sorted(owners) == sorted([first.id, second.id])
+    assert partial_files() == before
+
+
+def test_upload_limits(client, make_user, monkeypatch):
+    user = make_user()
+    monkeypatch.setattr(uploads, "MAX_UPLOAD_SIZE", 1000)
+    before = partial_files()
+
+    # Content-Length заведомо больше лимита — отказ до чтения тела
+    response = upload(client, user, os.urandom(uploads.MULTIPART_OVERHEAD + 2000))
+    assert response.status_code == 413
+    # Тело в пределах запаса, но файл больше лимита — отказ по ходу чтения
+    assert upload(client, user, os.urandom(1500)).status_code == 413
+    assert upload(client, user, os.urandom(900)).status_code == 200
+    assert partial_files() == before
+
+
+def test_upload_quota(client, make_user, monkeypatch):
+    user = make_user()
+    monkeypatch.setattr(uploads, "USER_QUOTA_BYTES", 3000)
+
+    assert upload(client, user, os.urandom(2000)).status_code == 200
+    response = upload(client, user, os.urandom(2000))
+    assert response.status_code == 413
+    assert response.json()["detail"] == "Превышена квота на файлы"
+    # Незавершённые загрузки учитываются по заявленному размеру
+    response = client.post("/uploads", headers=user.headers, json={"filename": "big.bin", "size": 1500})
+    assert response.status_code == 413
+
+
+@pytest.mark.parametrize("request_kwargs, status_code", [
+    ({"data": {"other": "x"}, "files": {"attachment": ("a.bin", b"abc")}}, 422),
+    ({"content": b"raw bytes", "headers": {"Content-Type": "application/octet-stream"}}, 415),
+])
+def test_upload_rejects_malformed_body(client, make_user, request_kwargs, status_code):
+    user = make_user()
+    headers = {**user.headers, **request_kwargs.pop("headers", {})}
+    assert client.post("/upload", headers=headers, **request_kwargs).status_code == status_code
+
+
+def test_resumable_upload(client, make_user):
+    user, stranger = make_user(), make_user()
+    body = os.urandom(10_000)
+    session = client.post("/uploads", headers=user.headers, json={"filename": "doc.pdf", "size": len(body)}).json()
+    upload_id = session["upload_id"]
+    assert session["offset"] == 0
+
+    def put(offset: int, part: bytes):
+        return client.put(f"/uploads/{upload_id}", params={"offset": offset}, content=part, headers=user.headers)
+
+    assert put(0, body[:4000]).json()["offset"] == 4000
+    # Повтор уже принятой части и пропуск вперёд — 409 с текущей позицией
+    assert put(0, body[:4000]).status_code == 409
+    assert put(6000, body[6000:]).status_code == 409
+    # Часть длиннее заявленного размера не сдвигает offset
+    assert put(4000, body[4000:] + b"extra").status_code == 413
+    assert client.get(f"/uploads/{upload_id}", headers=user.headers).json()["offset"] == 4000
+
+    assert client.post(f"/uploads/{upload_id}/complete", headers=user.headers).status_code == 409
+    assert client.get(f"/uploads/{upload_id}", headers=stranger.headers).status_code == 404
+    assert put(4000, body[4000:]).json()["offset"] == len(body)
+
+    url = client.post(f"/uploads/{upload_id}/complete", headers=user.headers).json()["url"]
+    with open(os.path.join(uploads.UPLOAD_DIR, url.rsplit("/", 1)[-1]), "rb") as f:
+        assert f.read() == body
+    assert upload_id not in partial_files()
+    assert client.get(f"/uploads/{upload_id}", headers=user.headers).status_code == 404
+
+
+def test_cancel_and_sweep(client, make_user):
+    user = make_user()
+    cancelled = client.post("/uploads", headers=user.headers, json={"filename": "a.bin", "size": 100}).json()["upload_id"]
+    abandoned = client.post("/uploads", headers=user.headers, json={"filename": "b.bin", "size": 100}).json()["upload_id"]
+
+    assert client.delete(f"/uploads/{cancelled}", headers=user.headers).status_code == 204
+    assert cancelled not in partial_files()
+    assert client.get(f"/uploads/{cancelled}", headers=user.headers).status_code == 404
+
+    async def sweep():
+        from database import AsyncSessionLocal
+        async with AsyncSessionLocal() as db:
+            return await uploads.sweep_sessions(db, ttl_seconds=-1)
+
+    assert client.portal.call(sweep) >= 1
+    assert abandoned not in partial_files()
+    with SessionLocal() as db:
+        assert db.scalar(select(func.count()).where(models.UploadSession.user_id == user.id)) == 0
@@ -0,0 +1,72 @@
+"""Формат кадров /ws: согласование JSON/MessagePack и ограничение размера кадра."""
+import json
+
+import msgpack
+import pytest
+from starlette.websockets import WebSocketDisconnect
+
+import wire
+from conftest import open_ws
+
+
+def test_msgpack_subprotocol(client, make_user):
+    user = make_user()
+    with open_ws(client, user, subprotocols=["msgpack", "json"]) as ws:
+        assert ws.accepted_subprotocol == "msgpack"
+        ws.send_bytes(msgpack.packb({"type": "sync", "since": 0}))
+        frame = msgpack.unpackb(ws.receive_bytes())
+
+    assert frame["type"] == "sync_batch"
+    assert frame["done"] is True
+
+
+def test_json_without_subprotocol(client, make_user):
+    user = make_user()
+    with open_ws(client, user) as ws:
+        assert ws.accepted_subprotocol is None
+        ws.send_json({"type": "sync", "since": 0})
+        frame = json.loads(ws.receive_text())
+
+    assert frame["type"] == "sync_batch"
+
+
+def test_unknown_subprotocol_falls_back_to_json(client, make_user):
+    user = make_user()
+    with open_ws(client, user, subprotocols=["cbor"]) as ws:
+        assert ws.accepted_subprotocol is None
+        ws.send_json({"type": "sync", "since": 0})
+        assert json.loads(ws.receive_text())["type"] == "sync_batch"
+
+
+def test_invalid_frame_gets_error(client, make_user):
+    user = make_user()
+    with open_ws(client, user) as ws:
+        ws.send_json({"type": "edit_message", "message_id": "x"})
+        frame = ws.receive_json()
+        # Сокет остаётся открытым
+        ws.send_json({"type": "sync", "since": 0})
+        assert ws.receive_json()["type"] == "sync_batch"
+
+    assert frame["type"] == "error"
+
+
+def test_frame_over_limit_closes_socket(client, make_user, monkeypatch):
+    monkeypatch.setattr(wire, "WS_MAX_FRAME_BYTES", 1024)
+    user = make_user()
+    with open_ws(client, user) as ws:
+        ws.send_json({"type": "message", "recipient_id": user.id, "content": "x" * 2048})
+        with pytest.raises(WebSocketDisconnect) as exc:
+            ws.receive_text()
+
+    assert exc.value.code == 1009
+
+
+def test_frame_without_type_is_message():
+    frame = wire.parse_client_frame({"recipient_id": 1, "content": "привет"})
+    assert frame.type == "message"
+
+
+def test_encode_matches_negotiated_format():
+    message = {"type": "new_message", "content": "привет"}
+    assert json.loads(wire.encode(message, wire.JSON)) == message
+    assert msgpack.unpackb(wire.encode(message, wire.MSGPACK)) == message
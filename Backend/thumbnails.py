@@ -0,0 +1,116 @@
+"""Уменьшенные варианты изображений (аватары, превью фото) в формате WebP.
+
+После /upload варианты 64/128/512 px строятся в фоне, в пуле процессов (ресайз и
+кодирование — чистая нагрузка на CPU). Если варианта ещё нет, он строится при первом
+запросе. Оригиналы хранятся по sha256, значит и вариант неизменяем: отдаём его со
+строгим ETag и годовым Cache-Control.
+"""
+import asyncio
+import multiprocessing
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+import uploads
+
+VARIANT_DIR = "static/variants"
+VARIANT_SIZES = (64, 128, 512)
+IMAGE_EXTENSIONS = {"jpg", "jpeg", "png", "gif", "webp", "bmp"}
+THUMBNAIL_WORKERS = int(os.getenv("THUMBNAIL_WORKERS", "2"))
+CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# Имя файла в хранилище: <sha256>.<ext> (см. uploads.store)
+STORED_NAME_RE = re.compile(r"^([0-9a-f]{64})\.([a-z0-9]{1,10})$")
+
+# Не fork: пул создаётся при первой загрузке, в уже многопоточном сервере (как в hashing)
+_MP_CONTEXT = multiprocessing.get_context(
+    "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+)
+_executor: ProcessPoolExecutor | None = None
+# Варианты, которые уже строятся: повторный запрос ждёт ту же задачу
+_in_flight: dict[str, asyncio.Future] = {}
+# Ссылки на фоновые задачи, чтобы их не собрал GC до завершения
+_background: set[asyncio.Task] = set()
+
+
+def _render_variant(src_path: str, dst_path: str, size: int):
+    # Выполняется в отдельном процессе
+    from PIL import Image, ImageOps
+
+    with Image.open(src_path) as image:
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((size, size))
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA" if image.mode in ("P", "LA", "PA") else "RGB")
+        tmp_path = f"{dst_path}.{os.getpid()}.tmp"
+        image.save(tmp_path, "WEBP", quality=80, method=4)
+    os.replace(tmp_path, dst_path)
+
+
+def _pool() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=THUMBNAIL_WORKERS, mp_context=_MP_CONTEXT)
+    return _executor
+
+
+def shutdown():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+def is_image(stored_name: str) -> bool:
+    match = STORED_NAME_RE.match(stored_name)
+    return bool(match) and match.group(2) in IMAGE_EXTENSIONS
+
+
+def variant_path(stored_name: str, size: int) -> str:
+    sha256 = STORED_NAME_RE.match(stored_name).group(1)
+    return os.path.join(VARIANT_DIR, f"{sha256}_{size}.webp")
+
+
+def etag(stored_name: str, size: int) -> str:
+    return f'"{STORED_NAME_RE.match(stored_name).group(1)}-{size}"'
+
+
+def variant_url(url: str | None, size: int) -> str | None:
+    """URL варианта для загруженного к нам изображения; внешние URL возвращаются как есть."""
+    if not url:
+        return url
+    stored_name = url.rsplit("/", 1)[-1]
+    if f"/{uploads.UPLOAD_DIR}/" not in url or not is_image(stored_name):
+        return url
+    return f"http://localhost:8000/media/{stored_name}/{size}"
+
+
+async def ensure_variant(stored_name: str, size: int) -> str:
+    """Путь к варианту; строит его в пуле процессов, если файла ещё нет."""
+    dst_path = variant_path(stored_name, size)
+    if os.path.exists(dst_path):
+        return dst_path
+
+    future = _in_flight.get(dst_path)
+    if future is None:
+        src_path = os.path.join(uploads.UPLOAD_DIR, stored_name)
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(_pool(), _render_variant, src_path, dst_path, size)
+        _in_flight[dst_path] = future
+        future.add_done_callback(lambda _: _in_flight.pop(dst_path, None))
+    await asyncio.shield(future)
+    return dst_path
+
+
+def schedule_variants(stored_name: str):
+    """Фоновая генерация всех вариантов после загрузки (ошибки — например, битое изображение — игнорируются)."""
+    if not is_image(stored_name):
+        return
+    for size in VARIANT_SIZES:
+        task = asyncio.ensure_future(ensure_variant(stored_name, size))
+        _background.add(task)
+        task.add_done_callback(lambda t: (_background.discard(t), t.cancelled() or t.exception()))
+
+
+def ensure_dirs():
+    os.makedirs(VARIANT_DIR, exist_ok=True)
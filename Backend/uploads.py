@@ -0,0 +1,361 @@
+"""Потоковая загрузка файлов с хранением по содержимому (content-addressed).
+
+Тело multipart разбирается потоком (MultipartFile) и пишется на диск частями через
+aiofiles, sha256 считается по ходу записи, и
+итоговое имя — это хэш: повторная загрузка того же файла (аватар, пересланное фото)
+не занимает диск второй раз. Размер файла и суммарный объём загрузок пользователя
+ограничены. Большие вложения можно докачивать по частям (см. эндпоинты /uploads).
+
+Незавершённые части лежат вне /static (UPLOAD_PARTIAL_DIR), чтобы их нельзя было
+скачать по ссылке. Брошенные загрузки удаляются через UPLOAD_SESSION_TTL_SECONDS
+после создания (UploadSweeper) или явно через DELETE /uploads/{id}.
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import re
+import time
+import uuid
+import weakref
+from datetime import datetime, timedelta, timezone
+from typing import AsyncIterator
+
+import aiofiles
+import aiofiles.os
+from fastapi import HTTPException, Request, status
+from python_multipart import MultipartParser
+from python_multipart.exceptions import MultipartParseError
+from python_multipart.multipart import parse_options_header
+from sqlalchemy import delete, func, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import run_in_threadpool
+
+import models
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_DIR = "static/uploads"
+# Должна быть на той же файловой системе, что и UPLOAD_DIR: готовый файл переносится os.replace
+PARTIAL_DIR = os.getenv("UPLOAD_PARTIAL_DIR", "uploads_partial")
+CHUNK_SIZE = 1024 * 1024
+# Запас на границы и заголовки частей multipart при проверке Content-Length
+MULTIPART_OVERHEAD = 64 * 1024
+
+MAX_UPLOAD_SIZE = int(os.getenv("MAX_UPLOAD_SIZE", str(50 * 1024 * 1024)))
+USER_QUOTA_BYTES = int(os.getenv("UPLOAD_QUOTA_BYTES", str(1024 * 1024 * 1024)))
+UPLOAD_SESSION_TTL_SECONDS = int(os.getenv("UPLOAD_SESSION_TTL_SECONDS", str(24 * 3600)))
+UPLOAD_SWEEP_INTERVAL_SECONDS = int(os.getenv("UPLOAD_SWEEP_INTERVAL_SECONDS", "3600"))
+
+# upload_id -> блокировка в этом процессе; между воркерами части сериализует блокировка строки
+_session_locks: weakref.WeakValueDictionary[str, asyncio.Lock] = weakref.WeakValueDictionary()
+
+
+def ensure_dirs():
+    os.makedirs(PARTIAL_DIR, exist_ok=True)
+
+
+def safe_extension(filename: str | None) -> str:
+    # Расширение попадает в путь на диске — только буквы/цифры, без точек и слэшей
+    ext = (filename or "").rsplit(".", 1)[-1] if "." in (filename or "") else ""
+    ext = re.sub(r"[^A-Za-z0-9]", "", ext)[:10].lower()
+    return ext or "bin"
+
+
+def public_url(stored_name: str) -> str:
+    return f"http://localhost:8000/{UPLOAD_DIR}/{stored_name}"
+
+
+async def used_bytes(db: AsyncSession, user_id: int) -> int:
+    # Квота учитывает и уже сохранённые файлы, и заявленный размер незавершённых загрузок
+    stored = await db.scalar(
+        select(func.coalesce(func.sum(models.Upload.size), 0)).where(models.Upload.user_id == user_id)
+    )
+    pending = await db.scalar(
+        select(func.coalesce(func.sum(models.UploadSession.size), 0)).where(models.UploadSession.user_id == user_id)
+    )
+    return int(stored) + int(pending)
+
+
+async def check_quota(db: AsyncSession, user_id: int, incoming: int):
+    if incoming > MAX_UPLOAD_SIZE:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail="Файл слишком большой")
+    if await used_bytes(db, user_id) + incoming > USER_QUOTA_BYTES:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail="Превышена квота на файлы")
+
+
+async def write_stream(
+    chunks: AsyncIterator[bytes], path: str, limit: int, mode: str = "wb", hasher=None,
+    detail: str = "Файл слишком большой",
+) -> int:
+    """Пишет поток в файл, не держа его в памяти целиком. Возвращает число записанных байт.
+    При превышении limit выбрасывается 413 с detail; недописанный файл убирает вызывающий код."""
+    written = 0
+    async with aiofiles.open(path, mode) as out:
+        async for chunk in chunks:
+            written += len(chunk)
+            if written > limit:
+                raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=detail)
+            if hasher is not None:
+                hasher.update(chunk)
+            await out.write(chunk)
+    return written
+
+
+class MultipartFile:
+    """Поле file из тела multipart/form-data, разбираемое прямо из потока запроса:
+    тело не складывается целиком ни в память, ни во временный файл Starlette,
+    поэтому лимиты срабатывают по ходу чтения. filename известен к первой части данных."""
+
+    def __init__(self, content_type: str | None, chunks: AsyncIterator[bytes], field: str = "file"):
+        media_type, params = parse_options_header(content_type or "")
+        if media_type != b"multipart/form-data" or not params.get(b"boundary"):
+            raise HTTPException(status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, detail="Ожидается multipart/form-data")
+        self.boundary = params[b"boundary"]
+        self.chunks = chunks
+        self.field = field.encode()
+        self.filename: str | None = None
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        # Колбэки парсера синхронные: складываем события куска и разбираем их после write
+        parsed = []
+        headers = {}
+        header = [b"", b""]
+
+        def on_header_field(data, start, end):
+            header[0] += data[start:end]
+
+        def on_header_value(data, start, end):
+            header[1] += data[start:end]
+
+        def on_header_end():
+            headers[header[0].lower()] = header[1]
+            header[0] = header[1] = b""
+
+        def on_headers_finished():
+            parsed.append(("part", dict(headers)))
+            headers.clear()
+
+        parser = MultipartParser(self.boundary, {
+            "on_header_field": on_header_field,
+            "on_header_value": on_header_value,
+            "on_header_end": on_header_end,
+            "on_headers_finished": on_headers_finished,
+            "on_part_data": lambda data, start, end: parsed.append(("data", data[start:end])),
+            "on_part_end": lambda: parsed.append(("end", None)),
+        })
+        reading = found = False
+        try:
+            async for chunk in self.chunks:
+                parser.write(chunk)
+                for kind, value in parsed:
+                    if kind == "part":
+                        _, disposition = parse_options_header(value.get(b"content-disposition", b""))
+                        reading = not found and disposition.get(b"name") == self.field
+                        if reading:
+                            self.filename = disposition.get(b"filename", b"").decode("utf-8", "replace")
+                    elif kind == "data" and reading and value:
+                        yield value
+                    elif kind == "end" and reading:
+                        reading, found = False, True
+                parsed.clear()
+            parser.finalize()
+        except MultipartParseError:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Повреждённое тело multipart")
+        if not found:
+            raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=f"Нет поля {self.field.decode()}")
+
+
+def _sha256_of_file(path: str) -> str:
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(CHUNK_SIZE):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+async def sha256_of_file(path: str) -> str:
+    # Хэширование большого файла — в пуле потоков, чтобы не держать event loop
+    return await run_in_threadpool(_sha256_of_file, path)
+
+
+async def store(db: AsyncSession, user_id: int, temp_path: str, sha256: str, size: int, ext: str) -> str:
+    """Переносит временный файл в хранилище под именем <sha256>.<ext> (или удаляет,
+    если такой уже есть) и записывает загрузку на пользователя. Возвращает публичный URL."""
+    stored_name = f"{sha256}.{ext}"
+    final_path = os.path.join(UPLOAD_DIR, stored_name)
+    if await aiofiles.os.path.exists(final_path):
+        await aiofiles.os.remove(temp_path)
+    else:
+        await aiofiles.os.replace(temp_path, final_path)
+
+    # Параллельная загрузка того же файла тем же пользователем: строка уже есть — используем её
+    upsert = pg_insert if db.get_bind().dialect.name == "postgresql" else sqlite_insert
+    await db.execute(
+        upsert(models.Upload)
+        .values(user_id=user_id, sha256=sha256, stored_name=stored_name, size=size)
+        .on_conflict_do_nothing(index_elements=["user_id", "sha256"])
+    )
+    await db.commit()
+    return public_url(stored_name)
+
+
+async def save_upload(db: AsyncSession, user_id: int, request: Request) -> str:
+    """Однократная загрузка (multipart): тело запроса -> временный файл + sha256 -> хранилище.
+    Заведомо слишком большое тело отклоняется по Content-Length, не читая его."""
+    declared = request.headers.get("content-length")
+    if declared and declared.isdigit():
+        await check_quota(db, user_id, max(int(declared) - MULTIPART_OVERHEAD, 0))
+    file = MultipartFile(request.headers.get("content-type"), request.stream())
+    temp_path = os.path.join(PARTIAL_DIR, uuid.uuid4().hex)
+    hasher = hashlib.sha256()
+    quota_left = max(USER_QUOTA_BYTES - await used_bytes(db, user_id), 0)
+    detail = "Превышена квота на файлы" if quota_left < MAX_UPLOAD_SIZE else "Файл слишком большой"
+    try:
+        size = await write_stream(file, temp_path, min(MAX_UPLOAD_SIZE, quota_left), hasher=hasher, detail=detail)
+    except BaseException:
+        await aiofiles.os.remove(temp_path)
+        raise
+    return await store(db, user_id, temp_path, hasher.hexdigest(), size, safe_extension(file.filename))
+
+
+# --- Докачиваемые загрузки ---
+
+def partial_path(upload_id: str) -> str:
+    return os.path.join(PARTIAL_DIR, upload_id)
+
+
+async def create_session(db: AsyncSession, user_id: int, filename: str, size: int) -> models.UploadSession:
+    await check_quota(db, user_id, size)
+    session = models.UploadSession(id=uuid.uuid4().hex, user_id=user_id, filename=filename, size=size, received=0)
+    db.add(session)
+    await db.commit()
+    async with aiofiles.open(partial_path(session.id), "wb"):
+        pass
+    return session
+
+
+async def get_session(db: AsyncSession, user_id: int, upload_id: str) -> models.UploadSession:
+    session = await db.get(models.UploadSession, upload_id)
+    if session is None or session.user_id != user_id:
+        raise HTTPException(status_code=404, detail="Загрузка не найдена")
+    return session
+
+
+def _session_lock(upload_id: str) -> asyncio.Lock:
+    lock = _session_locks.get(upload_id)
+    if lock is None:
+        lock = _session_locks[upload_id] = asyncio.Lock()
+    return lock
+
+
+async def _lock_row(db: AsyncSession, session: models.UploadSession):
+    """Блокирует строку загрузки до commit и перечитывает её: параллельный запрос
+    к той же загрузке (в том числе из другого воркера) ждёт и видит новое received.
+    Если загрузку успели удалить — 404."""
+    locked = await db.scalar(
+        select(models.UploadSession)
+        .where(models.UploadSession.id == session.id)
+        .with_for_update()
+        .execution_options(populate_existing=True)
+    )
+    if locked is None:
+        raise HTTPException(status_code=404, detail="Загрузка не найдена")
+
+
+async def append_part(db: AsyncSession, session: models.UploadSession, offset: int, chunks: AsyncIterator[bytes]) -> int:
+    async with _session_lock(session.id):
+        await _lock_row(db, session)
+        # Часть принимается только с текущей позиции: клиент после обрыва спрашивает offset и продолжает с него
+        if offset != session.received:
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f"Ожидался offset {session.received}")
+        path = partial_path(session.id)
+        try:
+            written = await write_stream(chunks, path, session.size - session.received, mode="ab")
+        except BaseException:
+            # Оборванная или слишком длинная часть не должна сдвигать offset
+            await run_in_threadpool(os.truncate, path, session.received)
+            raise
+
+        session.received += written
+        await db.commit()
+        return session.received
+
+
+async def complete_session(db: AsyncSession, session: models.UploadSession) -> str:
+    async with _session_lock(session.id):
+        await _lock_row(db, session)
+        if session.received != session.size:
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f"Получено {session.received} из {session.size} байт")
+        path = partial_path(session.id)
+        sha256 = await sha256_of_file(path)
+        user_id, size, ext = session.user_id, session.size, safe_extension(session.filename)
+        await db.delete(session)
+        return await store(db, user_id, path, sha256, size, ext)
+
+
+async def _remove_partial(upload_id: str):
+    try:
+        await aiofiles.os.remove(partial_path(upload_id))
+    except FileNotFoundError:
+        pass
+
+
+async def cancel_session(db: AsyncSession, session: models.UploadSession):
+    """Отмена загрузки клиентом: строка и недокачанный файл удаляются, квота освобождается."""
+    async with _session_lock(session.id):
+        await _lock_row(db, session)
+        await db.delete(session)
+        await db.commit()
+        await _remove_partial(session.id)
+
+
+async def sweep_sessions(db: AsyncSession, ttl_seconds: int = UPLOAD_SESSION_TTL_SECONDS) -> int:
+    """Удаляет загрузки старше ttl_seconds и их файлы, а также файлы в PARTIAL_DIR,
+    за которыми нет загрузки (временные файлы упавших однократных загрузок)."""
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=ttl_seconds)
+    expired = (await db.scalars(
+        delete(models.UploadSession).where(models.UploadSession.created_at < cutoff).returning(models.UploadSession.id)
+    )).all()
+    await db.commit()
+    for upload_id in expired:
+        await _remove_partial(upload_id)
+
+    live = set((await db.scalars(select(models.UploadSession.id))).all())
+    deadline = time.time() - ttl_seconds
+    for name in await aiofiles.os.listdir(PARTIAL_DIR):
+        path = os.path.join(PARTIAL_DIR, name)
+        try:
+            if name not in live and (await aiofiles.os.stat(path)).st_mtime < deadline:
+                await aiofiles.os.remove(path)
+        except FileNotFoundError:
+            pass
+    return len(expired)
+
+
+class UploadSweeper:
+    """Фоновая уборка брошенных загрузок раз в UPLOAD_SWEEP_INTERVAL_SECONDS."""
+
+    def __init__(self, session_factory):
+        self.session_factory = session_factory
+        self._task: asyncio.Task | None = None
+
+    async def start(self):
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+
+    async def _loop(self):
+        while True:
+            try:
+                async with self.session_factory() as db:
+                    removed = await sweep_sessions(db)
+                if removed:
+                    logger.info("Удалено брошенных загрузок: %s", removed)
+            except Exception:
+                logger.exception("Не удалось убрать брошенные загрузки")
+            await asyncio.sleep(UPLOAD_SWEEP_INTERVAL_SECONDS)
@@ -0,0 +1,83 @@
+"""Формат кадров /ws: JSON или MessagePack.
+
+Клиент выбирает формат через подпротокол WebSocket (заголовок Sec-WebSocket-Protocol):
+  - "msgpack" — бинарные кадры MessagePack (пакет msgpack, см. README.md);
+  - "json" или без подпротокола — текстовые кадры JSON, как раньше.
+Сжатие permessage-deflate uvicorn согласует сам (включено по умолчанию,
+--ws-per-message-deflate), браузеры предлагают его автоматически — для JSON
+это основной выигрыш по трафику.
+
+Входящие кадры ограничены WS_MAX_FRAME_BYTES и проверяются по схемам из schemas.py.
+"""
+import json
+import os
+
+from fastapi import WebSocket, WebSocketDisconnect
+from pydantic import BaseModel, TypeAdapter
+
+import schemas
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+WS_MAX_FRAME_BYTES = int(os.getenv("WS_MAX_FRAME_BYTES", str(64 * 1024)))
+
+JSON = "json"
+MSGPACK = "msgpack"
+
+_client_frame = TypeAdapter(schemas.ClientFrame)
+
+
+class FrameTooLarge(Exception):
+    pass
+
+
+def supported_protocols() -> list[str]:
+    return [MSGPACK, JSON] if msgpack is not None else [JSON]
+
+
+def negotiate(websocket: WebSocket) -> tuple[str, str | None]:
+    """(формат, подпротокол для accept). Подпротокол возвращается, только если клиент его предложил."""
+    offered = websocket.scope.get("subprotocols") or []
+    for protocol in offered:
+        if protocol in supported_protocols():
+            return protocol, protocol
+    return JSON, None
+
+
+def encode(message: dict, protocol: str) -> str | bytes:
+    if protocol == MSGPACK:
+        return msgpack.packb(message, default=str)
+    # Так же, как starlette send_json
+    return json.dumps(message, separators=(",", ":"), ensure_ascii=False, default=str)
+
+
+async def send(websocket: WebSocket, frame: str | bytes):
+    if isinstance(frame, bytes):
+        await websocket.send_bytes(frame)
+    else:
+        await websocket.send_text(frame)
+
+
+async def receive(websocket: WebSocket, protocol: str) -> dict:
+    """Следующий кадр клиента как dict. WebSocketDisconnect пробрасывается как есть."""
+    message = await websocket.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", 1000), message.get("reason"))
+    raw = message.get("bytes") if message.get("bytes") is not None else message.get("text", "")
+    size = len(raw) if isinstance(raw, bytes) else len(raw.encode())
+    if size > WS_MAX_FRAME_BYTES:
+        raise FrameTooLarge()
+    if isinstance(raw, bytes) and protocol == MSGPACK:
+        return msgpack.unpackb(raw)
+    return json.loads(raw)
+
+
+def parse_client_frame(data) -> BaseModel:
+    """Проверяет кадр по схеме; кадр без type — новое сообщение (как у старых клиентов).
+    Ошибку pydantic.ValidationError обрабатывает вызывающий код."""
+    if isinstance(data, dict):
+        data.setdefault("type", "message")
+    return _client_frame.validate_python(data)